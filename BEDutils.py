@@ -18,7 +18,11 @@ class BEDNotIndexed(Exception):
 ### BED indexer
 
 class BEDindexer():
+    """Build and load the .bidx index of a BED file, mapping each chromosome to the offset of its first
+line. The first line of the index records the size and modification time of the BED file, so that
+an index left over from a previous version of the file can be recognized (see isCurrent)."""
     filename = ""
+    stamp = None                # (size, mtime) of the BED file when the loaded index was built
 
     def __init__(self, filename):
         self.filename = filename
@@ -26,14 +30,26 @@ class BEDindexer():
     def bidx_filename(self):
         return os.path.splitext(self.filename)[0] + ".bidx"
 
+    def fileStamp(self):
+        st = os.stat(self.filename)
+        return (st.st_size, int(st.st_mtime))
+
+    def isCurrent(self):
+        """Returns True if the loaded index was built from the current version of the BED file."""
+        return self.stamp == self.fileStamp()
+
     def loadindex(self):
         bidx = self.bidx_filename()
         if os.path.isfile(bidx):
             with open(bidx, "r") as f:
                 data = f.read().split("\n")
             idx = {}
+            self.stamp = None
             for d in data:
-                if "\t" in d:
+                if d.startswith("#stamp\t"):
+                    parts = d.split("\t")
+                    self.stamp = (int(parts[1]), int(parts[2]))
+                elif "\t" in d:
                     [chrom, fp] = d.split("\t")
                     idx[chrom] = int(fp)
             return idx
@@ -45,6 +61,7 @@ class BEDindexer():
         tag = ""
         sys.stderr.write("{} => {}\n".format(self.filename, bidx))
         with open(bidx, "w") as out:
+            out.write("#stamp\t{}\t{}\n".format(*self.fileStamp()))
             with open(self.filename, "r") as f:
                 while True:
                     pos = f.tell()
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
+import gc
 import os
 import sys
 import os.path
+import itertools
 import sqlite3 as sql
 
 import Utils
+from Regions import IntervalIndex
 
 ## DB Utilities
 
@@ -114,6 +117,53 @@ def sortClassifications(cls):
     cls.sort(key=lambda c: c.idx, reverse=True)
     return cls
 
+# Canonical transcript selection. Each policy is a function that receives the transcripts of
+# a gene that can be chosen and an optional argument, and returns the canonical transcript of
+# the gene (or None).
+
+def canonicalLongest(transcripts, arg=None):
+    """The longest transcript (the first one, in case of ties)."""
+    best = None
+    maxlen = 0
+    for tr in transcripts:
+        m = int(tr.txend) - int(tr.txstart)
+        if m > maxlen:
+            maxlen = m
+            best = tr
+    return best
+
+def canonicalCDS(transcripts, arg=None):
+    """The transcript with the longest CDS, or the longest transcript if the gene is not coding."""
+    best = None
+    maxlen = 0
+    for tr in transcripts:
+        m = tr.cdsLength()
+        if m > maxlen:
+            maxlen = m
+            best = tr
+    return best or canonicalLongest(transcripts)
+
+def canonicalTagged(transcripts, arg=None):
+    """The first transcript having tag `arg' (default: Ensembl_canonical), or the longest transcript if none does."""
+    tag = arg or "Ensembl_canonical"
+    for tr in transcripts:
+        if tag in tr.tags:
+            return tr
+    return canonicalLongest(transcripts)
+
+canonicalPolicies = {'longest': canonicalLongest,
+                     'cds': canonicalCDS,
+                     'tag': canonicalTagged}
+
+def getCanonicalPolicy(spec):
+    """Parse a canonical policy specification of the form name or name:arg, where name is one of the keys
+of canonicalPolicies. Returns a tuple (function, arg), or None if the policy is unknown."""
+    (name, _, arg) = spec.partition(":")
+    if name in canonicalPolicies:
+        return (canonicalPolicies[name], arg or None)
+    else:
+        return None
+
 # Classes
 
 class Genelist():
@@ -125,10 +175,12 @@ class Genelist():
     currentChrom = ""
     currentGenes = ""
     source = ""
+    canonicalPolicy = "longest" # How setCanonical chooses the canonical transcript, see getCanonicalPolicy
 
     def __init__(self):
         self.chroms = []
         self.genes = {}
+        self.indexes = {}
         self.btFlags = {"": True, "*": True}
 
     # Next two methods allow a genelist to be used in a with statement
@@ -140,24 +192,70 @@ class Genelist():
         pass
 
     def saveAllToDB(self, filename):
-        """Save all genes to the database represented by connection `conn'."""
+        """Save all genes to the database in `filename'. Rows are inserted in bulk, one chromosome
+at a time, in a single transaction; the indexes are created after loading (if the database was
+initialized without them), and the database is analyzed at the end."""
         tot  = 0                # Total number of genes written
         conn = sql.connect(filename)
-        with conn:
-            for chrom in self.chroms:
-                sys.stderr.write("  {}... ".format(chrom))
-                n = 0
-                for g in self.genes[chrom]:
-                    g.saveToDB(conn)
-                    n += 1
-                sys.stderr.write("{} genes written.\n".format(n))
-                tot += n
-            self.setTSS(conn)
-            self.setCanonical(conn)
-            self.setCounts(conn)
-            conn.execute("INSERT INTO Source (filename) values (?);", (self.source,))
+        try:
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute("PRAGMA journal_mode = MEMORY;")
+            conn.execute("PRAGMA cache_size = -{};".format(dbCacheSize))
+            kept = self.uniqueTranscripts()
+            self.setCanonical(kept)
+            with conn:
+                for chrom in self.chroms:
+                    sys.stderr.write("  {}... ".format(chrom))
+                    n = self.saveChromToDB(conn, chrom, kept)
+                    sys.stderr.write("{} genes written.\n".format(n))
+                    tot += n
+            sys.stderr.write("Creating indexes...\n")
+            createIndexes(conn)
+            with conn:
+                self.setTSS(conn)
+                self.setCounts(conn)
+                conn.execute("INSERT INTO Source (filename) values (?);", (self.source,))
+                if selectValue(conn, "SELECT count(*) FROM sqlite_master WHERE name='GenesRtree';"):
+                    sys.stderr.write("Filling R*Tree indexes...\n")
+                    fillRtree(conn)
+            conn.execute("ANALYZE;")
+        finally:
+            conn.close()
         return tot
 
+    def uniqueTranscripts(self):
+        """Returns a dictionary mapping each transcript ID to the transcript that will be written
+to the database for it, which is the first one in order of chromosome and gene. The others are
+reported as duplicates."""
+        kept = {}
+        for chrom in self.chroms:
+            for g in self.genes[chrom]:
+                for tr in g.transcripts:
+                    if tr.ID in kept:
+                        sys.stderr.write("Error: transcript ID {} is not unique.\n".format(tr.ID))
+                    else:
+                        kept[tr.ID] = tr
+        return kept
+
+    def saveChromToDB(self, conn, chrom, kept):
+        """Insert the genes in `chrom' with their transcripts and exons into the database
+represented by connection `conn'. Only the transcripts in `kept' (see uniqueTranscripts)
+are written. Returns the number of genes written."""
+        genes = self.genes[chrom]
+        grows = []
+        trows = []
+        erows = []
+        for g in genes:
+            grows.append(g.dbRow())
+            for tr in g.transcripts:
+                erows.extend(tr.exonRows())
+                if kept.get(tr.ID) is tr:
+                    trows.append(tr.dbRow(g.ID))
+        conn.executemany("INSERT INTO Exons (ID, idx, chrom, start, end) VALUES (?, ?, ?, ?, ?);", erows)
+        conn.executemany("INSERT INTO Transcripts (ID, parentID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend, canonical) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", trows)
+        conn.executemany("INSERT INTO Genes (ID, name, geneid, ensg, biotype, chrom, strand, start, end, canonical) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", grows)
+        return len(genes)
+
     def setTSS(self, conn):
         sys.stderr.write("Setting TSS...\n")
         conn.execute("UPDATE Genes SET tss=start WHERE strand='1';")
@@ -165,20 +263,21 @@ class Genelist():
         conn.execute("UPDATE Transcripts SET tss=txstart WHERE strand='1';")
         conn.execute("UPDATE Transcripts SET tss=txend WHERE strand='-1';")
 
-    def setCanonical(self, conn):
-        sys.stderr.write("Setting Canonical...\n")
-        c = conn.cursor()
-        for r in conn.execute("SELECT ID FROM Genes;"):
-            gid = r[0]
-            maxtr = 0
-            best  = ""
-            for tr in c.execute("SELECT ID, txstart, txend FROM Transcripts WHERE parentID=?;", (gid,)):
-                m = int(tr[2]) - int(tr[1])
-                if m > maxtr:
-                    maxtr = m
-                    best = tr[0]
-            c.execute("UPDATE Genes SET canonical=? WHERE ID=?;", (best, gid))
-            c.execute("UPDATE Transcripts SET canonical='Y' WHERE ID=?;", (best,))
+    def setCanonical(self, kept=None):
+        """Mark the canonical transcript of each gene, chosen according to canonicalPolicy. This is done
+in memory, so the canonical flags are written to the database together with the genes. If `kept' is
+specified (see uniqueTranscripts), only transcripts that will be written can be chosen."""
+        sys.stderr.write("Setting Canonical ({})...\n".format(self.canonicalPolicy))
+        (policy, arg) = getCanonicalPolicy(self.canonicalPolicy)
+        for chrom in self.chroms:
+            for g in self.genes[chrom]:
+                if kept is None:
+                    best = policy(g.transcripts, arg)
+                else:
+                    best = policy([ tr for tr in g.transcripts if kept.get(tr.ID) is tr ], arg)
+                for tr in g.transcripts:
+                    tr.canonical = tr is best
+                g.canonical = best.ID if best else ""
 
     def setCounts(self, conn):
         sys.stderr.write("Updating Counts...\n")
@@ -230,6 +329,7 @@ class Genelist():
                 self.chroms.append(chrom)
                 self.genes[chrom] = []
             self.genes[chrom].append(gene)
+            self.indexes.pop(chrom, None)
             self.ngenes += 1
 
     def selectChrom(self, chrom):
@@ -271,46 +371,30 @@ class Genelist():
             self.genes[chrom].sort(key=lambda g:g.start)
 
     def buildIndexes(self):
-        step = 100
-        idxs = {}
-        for chrom, genes in Utils.get_iterator(self.genes):
-            ng = len(genes)
-            d = []
-            # print("chr={}, genes={}".format(chrom, len(genes)))
-            for i in range(0, len(genes), step):
-                i2 = min(i+step, ng) - 1
-                # print("i1={}, i2={}".format(i, i+step-1))
-                gfirst = genes[i]
-                glast  = genes[i2]
-                d.append([gfirst.start, glast.end, i, i2])
-            idxs[chrom] = d
-            # print(d)
-            # raw_input()
-        self.indexes = idxs
-
-    def positionsToRange(self, chrom, start, end):
-        """Returns the first and last index for genes in the range `start' to `end'."""
-        first = last = 0
-        if chrom in self.indexes:
-            idxs = self.indexes[chrom]
-            for i in range(0, len(idxs)):
-                iblock = idxs[i]
-                if iblock[0] <= start <= iblock[1]:
-                    sb = iblock
-                    eb = iblock
-                    if i > 0:
-                        sb = idxs[i-1]
-                    if i < len(idxs) - 1:
-                        eb = idxs[i+1]
-                    first = sb[2]
-                    last  = eb[3]
-                    break
-        return (first, last)
+        """Build an interval index over the genes of each chromosome."""
+        self.indexes = {}
+        for chrom in self.chroms:
+            self.indexes[chrom] = IntervalIndex(self.genes[chrom])
+
+    def chromIndex(self, chrom):
+        """Returns the interval index for the genes on `chrom' (building it if necessary), or None."""
+        if chrom not in self.indexes:
+            if chrom not in self.genes:
+                return None
+            self.indexes[chrom] = IntervalIndex(self.genes[chrom])
+        return self.indexes[chrom]
+
+    def overlappingGenes(self, chrom, start, end):
+        """Returns all genes in `chrom' whose start-end range overlaps the `start-end' region, in order of start."""
+        idx = self.chromIndex(chrom)
+        if idx is None:
+            return []
+        return idx.all(start, end)
 
     def classifyIntersection(self, astart, aend, g):
         """A is mine, B is other."""
-        bstart = g.txstart
-        bend   = g.txend
+        bstart = g.start
+        bend   = g.end
         if astart < bstart:
             if bstart <= aend <= bend:
                 how = 'left'
@@ -338,14 +422,15 @@ class Genelist():
         return None
 
     def allIntersecting(self, chrom, start, end):
-        """Returns all genes in `chrom' that intersect the `start-end' region."""
+        """Returns all genes in `chrom' that intersect the `start-end' region, in order of start."""
+        return self.overlappingGenes(chrom, start, end)
+
+    def allIntersections(self, chrom, start, end):
+        """Returns a (gene, how, fraction of region, fraction of gene) tuple for each gene in `chrom'
+that intersects the `start-end' region."""
         result = []
-        self.selectChrom(chrom)
-        genes = self.currentGenes
-        (first, last) = self.positionsToRange(chrom, start, end)
-        # print("Looking at {}-{}".format(first, last))
-        for i in range(first, last+1):
-            ix = self.classifyIntersection(start, end, genes[i])
+        for g in self.allIntersecting(chrom, start, end):
+            ix = self.classifyIntersection(start, end, g)
             if ix:
                 result.append(ix)
         return result
@@ -356,7 +441,7 @@ class Genelist():
                 f.readline()
                 for line in f:
                     parsed = line.rstrip("\n\r").split("\t")
-                    allint = self.allIntersecting(parsed[0], int(parsed[1]), int(parsed[2]))
+                    allint = self.allIntersections(parsed[0], int(parsed[1]), int(parsed[2]))
                     for a in allint:
                         g = a[0]
                         out.write("\t".join(parsed + [g.name, g.biotype, a[1], Utils.f2dd(a[2]*100), Utils.f2dd(a[3]*100)]) + "\n")
@@ -409,6 +494,14 @@ class GenelistDB(Genelist):
     preloaded = False           # Did we preload all genes into the Genelist?
     genesTable = {}
     transcriptsTable = {}
+    nqueries = 0                # Number of queries sent to the database
+    maxinlist = 500             # Larger sets of IDs are passed to queries through a temporary table
+    rtree = None                # Does the database have R*Tree indexes? None until checked by hasRtree
+    chromIDs = {}               # Chromosome name -> ID in the R*Tree indexes
+    chromSizes = {}             # Chromosome name -> largest gene or transcript end
+    rtreeWindow = 100000        # Initial size of the window searched by findClosestGene using the R*Tree indexes
+    geneFields = ['ID', 'name', 'geneid', 'ensg', 'biotype', 'chrom', 'strand', 'start', 'end']
+    txFields = ['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend', 'canonical']
 
     def __enter__(self):
         self._level += 1
@@ -425,10 +518,96 @@ class GenelistDB(Genelist):
                 self.dbconn.close()
                 self.dbconn = None
 
+    def execute(self, query, args=()):
+        """Execute `query' on the open database connection, counting it in `nqueries'."""
+        self.nqueries += 1
+        return self.dbconn.execute(query, args)
+
+    def selectIn(self, query, ids):
+        """Execute `query', replacing the {} placeholder with the list of IDs in `ids' (to be used in
+an IN clause). Returns all rows."""
+        if len(ids) <= self.maxinlist:
+            return self.execute(query.format(",".join("?" * len(ids))), ids).fetchall()
+        self.execute("CREATE TEMP TABLE IF NOT EXISTS BatchIDs (ID varchar primary key);")
+        self.execute("DELETE FROM BatchIDs;")
+        self.nqueries += 1
+        self.dbconn.executemany("INSERT OR IGNORE INTO BatchIDs (ID) VALUES (?);", [ (i,) for i in ids ])
+        return self.execute(query.format("SELECT ID FROM temp.BatchIDs")).fetchall()
+
+    def makeGene(self, row):
+        """Create a Gene from a row containing the fields in `geneFields'."""
+        g = Gene(row[0], row[5], row[6])
+        for pair in zip(self.geneFields, row):
+            setattr(g, pair[0], pair[1])
+        return g
+
+    def makeTranscript(self, trow):
+        """Create a Transcript, with no exons, from a row containing the fields in `txFields'."""
+        tr = Transcript(trow[0], trow[4], trow[5], trow[6], trow[7])
+        tr.exons = []
+        for pair in zip(self.txFields, trow):
+            setattr(tr, pair[0], pair[1])
+        tr.canonical = (trow[10] == 'Y')
+        return tr
+
+    def loadExons(self, transcripts):
+        """Add their exons to the transcripts in `transcripts' (a dictionary indexed by ID) with a single query."""
+        for erow in self.selectIn("SELECT ID, start, end FROM Exons WHERE ID IN ({}) ORDER BY ID, idx;", list(transcripts)):
+            transcripts[erow[0]].addExon(erow[1], erow[2])
+
+    def loadGenes(self, ids):
+        """Returns a dictionary mapping the gene IDs in `ids' to Gene objects, complete with their
+transcripts and exons. Uses three queries, regardless of the number of genes."""
+        genes = {}
+        ids = list(set(ids))
+        if not ids:
+            return genes
+        for row in self.selectIn("SELECT " + ", ".join(self.geneFields) + " FROM Genes WHERE ID IN ({});", ids):
+            genes[row[0]] = self.makeGene(row)
+        transcripts = {}
+        for trow in self.selectIn("SELECT " + ", ".join(self.txFields) + ", parentID FROM Transcripts WHERE parentID IN ({}) ORDER BY rowid;", ids):
+            if trow[11] in genes:
+                tr = self.makeTranscript(trow)
+                genes[trow[11]].addTranscript(tr)
+                transcripts[tr.ID] = tr
+        for erow in self.selectIn("SELECT Exons.ID, Exons.start, Exons.end FROM Exons, Transcripts WHERE Exons.ID = Transcripts.ID AND Transcripts.parentID IN ({}) ORDER BY Exons.ID, Exons.idx;", ids):
+            if erow[0] in transcripts:
+                transcripts[erow[0]].addExon(erow[1], erow[2])
+        return genes
+
+    def loadAll(self):
+        """Add all genes in the database to this Genelist. The Exons, Transcripts and Genes tables are
+each read once (the first two ordered by their parent ID, so that the rows for each parent can be
+grouped as they are read), and each gene is assembled from the groups in a single pass."""
+        gcenabled = gc.isenabled()
+        gc.disable()            # Nothing to collect while building, and the collector is slow on millions of new objects
+        try:
+            with self:
+                exons = {}
+                for (tid, rows) in itertools.groupby(self.execute("SELECT ID, start, end FROM Exons ORDER BY ID, idx;"), lambda r: r[0]):
+                    exons[tid] = [ (r[1], r[2]) for r in rows ]
+                transcripts = {}
+                for (gid, rows) in itertools.groupby(self.execute("SELECT " + ", ".join(self.txFields) + ", parentID FROM Transcripts ORDER BY parentID, rowid;"), lambda r: r[11]):
+                    txs = []
+                    for trow in rows:
+                        tr = self.makeTranscript(trow)
+                        tr.exons = exons.get(trow[0], [])
+                        txs.append(tr)
+                    transcripts[gid] = txs
+                for row in self.execute("SELECT " + ", ".join(self.geneFields) + ", description FROM Genes ORDER BY rowid;"):
+                    g = self.makeGene(row)
+                    g.description = row[9]
+                    self.add(g, g.chrom)
+                    for tr in transcripts.get(g.ID, []):
+                        g.addTranscript(tr)
+        finally:
+            if gcenabled:
+                gc.enable()
+
     def getGenesTable(self):
         if not self.genesTable:
             with self:
-                for row in self.dbconn.execute("SELECT ID, biotype, name FROM genes;"):
+                for row in self.execute("SELECT ID, biotype, name FROM genes;"):
                     self.genesTable[row[0]] = {'gene_id': row[0],
                                                'gene_biotype': row[1] or "???",
                                                'gene_name': row[2]}
@@ -437,7 +616,7 @@ class GenelistDB(Genelist):
     def getTranscriptsTable(self):
         if not self.transcriptsTable:
             with self:
-                for row in self.dbconn.execute("SELECT transcripts.ID, genes.biotype, transcripts.name, genes.name FROM transcripts, genes WHERE genes.ID=transcripts.parentID;"):
+                for row in self.execute("SELECT transcripts.ID, genes.biotype, transcripts.name, genes.name FROM transcripts, genes WHERE genes.ID=transcripts.parentID;"):
                     self.transcriptsTable[row[0]] = {'transcript_id': row[0],
                                                      'gene_biotype': row[1] or "???",
                                                      'transcript_name': row[2],
@@ -449,7 +628,7 @@ class GenelistDB(Genelist):
         with self:
             #conn = sql.connect(self.dbname)
 #        try:
-            curr = self.dbconn.execute("SELECT name FROM Genes ORDER BY name")
+            curr = self.execute("SELECT name FROM Genes ORDER BY name")
             names = [ r[0] for r in curr.fetchall() ]
 #        finally:
 #            conn.close()
@@ -458,98 +637,79 @@ class GenelistDB(Genelist):
     def findGene(self, name, chrom=None):
         """Returns the gene called `name'. The name is matched against the ID, name, geneid, and ensg fields."""
         with self:
-            row = self.dbconn.execute("SELECT ID, name, geneid, ensg, biotype, chrom, strand, start, end FROM Genes WHERE ID=? OR name=? OR geneid=? OR ensg=?", 
-                                      (name, name, name, name)).fetchone()
+            row = self.execute("SELECT ID FROM Genes WHERE ID=? OR name=? OR geneid=? OR ensg=?",
+                               (name, name, name, name)).fetchone()
             if row:
-                gid = row[0]
-                g = Gene(gid, row[5], row[6])
-                for pair in zip(['ID', 'name', 'geneid', 'ensg', 'biotype', 'chrom', 'strand', 'start', 'end'], row):
-                    setattr(g, pair[0], pair[1])
-                for trow in self.dbconn.execute("SELECT ID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend FROM Transcripts WHERE parentID=?", (gid,)):
-                    tid = trow[0]
-                    tr = Transcript(tid, trow[4], trow[5], trow[6], trow[7])
-                    tr.exons = []
-                    for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
-                        setattr(tr, pair[0], pair[1])
-                    for erow in self.dbconn.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (tid,)):
-                        tr.addExon(erow[0], erow[1])
-                    g.addTranscript(tr)
-                return g
+                return self.loadGenes([row[0]]).get(row[0])
             else:
                 return None
 
     def allTranscriptNames(self):
         names = []
         with self:
-            curr = self.dbconn.execute("SELECT ID FROM Transcripts ORDER BY ID")
+            curr = self.execute("SELECT ID FROM Transcripts ORDER BY ID")
             names = [ r[0] for r in curr.fetchall() ]
         return names
 
     def findTranscript(self, name, chrom=None):
         """Returns the transcript called `name'. The name is matched against the ID, name, accession, and enst fields."""
         with self:
-            trow = self.dbconn.execute("SELECT ID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend FROM Transcripts WHERE ID=? OR name=? OR accession=? OR enst=?",
-                                       (name, name, name, name)).fetchone()
+            trow = self.execute("SELECT " + ", ".join(self.txFields) + " FROM Transcripts WHERE ID=? OR name=? OR accession=? OR enst=?",
+                                (name, name, name, name)).fetchone()
             if trow:
-                tid = trow[0]
-                tr = Transcript(tid, trow[4], trow[5], trow[6], trow[7])
-                tr.exons = []
-                for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
-                    setattr(tr, pair[0], pair[1])
-                for erow in self.dbconn.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (tid,)):
-                    tr.addExon(erow[0], erow[1])
+                tr = self.makeTranscript(trow)
+                self.loadExons({tr.ID: tr})
                 return tr
             else:
                 return None
 
     def getAllTranscripts(self):
-        """Returns an iterator that lopps over all transcripts."""
+        """Returns an iterator that lopps over all transcripts. Exons are read one chromosome at a time."""
         with self:
-            tcur = self.dbconn.cursor()
-            ecur = self.dbconn.cursor()
-
-            for trow in tcur.execute("SELECT t.ID, t.name, accession, enst, t.chrom, t.strand, txstart, txend, cdsstart, cdsend, g.name FROM Transcripts t, Genes g WHERE t.parentID = g.ID ORDER BY t.chrom, txstart"):
-                if trow:
-                    tid = trow[0]
-                    tr = Transcript(tid, trow[4], trow[5], trow[6], trow[7])
-                    tr.gene = trow[10]
-                    tr.exons = []
-                    for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
-                        setattr(tr, pair[0], pair[1])
-                    for erow in ecur.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (tid,)):
-                        tr.addExon(erow[0], erow[1])
+            chroms = [ r[0] for r in self.execute("SELECT DISTINCT chrom FROM Transcripts ORDER BY chrom;") ]
+            for chrom in chroms:
+                exons = {}
+                for (tid, rows) in itertools.groupby(self.execute("SELECT ID, start, end FROM Exons WHERE chrom=? ORDER BY ID, idx;", (chrom,)), lambda r: r[0]):
+                    exons[tid] = [ (r[1], r[2]) for r in rows ]
+                for trow in self.execute("SELECT " + ", ".join([ "t." + f for f in self.txFields ]) + ", g.name FROM Transcripts t, Genes g WHERE t.parentID = g.ID AND t.chrom=? ORDER BY t.txstart, t.rowid;", (chrom,)).fetchall():
+                    tr = self.makeTranscript(trow)
+                    tr.gene = trow[11]
+                    tr.exons = exons.get(tr.ID, [])
                     yield tr
 
     def findGenes(self, query, args=[]):
         """Returns the list of all genes that satisfy the `query'. `query' should be a SQL statement that returns
 a single column of values from the ID field."""
-        result = []
         with self:
-            gcur = self.dbconn.cursor()
-            for geneIDrow in self.dbconn.execute(query, args):
-                geneID = geneIDrow[0]
-                row = gcur.execute("SELECT ID, name, geneid, ensg, biotype, chrom, strand, start, end FROM Genes WHERE ID=?", (geneID,)).fetchone()
-                if row:
-                    g = Gene(geneID, row[5], row[6])
-                    for pair in zip(['ID', 'name', 'geneid', 'ensg', 'biotype', 'chrom', 'strand', 'start', 'end'], row):
-                        setattr(g, pair[0], pair[1])
-                    for trow in self.dbconn.execute("SELECT ID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend, canonical FROM Transcripts WHERE parentID=?", (geneID,)):
-                        tid = trow[0]
-                        tr = Transcript(tid, trow[4], trow[5], trow[6], trow[7])
-                        tr.exons = []
-                        for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
-                            setattr(tr, pair[0], pair[1])
-                        tr.canonical = (trow[10] == 'Y')
-                        for erow in self.dbconn.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (tid,)):
-                            tr.addExon(erow[0], erow[1])
-                        g.addTranscript(tr)
-                    result.append(g)
-            return result
+            ids = [ r[0] for r in self.execute(query, args).fetchall() ]
+            genes = self.loadGenes(ids)
+            return [ genes[gid] for gid in ids if gid in genes ]
+
+    def hasRtree(self):
+        """Returns True if the database has the R*Tree indexes created by initializeDB with rtree=True.
+The first call also reads the chromosome IDs and sizes. Requires an open connection."""
+        if self.rtree is None:
+            self.rtree = selectValue(self.dbconn, "SELECT count(*) FROM sqlite_master WHERE name='GenesRtree';") > 0
+            if self.rtree:
+                self.chromIDs = {}
+                self.chromSizes = {}
+                for row in self.execute("SELECT ID, name, size FROM Chroms;"):
+                    self.chromIDs[row[1]] = row[0]
+                    self.chromSizes[row[1]] = row[2]
+        return self.rtree
 
     def allIntersecting(self, chrom, start, end):
-        """Returns all genes in `chrom' that intersect the `start-end' region."""
-        return self.findGenes("SELECT ID from Genes where chrom=? and ((? <= start) and (start <= ?) or ((? <= end) and (end <= ?)) or ((start <= ?) and (end >= ?)))",
-                              (chrom, start, end, start, end, start, end))
+        """Returns all genes in `chrom' that intersect the `start-end' region, in the order in which they
+were written to the database (independent of the query plan, since callers pick among ties by order)."""
+        with self:
+            if self.hasRtree():
+                if chrom not in self.chromIDs:
+                    return []
+                cid = self.chromIDs[chrom]
+                return self.findGenes("SELECT g.ID FROM GenesRtree r, Genes g WHERE r.chromlo <= ? AND r.chromhi >= ? AND r.start <= ? AND r.end >= ? AND g.rowid = r.id ORDER BY g.rowid",
+                                      (cid, cid, end, start))
+            return self.findGenes("SELECT ID from Genes where chrom=? and ((? <= start) and (start <= ?) or ((? <= end) and (end <= ?)) or ((start <= ?) and (end >= ?))) ORDER BY rowid",
+                                  (chrom, start, end, start, end, start, end))
 
     def findClosestGene(self, chrom, start, end, transcripts=True, biotype=None, tss=False, canonical=False):
         """Find the closest gene to the region chrom:start-end, in either direction. Returns a tuple: (gene, distance).
@@ -579,11 +739,17 @@ to the gene's (or transcript's) TSS.
             args['fstart'] = 'tss'
             args['fend'] = 'tss'
 
+        # Ties are broken by rowid in the direction of the index scan, in both query paths
         with self:
-            query0 = "SELECT ID, {fstart}, {fend} FROM {table} WHERE chrom='{chrom}' AND {fstart} <= {start} AND {fend} >= {end} {biotype} {canon} ORDER BY {fstart} DESC LIMIT 1;".format(**args) # containing
-            query1 = "SELECT ID, {fend}   FROM {table} WHERE chrom='{chrom}' AND {fend} <= {start} {biotype} {canon} ORDER BY {fend} DESC LIMIT 1;".format(**args) # gene is upstream of region
-            query2 = "SELECT ID, {fstart} FROM {table} WHERE chrom='{chrom}' AND {fstart} >= {end} {biotype} {canon} ORDER BY {fstart} LIMIT 1;".format(**args) # gene is downstream of region
-            r0 = self.dbconn.execute(query0).fetchone()
+            if not tss and self.hasRtree():
+                (r0, r1, r2) = self.closestRtree(args)
+            else:
+                query0 = "SELECT ID, {fstart}, {fend} FROM {table} WHERE chrom='{chrom}' AND {fstart} <= {start} AND {fend} >= {end} {biotype} {canon} ORDER BY {fstart} DESC, {fend}, rowid DESC LIMIT 1;".format(**args) # containing
+                query1 = "SELECT ID, {fend}   FROM {table} WHERE chrom='{chrom}' AND {fend} <= {start} {biotype} {canon} ORDER BY {fend} DESC, rowid DESC LIMIT 1;".format(**args) # gene is upstream of region
+                query2 = "SELECT ID, {fstart} FROM {table} WHERE chrom='{chrom}' AND {fstart} >= {end} {biotype} {canon} ORDER BY {fstart}, rowid LIMIT 1;".format(**args) # gene is downstream of region
+                r0 = self.execute(query0).fetchone()
+                r1 = self.execute(query1).fetchone() if not r0 else None
+                r2 = self.execute(query2).fetchone() if not r0 else None
             if r0:
                 g0 = r0[0]
                 p1 = r0[1]
@@ -594,13 +760,11 @@ to the gene's (or transcript's) TSS.
                     return (g0, d1)
                 else:
                     return (g0, -d2)
-            r1 = self.dbconn.execute(query1).fetchone()
             if r1:
                 g1 = r1[0]
                 p1 = r1[1]
                 d1 = start - p1
                 # print (r1, d1)
-            r2 = self.dbconn.execute(query2).fetchone()
             if r2:
                 g2 = r2[0]
                 p2 = r2[1]
@@ -619,11 +783,42 @@ to the gene's (or transcript's) TSS.
                 else:
                     return (g2, -d2)
 
+    def closestRtree(self, args):
+        """Run the three queries of findClosestGene (containing, upstream, downstream) using the R*Tree
+indexes. The upstream and downstream queries look at a window of rtreeWindow bases next to the
+region, enlarged four times at each step until a gene is found or the window reaches the end of
+the chromosome. Returns the three rows (or None)."""
+        chrom = args['chrom']
+        if chrom not in self.chromIDs:
+            return (None, None, None)
+        args = dict(args, cid=self.chromIDs[chrom])
+        base = "FROM {table}Rtree r, {table} t WHERE r.chromlo <= {cid} AND r.chromhi >= {cid} AND t.rowid = r.id {biotype} {canon}".format(**args)
+        query0 = "SELECT t.ID, t.{fstart}, t.{fend} ".format(**args) + base + " AND r.start <= {start} AND r.end >= {end} ORDER BY t.{fstart} DESC, t.{fend}, t.rowid DESC LIMIT 1;".format(**args) # containing
+        r0 = self.execute(query0).fetchone()
+        if r0:
+            return (r0, None, None)
+        start = args['start']
+        end = args['end']
+        query1 = "SELECT t.ID, t.{fend} ".format(**args) + base + " AND r.end >= ? AND r.end <= ? ORDER BY t.{fend} DESC, t.rowid DESC LIMIT 1;".format(**args) # gene is upstream of region
+        w = self.rtreeWindow
+        while True:
+            r1 = self.execute(query1, (start - w, start)).fetchone()
+            if r1 or start - w <= 0:
+                break
+            w *= 4
+        query2 = "SELECT t.ID, t.{fstart} ".format(**args) + base + " AND r.start >= ? AND r.start <= ? ORDER BY t.{fstart}, t.rowid LIMIT 1;".format(**args) # gene is downstream of region
+        size = self.chromSizes[chrom]
+        w = self.rtreeWindow
+        while True:
+            r2 = self.execute(query2, (end, end + w)).fetchone()
+            if r2 or end + w >= size:
+                break
+            w *= 4
+        return (None, r1, r2)
+
     def getGeneInfo(self, geneid, query):
         with self:
-            gcur = self.dbconn.cursor()
-            row = gcur.execute(query, (geneid,)).fetchone()
-            return row
+            return self.execute(query, (geneid,)).fetchone()
 
 # Transcript class
 
@@ -640,6 +835,7 @@ class Transcript():
     cdsend = None
     strand = None
     canonical = False
+    tags = []
     exons = []
     smallrects = []
     largerects = []
@@ -666,16 +862,19 @@ class Transcript():
             print("{}CDS: {}-{}".format(prefix, self.cdsstart, self.cdsend))
             print("{}Exons: {}".format(prefix, self.exons))
 
-    def saveToDB(self, conn, parentID):
-        idx = 0
-        for ex in self.exons:
-            conn.execute("INSERT INTO Exons(ID, idx, chrom, start, end) VALUES (?, ?, ?, ?, ?);",
-                         (self.ID, idx, self.chrom, ex[0], ex[1]))
-            idx += 1
+    def dbRow(self, parentID):
+        """Returns the row for this transcript in the Transcripts table."""
+        return (self.ID, parentID, self.name, self.accession, self.enst, self.chrom, self.strand, self.txstart, self.txend, self.cdsstart, self.cdsend, 'Y' if self.canonical else 'N')
+
+    def exonRows(self):
+        """Returns the rows for the exons of this transcript in the Exons table."""
+        return [ (self.ID, idx, self.chrom, ex[0], ex[1]) for (idx, ex) in enumerate(self.exons) ]
 
+    def saveToDB(self, conn, parentID):
+        conn.executemany("INSERT INTO Exons(ID, idx, chrom, start, end) VALUES (?, ?, ?, ?, ?);", self.exonRows())
         try:
-            conn.execute("INSERT INTO Transcripts (ID, parentID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
-                         (self.ID, parentID, self.name, self.accession, self.enst, self.chrom, self.strand, self.txstart, self.txend, self.cdsstart, self.cdsend))
+            conn.execute("INSERT INTO Transcripts (ID, parentID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend, canonical) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                         self.dbRow(parentID))
         except sql.IntegrityError:
             sys.stderr.write("Error: transcript ID {} is not unique.\n".format(self.ID))
 
@@ -698,6 +897,12 @@ class Transcript():
         else:
             self.cdsend = cdsend
 
+    def cdsLength(self):
+        """Returns the number of coding bases in the exons of this transcript (0 if it has no CDS)."""
+        if not (self.cdsstart and self.cdsend):
+            return 0
+        return sum([ max(0, min(e[1], self.cdsend) - max(e[0], self.cdsstart)) for e in self.exons ])
+
     def setCDS(self, cdsstart, cdsend):
         """Set the CDS of this transcript to `cdsstart' and `cdsend'. This also sets the
 smallrects and largerects lists."""
@@ -863,6 +1068,7 @@ class Gene():
     strand = ""
     start = None                # leftmost txstart
     end = None                  # rightmost txend
+    canonical = ""              # ID of canonical transcript
     transcripts = []
     data = []
 
@@ -885,11 +1091,15 @@ class Gene():
         for t in self.transcripts:
             t.dump(prefix="  ", short=True)
 
+    def dbRow(self):
+        """Returns the row for this gene in the Genes table."""
+        return (self.ID, self.name, self.geneid, self.ensg, self.biotype, self.chrom, self.strand, self.start, self.end, self.canonical)
+
     def saveToDB(self, conn):
         for tr in self.transcripts:
             tr.saveToDB(conn, self.ID)
-        conn.execute("INSERT INTO Genes (ID, name, geneid, ensg, biotype, chrom, strand, start, end) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
-                     (self.ID, self.name, self.geneid, self.ensg, self.biotype, self.chrom, self.strand, self.start, self.end))
+        conn.execute("INSERT INTO Genes (ID, name, geneid, ensg, biotype, chrom, strand, start, end, canonical) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                     self.dbRow())
 
     def addTranscript(self, transcript):
         self.transcripts.append(transcript)
@@ -1092,6 +1302,8 @@ class GTFloader(GeneLoader):
             if f > 0:
                 key = p[0:f]
                 val = p[f+1:].strip('"')
+                if key == 'tag':
+                    anndict.setdefault('tags', []).append(val) # tag can appear more than once
                 anndict[key] = val
         return anndict
 
@@ -1135,6 +1347,7 @@ is in this list (or missing). If `notwanted' is specified, only include genes wh
                     self.currTranscript.geneid  = self.currGene.geneid
                     self.currTranscript.biotype = Utils.dget('transcript_biotype', ann)
                     self.currTranscript.name  = Utils.dget('transcript_name', ann)
+                    self.currTranscript.tags  = Utils.dget('tags', ann, [])
                     if txid.startswith("ENST"):
                         self.currTranscript.enst = txid
                     self.currTranscript.exons   = []
@@ -1213,6 +1426,7 @@ class GFFloader(GeneLoader):
                     self.currTranscript = Transcript(tid, chrom, strand, int(line[3]), int(line[4]))
                     self.currTranscript.name = Utils.dget('Name', ann, "")
                     self.currTranscript.biotype = Utils.dget('biotype', ann)
+                    self.currTranscript.tags = [ t for t in Utils.dget('tag', ann, "").split(",") if t ]
                     self.currTranscript.exons = [] # Exons come later in the file
                     if pid == self.currGene.ID:
                         self.currGene.addTranscript(self.currTranscript)
@@ -1249,61 +1463,70 @@ class DBloader(GeneLoader):
         self.gl = GenelistDB()
         self.gl.dbname = self.filename
         self.gl.preloaded = preload
+        if preload:
+            self.gl.loadAll()
+            return
         self.conn = sql.connect(self.filename)
         try:
-            if preload:
-                gcur = self.conn.cursor()
-                tcur = self.conn.cursor()
-                ecur = self.conn.cursor()
-                for row in gcur.execute("SELECT ID, name, geneid, ensg, biotype, chrom, strand, start, end, description FROM Genes"):
-                    gid = row[0]
-                    g = Gene(gid, row[5], row[6])
-                    for pair in zip(['ID', 'name', 'geneid', 'ensg', 'biotype', 'chrom', 'strand', 'start', 'end', 'description'], row):
-                        setattr(g, pair[0], pair[1])
-                    self.gl.add(g, g.chrom)
-                    for trow in tcur.execute("SELECT ID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend, canonical FROM Transcripts WHERE parentID=?", (gid,)):
-                        tid = trow[0]
-                        tr = Transcript(tid, trow[4], trow[5], trow[6], trow[7])
-                        for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
-                            setattr(tr, pair[0], pair[1])
-                        tr.canonical = (trow[10] == 'Y')
-                        for erow in ecur.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (tid,)):
-                            tr.addExon(erow[0], erow[1])
-                        g.addTranscript(tr)
-            else:
-                try:
-                    ncur = self.conn.execute("SELECT ngenes FROM Counts")
-                except:
-                    ncur = self.conn.execute("SELECT count(*) FROM Genes") # Fallback method for databases that don't have the Counts table yet...
-                self.gl.ngenes = ncur.fetchone()[0]
+            try:
+                ncur = self.conn.execute("SELECT ngenes FROM Counts")
+            except:
+                ncur = self.conn.execute("SELECT count(*) FROM Genes") # Fallback method for databases that don't have the Counts table yet...
+            self.gl.ngenes = ncur.fetchone()[0]
         finally:
             self.conn.close()
 
 ### Database stuff
 
-def initializeDB(filename):
-    """Create a new database in 'filename' and write the Genes, Transcripts, and Exons tables to it."""
+dbCacheSize = 200000            # Page cache (in kB) used while building a database
+dbIndexes = [ ('Genes', 'Genes', ['name', 'geneid', 'ensg', 'chrom', 'start', 'end']),
+              ('Trans', 'Transcripts', ['parentID', 'name', 'accession', 'enst', 'chrom', 'txstart', 'txend']),
+              ('Exon', 'Exons', ['ID', 'chrom', 'start', 'end']) ]
+
+def initializeDB(filename, indexes=True, rtree=False):
+    """Create a new database in 'filename' and write the Genes, Transcripts, and Exons tables to it.
+If `indexes' is False, the indexes are not created; saveAllToDB will create them after loading the data,
+which is much faster. If `rtree' is True, also create R*Tree indexes on the positions of genes and
+transcripts (filled by saveAllToDB), used by GenelistDB for overlap and closest gene queries."""
     conn = sql.connect(filename)
     try:
         conn.execute("DROP TABLE IF EXISTS Genes;")
         conn.execute("CREATE TABLE Genes (ID varchar primary key, name varchar, geneid varchar, ensg varchar, biotype varchar, description text, chrom varchar, strand int, start int, end int, canonical varchar, tss int default null);")
-        for field in ['name', 'geneid', 'ensg', 'chrom', 'start', 'end']:
-            conn.execute("CREATE INDEX Genes_{} on Genes({});".format(field, field))
         conn.execute("DROP TABLE IF EXISTS Transcripts;")
         conn.execute("CREATE TABLE Transcripts (ID varchar primary key, parentID varchar, name varchar, accession varchar, enst varchar, chrom varchar, strand int, txstart int, txend int, cdsstart int, cdsend int, canonical char(1) default 'N', tss int default null);")
-        for field in ['parentID', 'name', 'accession', 'enst', 'chrom', 'txstart', 'txend']:
-            conn.execute("CREATE INDEX Trans_{} on Transcripts({});".format(field, field))
         conn.execute("DROP TABLE IF EXISTS Exons;")
         conn.execute("CREATE TABLE Exons (ID varchar, idx int, chrom varchar, start int, end int);")
-        for field in ['ID', 'chrom', 'start', 'end']:
-            conn.execute("CREATE INDEX Exon_{} on Exons({});".format(field, field))
+        if indexes:
+            createIndexes(conn)
         conn.execute("DROP TABLE IF EXISTS Source;")
         conn.execute("CREATE TABLE Source (filename VARCHAR, ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL);")
         conn.execute("DROP TABLE IF EXISTS Counts;")
         conn.execute("CREATE TABLE Counts (ngenes INT DEFAULT 0, ntranscripts INT DEFAULT 0, nexons INT DEFAULT 0);")
+        for table in ['Chroms', 'GenesRtree', 'TranscriptsRtree']:
+            conn.execute("DROP TABLE IF EXISTS {};".format(table))
+        if rtree:
+            conn.execute("CREATE TABLE Chroms (ID integer primary key, name varchar, size int);")
+            # The chromosome ID is the first dimension, so each chromosome is a separate slice of the tree
+            conn.execute("CREATE VIRTUAL TABLE GenesRtree USING rtree_i32(id, chromlo, chromhi, start, end);")
+            conn.execute("CREATE VIRTUAL TABLE TranscriptsRtree USING rtree_i32(id, chromlo, chromhi, start, end);")
     finally:
         conn.close()
 
+def createIndexes(conn):
+    """Create the indexes on the Genes, Transcripts, and Exons tables, if they don't exist yet."""
+    for (prefix, table, fields) in dbIndexes:
+        for field in fields:
+            conn.execute("CREATE INDEX IF NOT EXISTS {}_{} on {}({});".format(prefix, field, table, field))
+
+def fillRtree(conn):
+    """Fill the Chroms table and the R*Tree indexes from the contents of the Genes and Transcripts tables."""
+    conn.execute("DELETE FROM Chroms;")
+    conn.execute("INSERT INTO Chroms (name, size) SELECT chrom, max(e) FROM (SELECT chrom, end AS e FROM Genes UNION ALL SELECT chrom, txend FROM Transcripts) GROUP BY chrom ORDER BY chrom;")
+    conn.execute("DELETE FROM GenesRtree;")
+    conn.execute("INSERT INTO GenesRtree SELECT g.rowid, c.ID, c.ID, g.start, g.end FROM Genes g, Chroms c WHERE g.chrom = c.name AND g.start <= g.end;")
+    conn.execute("DELETE FROM TranscriptsRtree;")
+    conn.execute("INSERT INTO TranscriptsRtree SELECT t.rowid, c.ID, c.ID, t.txstart, t.txend FROM Transcripts t, Chroms c WHERE t.chrom = c.name AND t.txstart <= t.txend;")
+
 ### Top level
 
 def loadGenes(filename, preload=True):
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
 import csv
+import bisect
 import Utils
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class Region(object):
     chrom = ""
     start = 0
@@ -78,14 +84,125 @@ class RegionSource(object):
                 self._idx += 1
                 return Region(src)
 
+class IntervalIndex(object):
+    """Index over a list of intervals (objects with `start' and `end' attributes, ends included)
+answering point and overlap queries in O(log n + k). The intervals are stored as a nested containment
+list: each list is sorted by start, and intervals contained in another one are moved to a sublist
+attached to it, so that the ends in each list are sorted too. Hits are always returned in order of
+start (intervals with the same start in the order they were given)."""
+    items = []                  # Intervals sorted by start
+    starts = []
+    maxends = []                # Running maximum of ends, for first-hit queries
+    lists = []                  # (starts, ends, ids, sublists) for each list, top list first
+    arrays = None               # numpy copies of starts and maxends, built by batchFirst
+
+    def __init__(self, intervals):
+        self.items = sorted(intervals, key=lambda r: r.start)
+        self.starts = [ r.start for r in self.items ]
+        self.maxends = []
+        m = None
+        for r in self.items:
+            m = r.end if m is None else max(m, r.end)
+            self.maxends.append(m)
+        self.build()
+
+    def __len__(self):
+        return len(self.items)
+
+    def build(self):
+        ends = [ r.end for r in self.items ]
+        members = [[]]          # ids in each list
+        lid = {}                # id of interval -> index of its sublist
+        stack = []
+        for i in sorted(range(len(self.items)), key=lambda i: (self.starts[i], -ends[i])):
+            while stack and ends[stack[-1]] < ends[i]:
+                stack.pop()
+            if stack:
+                parent = stack[-1]
+                if parent not in lid:
+                    lid[parent] = len(members)
+                    members.append([])
+                members[lid[parent]].append(i)
+            else:
+                members[0].append(i)
+            stack.append(i)
+        self.lists = [ ([ self.starts[i] for i in ids ], [ ends[i] for i in ids ], ids, [ lid.get(i, -1) for i in ids ]) for ids in members ]
+
+    def firstIndex(self, start, end=None):
+        """Returns the index of the first interval overlapping [start, end] (or containing `start' if
+`end' is not specified), or -1."""
+        if end is None:
+            end = start
+        i = bisect.bisect_left(self.maxends, start)
+        if i < len(self.items) and self.starts[i] <= end:
+            return i
+        return -1
+
+    def first(self, start, end=None):
+        """Returns the first interval overlapping [start, end] (or containing `start' if `end' is not
+specified), or None."""
+        i = self.firstIndex(start, end)
+        if i < 0:
+            return None
+        return self.items[i]
+
+    def allIndexes(self, start, end=None):
+        """Returns the sorted indexes of all intervals overlapping [start, end] (or containing `start' if
+`end' is not specified)."""
+        if end is None:
+            end = start
+        hits = []
+        todo = [0]
+        while todo:
+            (starts, ends, ids, subs) = self.lists[todo.pop()]
+            j = bisect.bisect_left(ends, start)
+            while j < len(ids) and starts[j] <= end:
+                hits.append(ids[j])
+                if subs[j] >= 0:
+                    todo.append(subs[j])
+                j += 1
+        hits.sort()
+        return hits
+
+    def all(self, start, end=None):
+        """Returns all intervals overlapping [start, end] (or containing `start' if `end' is not
+specified), in order of start."""
+        return [ self.items[i] for i in self.allIndexes(start, end) ]
+
+    def batch(self, starts, ends=None):
+        """Returns, for each query in `starts' (and `ends', if specified), the list of intervals it
+overlaps, in order of start."""
+        if ends is None:
+            return [ self.all(s) for s in starts ]
+        return [ self.all(s, e) for (s, e) in zip(starts, ends) ]
+
+    def batchFirst(self, starts, ends=None):
+        """Returns the index of the first interval overlapping each query in `starts' (and `ends', if
+specified), or -1. Uses numpy if available."""
+        if ends is None:
+            ends = starts
+        if np is None:
+            return [ self.firstIndex(s, e) for (s, e) in zip(starts, ends) ]
+        if not self.items:
+            return np.full(len(starts), -1, dtype=int)
+        if self.arrays is None:
+            self.arrays = (np.array(self.starts, dtype=np.int64), np.array(self.maxends, dtype=np.int64))
+        (istarts, maxends) = self.arrays
+        idx = np.searchsorted(maxends, starts, 'left')
+        good = idx < len(self.items)
+        good[good] = istarts[idx[good]] <= np.asarray(ends)[good]
+        return np.where(good, idx, -1)
+
 class BEDdict(object):
     bedfile = ""
     d = {}
+    indexes = {}                # IntervalIndex for each chromosome, built when first needed
     nregs = 0
 
     def __init__(self, bedfile):
         self.bedfile = bedfile
         self.d = {}
+        self.indexes = {}
         if bedfile:
             with open(bedfile, "r") as f:
                 c = csv.reader(f, delimiter='\t')
@@ -111,26 +228,53 @@ class BEDdict(object):
         else:
             return []
         
+    def chromIndex(self, chrom):
+        """Returns the IntervalIndex for the regions on `chrom', or None if there are none."""
+        if chrom not in self.d:
+            return None
+        if chrom not in self.indexes:
+            self.indexes[chrom] = IntervalIndex(self.d[chrom])
+        return self.indexes[chrom]
+
     def find(self, reg):
         """Returns the first region in this BEDdict overlapping `reg', or None if not found."""
-        if reg.chrom in self.d:
-            for r in self.d[reg.chrom]:
-                if r.start > reg.end:
-                    return None
-                elif reg.overlap(r):
-                    return r
+        idx = self.chromIndex(reg.chrom)
+        if idx:
+            return idx.first(reg.start, reg.end)
         return None
 
     def findPos(self, chrom, pos):
         """Returns the first region in this BEDdict containing position `pos' on chromosome `chrom', or None if not found."""
-        if chrom in self.d:
-            for r in self.d[chrom]:
-                if r.start > pos:
-                    return None
-                if r.start <= pos <= r.end:
-                    return r
+        idx = self.chromIndex(chrom)
+        if idx:
+            return idx.first(pos)
         return None
 
+    def findAll(self, reg):
+        """Returns all regions in this BEDdict overlapping `reg'."""
+        idx = self.chromIndex(reg.chrom)
+        if idx:
+            return idx.all(reg.start, reg.end)
+        return []
+
+    def findAllPos(self, chrom, pos):
+        """Returns all regions in this BEDdict containing position `pos' on chromosome `chrom'."""
+        idx = self.chromIndex(chrom)
+        if idx:
+            return idx.all(pos)
+        return []
+
+    def findPositions(self, chrom, positions):
+        """Returns, for each position in `positions' on chromosome `chrom', the list of regions containing it."""
+        idx = self.chromIndex(chrom)
+        if idx:
+            return idx.batch(positions)
+        return [ [] for p in positions ]
+
+    def findRegions(self, regs):
+        """Returns, for each region in `regs', the list of regions in this BEDdict overlapping it."""
+        return [ self.findAll(reg) for reg in regs ]
+
     def setPayloads(self, func):
         """Set all payloads to the value returned by function `func'."""
         for reglist in self.d.values():
@@ -7,12 +7,22 @@ import sys
 import csv
 import math
 import gzip
+import json
 import time
+import array
 import pysam
+import bisect
+import struct
 import string
 import random
+import sqlite3 as sql
 
-#from BEDutils import loadindex
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from BEDutils import BEDindexer, BEDNotIndexed
 
 PYTHON_VERSION = sys.version_info.major
 PY3 = (PYTHON_VERSION == 3)
@@ -888,6 +898,259 @@ class GenomicWindower():
         self.open(echrom, epos, entry)
         self.nextBlock(echrom, epos)
             
+def loadindex(filename, create=True):
+    """Returns the .bidx index (a dictionary mapping chromosome names to file offsets) of BED file `filename'.
+If `create' is True, the index is built first if it does not exist, or (re)built if it was not built
+from the current version of the file (different size or modification time)."""
+    BI = BEDindexer(filename)
+    try:
+        idx = BI.loadindex()
+        if not create or BI.isCurrent():
+            return idx
+    except BEDNotIndexed:
+        if not create:
+            raise
+    BI.bedindex()
+    return BI.loadindex()
+
+def indexedChroms(filename, header=False):
+    """Returns the list of chromosomes in BED file `filename' in the order in which they appear, using
+its .bidx index. If `header' is True, the first line of the file is a header and is not a chromosome."""
+    if isMethStore(filename):
+        return MethStore(filename).chromNames()
+    idx = loadindex(filename)
+    return [ c for c in sorted(idx.keys(), key=lambda k: idx[k]) if not (header and idx[c] == 0) ]
+
+### Offset index for mat files
+
+class MatIndex():
+    """Persistent index mapping the (chrom, pos) key of each line of a mat file to its offset in the
+file, stored as an sqlite database in a .midx file next to it. The index is built the first time it
+is needed, and rebuilt if the size or modification time of the mat file change."""
+    filename = ""
+    idxfile = ""
+    hdr = []                    # Header line of the mat file, split
+    nsites = 0
+    conn = None
+    batchsize = 100000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.idxfile = os.path.splitext(filename)[0] + ".midx"
+        if not self.isCurrent():
+            self.build()
+        self.conn = sql.connect(self.idxfile)
+        row = self.conn.execute("SELECT hdr, nsites FROM Source").fetchone()
+        self.hdr = row[0].split("\t")
+        self.nsites = row[1]
+
+    def fileStamp(self):
+        st = os.stat(self.filename)
+        return (st.st_size, int(st.st_mtime))
+
+    def isCurrent(self):
+        if not os.path.isfile(self.idxfile):
+            return False
+        conn = sql.connect(self.idxfile)
+        try:
+            row = conn.execute("SELECT size, mtime FROM Source").fetchone()
+        except sql.Error:
+            return False
+        finally:
+            conn.close()
+        return row is not None and tuple(row) == self.fileStamp()
+
+    def build(self):
+        (size, mtime) = self.fileStamp()
+        safeRemoveFile(self.idxfile)
+        sys.stderr.write("{} => {}\n".format(self.filename, self.idxfile))
+        conn = sql.connect(self.idxfile)
+        try:
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute("PRAGMA journal_mode = OFF;")
+            conn.execute("CREATE TABLE Sites (chrom varchar, pos int, offset int);")
+            conn.execute("CREATE TABLE Source (filename varchar, size int, mtime int, hdr text, nsites int);")
+            nsites = 0
+            batch = []
+            with open(self.filename, "r") as f:
+                hdr = f.readline().rstrip("\r\n")
+                while True:
+                    fp = f.tell()
+                    line = f.readline()
+                    if not line:
+                        break
+                    tp = line.find("\t")
+                    tp2 = line.find("\t", tp+1)
+                    if tp2 < 0:
+                        continue
+                    batch.append((line[:tp], int(line[tp+1:tp2]), fp))
+                    if len(batch) == self.batchsize:
+                        conn.executemany("INSERT INTO Sites VALUES (?, ?, ?);", batch)
+                        nsites += len(batch)
+                        batch = []
+            conn.executemany("INSERT INTO Sites VALUES (?, ?, ?);", batch)
+            nsites += len(batch)
+            conn.execute("CREATE INDEX Sites_key on Sites(chrom, pos);")
+            conn.execute("INSERT INTO Source VALUES (?, ?, ?, ?, ?);", (self.filename, size, mtime, hdr, nsites))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def lookup(self, chrom, pos):
+        """Returns the offset of the line for site `pos' in `chrom', or None. If the site appears more
+than once, the last occurrence is returned."""
+        return self.conn.execute("SELECT max(offset) FROM Sites WHERE chrom=? AND pos=?;", (chrom, pos)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+### Binary methylation store
+
+STORE_MAGIC = b"DMAPSTR1"
+
+def isMethStore(filename):
+    """Returns True if `filename' is a binary methylation store (see MethStore)."""
+    with open(filename, "rb") as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+class MethStore():
+    """Columnar binary store for methylation data, created by `dmaptools.py pack'. The file contains
+the magic string, the length of the header, a JSON header describing chromosomes and columns, and
+one block per column. Sites are grouped by chromosome (in their original order) and each column is
+exposed as a read-only numpy memmap, so that multiple processes can share the same pages.
+
+A store of kind `bed' has columns pos, cov, c, meth (from columns 2, 5, 6, 4 of an mcall BED file);
+a store of kind `mat' has columns pos and values (one row per site, NaN for missing values), and
+the original header in `hdr'."""
+    filename = ""
+    kind = ""
+    nsites = 0
+    chroms = []                 # List of (chrom, start, end) tuples, as indexes into the columns
+    hdr = None
+    columns = {}
+    _starts = []
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError("`{}' is not a methylation store.".format(filename))
+            (hlen,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(hlen).decode())
+        self.kind = str(header['kind'])
+        self.nsites = header['nsites']
+        self.chroms = [ (str(c), start, end) for (c, start, end) in header['chroms'] ]
+        self._starts = [ c[1] for c in self.chroms ]
+        if header['hdr']:
+            self.hdr = [ str(h) for h in header['hdr'] ]
+        self.columns = {}
+        for (name, dtype, offset, shape) in header['columns']:
+            if shape[0] == 0:
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+
+    def __getattr__(self, name):
+        if name in self.columns:
+            return self.columns[name]
+        raise AttributeError(name)
+
+    def chromNames(self):
+        return [ c[0] for c in self.chroms ]
+
+    def chromRange(self, chrom):
+        """Returns the (start, end) indexes of the sites on `chrom', or None if not present."""
+        for c in self.chroms:
+            if c[0] == chrom:
+                return (c[1], c[2])
+        return None
+
+    def chromAt(self, idx):
+        """Returns the (chrom, start, end) tuple for the chromosome containing site number `idx'."""
+        return self.chroms[bisect.bisect_right(self._starts, idx) - 1]
+
+def writeMethStore(filename, kind, chroms, columns, hdr=None):
+    """Write a MethStore to `filename'. `chroms' is a list of (chrom, start, end) tuples, `columns'
+a list of (name, numpy array) tuples."""
+    nsites = len(columns[0][1])
+    coldesc = []
+    offset = 0
+    for (name, data) in columns:
+        coldesc.append([name, data.dtype.str, offset, list(data.shape)])
+        offset += data.nbytes + (-data.nbytes % 8)
+    header = {'kind': kind, 'nsites': nsites, 'chroms': chroms, 'hdr': hdr, 'columns': coldesc}
+    # Column offsets depend on the size of the header, which depends on the offsets...
+    base = 0
+    while True:
+        htext = json.dumps(header)
+        newbase = len(STORE_MAGIC) + 8 + len(htext)
+        newbase += -newbase % 8
+        if newbase <= base:
+            break
+        for cd in coldesc:
+            cd[2] += newbase - base
+        base = newbase
+    hlen = base - len(STORE_MAGIC) - 8
+    htext = htext.ljust(hlen).encode()
+    with open(filename, "wb") as out:
+        out.write(STORE_MAGIC)
+        out.write(struct.pack("<Q", hlen))
+        out.write(htext)
+        for (name, data) in columns:
+            data.tofile(out)
+            out.write(b"\0" * (-data.nbytes % 8))
+
+def _frombuffer(a, dtype):
+    if len(a) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(a, dtype=dtype)
+
+def packMethFile(infile, outfile, kind="bed"):
+    """Convert the mcall/cscall BED file (kind = `bed') or -mat file (kind = `mat') `infile' to a
+MethStore in `outfile'. Returns the number of sites stored."""
+    chroms = []
+    chrom = None
+    pos = array.array('i')
+    hdr = None
+    with open(infile, "r") as f:
+        if kind == "mat":
+            hdr = readDelim(f)
+            nreps = len(hdr) - 4
+            values = array.array('d')
+            nan = float('nan')
+            for line in f:
+                data = line.rstrip("\r\n").split("\t")
+                if data[0] != chrom:
+                    chrom = data[0]
+                    chroms.append([chrom, len(pos), len(pos)])
+                pos.append(int(data[1]))
+                values.extend([ nan if v == "NA" else float(v) for v in data[4:4+nreps] ])
+            columns = [('pos', _frombuffer(pos, dtype=np.int32)),
+                       ('values', _frombuffer(values, dtype=np.float64).reshape((len(pos), nreps)))]
+        else:
+            cov = array.array('i')
+            nc = array.array('i')
+            meth = array.array('d')
+            for line in f:
+                if line[0] == '#':
+                    continue
+                data = line.rstrip("\r\n").split("\t")
+                if data[0] != chrom:
+                    chrom = data[0]
+                    chroms.append([chrom, len(pos), len(pos)])
+                pos.append(int(data[1]))
+                cov.append(int(float(data[4])))
+                nc.append(int(float(data[5])))
+                meth.append(float(data[3]))
+            columns = [('pos', _frombuffer(pos, dtype=np.int32)),
+                       ('cov', _frombuffer(cov, dtype=np.int32)),
+                       ('c', _frombuffer(nc, dtype=np.int32)),
+                       ('meth', _frombuffer(meth, dtype=np.float64))]
+    for i in range(len(chroms)):
+        chroms[i][2] = chroms[i+1][1] if i+1 < len(chroms) else len(pos)
+    writeMethStore(outfile, kind, chroms, columns, hdr=hdr)
+    return len(pos)
+
 ## ToDo: make this class more general
 class BEDreader():
     filename = None
@@ -895,9 +1158,17 @@ class BEDreader():
     current  = None
     chrom    = ""
     pos      = 0
+    store    = None             # MethStore, if reading from a binary store
+    sidx     = -1               # Index of current site in store
+    chromEnd = 0                # Index of first site after current chrom in store
 
     def __init__(self, filename, skipHdr=True, jump=False):
         self.filename = filename
+        if isMethStore(filename):
+            self.openStore(jump)
+            if jump or skipHdr:
+                self.readNext()
+            return
         self.stream = open(self.filename, "r")
         if jump:
             idx = loadindex(filename)
@@ -911,18 +1182,49 @@ class BEDreader():
         elif skipHdr:
             self.readNext()
 
+    def openStore(self, jump=False):
+        """Read from a MethStore instead of a text file. The store takes the place of `stream'."""
+        self.store = self.stream = MethStore(self.filename)
+        self.sidx = -1
+        self.chromEnd = 0
+        if jump:
+            rng = self.store.chromRange(jump)
+            if rng:
+                self.sidx = rng[0] - 1
+            else:
+                sys.stderr.write("Warning: `{}' not found in store.\n".format(jump))
+                self.sidx = self.store.nsites
+
     def close(self):
-        self.stream.close()
+        if not self.store:
+            self.stream.close()
 
     def storeCurrent(self, data):
         #self.current = [int(data[4]), int(data[5]), data[1]]
         self.current = [float(data[4]), float(data[5]), data[1]]
+
+    def storeCurrentSite(self, i):
+        """Like storeCurrent(), for site number `i' of the store."""
+        self.current = [float(self.store.cov[i]), float(self.store.c[i]), str(self.pos)]
+
+    def readNextSite(self):
+        self.sidx += 1
+        if self.sidx >= self.store.nsites:
+            self.stream = None
+            return None
+        if self.sidx >= self.chromEnd:
+            (self.chrom, start, self.chromEnd) = self.store.chromAt(self.sidx)
+        self.pos = int(self.store.pos[self.sidx])
+        self.storeCurrentSite(self.sidx)
+        return True
         
     def readNext(self):
         """Read one line from stream and store it in the `current' attribute. Also sets `chrom' 
 and `pos' to its first and second elements."""
         if self.stream == None:
             return None
+        if self.store:
+            return self.readNextSite()
         data = readDelim(self.stream)
         if data == None:
             # print("File {} finished.".format(self.filename))
@@ -980,11 +1282,101 @@ and `pos' to its first and second elements."""
             result.append(self.current)
         return result
 
+    def readChromosomeArrays(self):
+        """Like readChromosome(), but returns the sites of the current chromosome as a tuple of
+numpy arrays (positions, coverage, C counts). Requires numpy. When reading from a store, the arrays
+are memmap slices and no data is copied."""
+        if self.stream is None:
+            return None
+        if self.store:
+            (i, j) = self.storeSkipChrom()
+            return (self.store.pos[i:j], self.store.cov[i:j], self.store.c[i:j])
+        pos = []
+        cov = []
+        nc  = []
+        thisChrom = self.chrom
+        while self.chrom == thisChrom:
+            pos.append(self.pos)
+            cov.append(self.current[0])
+            nc.append(self.current[1])
+            if not self.readNext():
+                break
+        return (np.array(pos, dtype=np.int64), np.array(cov, dtype=float), np.array(nc, dtype=float))
+
+    def storeSkipChrom(self):
+        """Move to the first site of the next chromosome in the store, returning the (start, end)
+indexes of the remaining sites of the current one."""
+        (i, j) = (self.sidx, self.chromEnd)
+        self.sidx = j - 1
+        self.readNext()
+        return (i, j)
+
 class METHreader(BEDreader):
     
     def storeCurrent(self, data):
         self.current = [data[0], int(data[1]), float(data[3])]
 
+    def storeCurrentSite(self, i):
+        self.current = [self.chrom, self.pos, float(self.store.meth[i])]
+
+    def readChromosomeArrays(self):
+        """Returns the sites of the current chromosome as a tuple of numpy arrays (positions,
+methylation values)."""
+        if self.stream is None:
+            return None
+        if self.store:
+            (i, j) = self.storeSkipChrom()
+            return (self.store.pos[i:j], self.store.meth[i:j])
+        pos = []
+        meth = []
+        thisChrom = self.chrom
+        while self.chrom == thisChrom:
+            pos.append(self.pos)
+            meth.append(self.current[2])
+            if not self.readNext():
+                break
+        return (np.array(pos, dtype=np.int64), np.array(meth, dtype=float))
+
+class COLreader(BEDreader):
+    """Reads the positions and the values in one column of a BED file whose first line is a header. Stores
+of kind `bed' (see MethStore) can be read too, for the columns they contain (4, 5 and 6, counting from 1)."""
+    column = 4                  # Column containing the values (0-based)
+    storeColumns = {3: 'meth', 4: 'cov', 5: 'c'}
+
+    def __init__(self, filename, column=4, jump=False):
+        self.column = column
+        BEDreader.__init__(self, filename, skipHdr=False, jump=jump)
+        if self.store and (self.store.kind != "bed" or column not in self.storeColumns):
+            raise ValueError("Store `{}' does not contain column {}.".format(filename, column + 1))
+        if not jump:
+            if not self.store:
+                self.stream.readline()
+            self.readNext()
+
+    def storeCurrent(self, data):
+        v = data[self.column]
+        self.current = [float('nan') if v == "NA" else float(v)]
+
+    def storeCurrentSite(self, i):
+        self.current = [float(self.store.columns[self.storeColumns[self.column]][i])]
+
+    def readChromosomeArrays(self):
+        """Returns the sites of the current chromosome as a tuple of numpy arrays (positions, values)."""
+        if self.stream is None:
+            return None
+        if self.store:
+            (i, j) = self.storeSkipChrom()
+            return (self.store.pos[i:j], self.store.columns[self.storeColumns[self.column]][i:j])
+        pos = []
+        vals = []
+        thisChrom = self.chrom
+        while self.chrom == thisChrom:
+            pos.append(self.pos)
+            vals.append(self.current[0])
+            if not self.readNext():
+                break
+        return (np.array(pos, dtype=np.int64), np.array(vals, dtype=float))
+
 class DualBEDreader():
     bed1 = None
     bed2 = None
@@ -993,9 +1385,9 @@ class DualBEDreader():
     current1 = None
     current2 = None
 
-    def __init__(self, filename1, filename2):
-        self.bed1 = BEDreader(filename1)
-        self.bed2 = BEDreader(filename2)
+    def __init__(self, filename1, filename2, jump=False):
+        self.bed1 = BEDreader(filename1, jump=jump)
+        self.bed2 = BEDreader(filename2, jump=jump)
         if self.bed1.chrom != self.bed2.chrom:
             sys.stderr.write("Error: BED files start on different chromosomes ({}, {}).\n".format(self.bed1.chrom, self.bed2.chrom))
         else:
@@ -1035,16 +1427,154 @@ class MATreader(BEDreader):
     hdr = None
     nreps = 0
 
-    def __init__(self, filename):
+    def __init__(self, filename, jump=False):
         self.filename = filename
+        if isMethStore(filename):
+            self.openStore(jump)
+            self.hdr = self.store.hdr
+            self.nreps = len(self.hdr)-4
+            self.readNext()
+            return
         self.stream = open(self.filename, "r")
         self.hdr = readDelim(self.stream)
         self.nreps = len(self.hdr)-4
+        if jump:
+            idx = loadindex(filename)
+            if jump in idx:
+                self.stream.seek(idx[jump])
+            else:
+                sys.stderr.write("Warning: `{}' not found in BED index.\n".format(jump))
         self.readNext()
 
     def storeCurrent(self, data):
         self.current = data[4:]
+
+    def storeCurrentSite(self, i):
+        self.current = [ 'NA' if math.isnan(v) else v for v in self.store.values[i].tolist() ]
+
+    def readChromosomeArrays(self):
+        """Returns the sites of the current chromosome as a tuple (positions, values), where values
+is a (sites x replicates) array with NaN for missing values."""
+        if self.stream is None:
+            return None
+        if self.store:
+            (i, j) = self.storeSkipChrom()
+            return (self.store.pos[i:j], self.store.values[i:j])
+        pos = []
+        values = []
+        nan = float('nan')
+        thisChrom = self.chrom
+        while self.chrom == thisChrom:
+            pos.append(self.pos)
+            values.append([ nan if v == 'NA' else float(v) for v in self.current ])
+            if not self.readNext():
+                break
+        return (np.array(pos, dtype=np.int64), np.array(values, dtype=float).reshape((len(pos), self.nreps)))
         
+class MATchunks():
+    """Read a -mat file (or a mat store) in chunks of `chunksize' rows. Iterating over this object
+returns (chroms, positions, values) tuples of numpy arrays, where values is a (rows x columns) array
+of the columns starting at `first' (by default, the replicate columns), with NaN for NA. If `masked'
+is True, values is a masked array with NA values masked instead. If `chrom' is specified, only rows
+on that chromosome are returned (using the .bidx index of the file). Only one chunk is held in memory
+at a time."""
+    filename = ""
+    chunksize = 100000
+    first = 4
+    chrom = None
+    masked = False
+    hdr = None
+    ncols = 0
+    store = None
+
+    def __init__(self, filename, chunksize=100000, first=4, chrom=None, masked=False):
+        self.filename = filename
+        self.chunksize = chunksize
+        self.first = first
+        self.chrom = chrom
+        self.masked = masked
+        if isMethStore(filename):
+            self.store = MethStore(filename)
+            if first != 4:
+                raise ValueError("Store `{}' only contains replicate columns.".format(filename))
+            self.hdr = self.store.hdr
+        else:
+            with open(filename, "r") as f:
+                self.hdr = readDelim(f)
+        self.ncols = len(self.hdr) - first
+
+    def __iter__(self):
+        if self.store:
+            chunks = self.storeChunks()
+        else:
+            chunks = self.textChunks()
+        if self.masked:
+            return ( (c, p, np.ma.masked_invalid(v)) for (c, p, v) in chunks )
+        return chunks
+
+    def storeChunks(self):
+        st = self.store
+        (first, last) = (0, st.nsites)
+        if self.chrom:
+            (first, last) = st.chromRange(self.chrom) or (0, 0)
+        for i in range(first, last, self.chunksize):
+            j = min(i + self.chunksize, last)
+            names = []
+            counts = []
+            k = i
+            while k < j:
+                (chrom, cs, ce) = st.chromAt(k)
+                names.append(chrom)
+                counts.append(min(ce, j) - k)
+                k = min(ce, j)
+            yield (np.repeat(np.array(names), counts), st.pos[i:j], st.values[i:j])
+
+    def makeChunk(self, chroms, pos, values):
+        """Convert the lists of chromosome names, position strings and value strings (the tab-delimited
+value columns of each row) to arrays. The numbers are parsed by numpy in a single call per column
+group, NA values becoming nan."""
+        positions = np.fromstring(" ".join(pos), dtype=np.int64, sep=" ")
+        data = np.fromstring(" ".join(values).replace("NA", "nan"), dtype=float, sep=" ")
+        if len(positions) != len(pos) or len(data) != len(pos) * self.ncols:
+            raise ValueError("Bad number in file `{}'.".format(self.filename))
+        return (np.array(chroms), positions, data.reshape(len(pos), self.ncols))
+
+    def textChunks(self):
+        chroms = []
+        pos = []
+        values = []
+        first = self.first
+        ntabs = self.ncols - 1
+        with open(self.filename, "r") as f:
+            f.readline()
+            if self.chrom:
+                idx = loadindex(self.filename)
+                if self.chrom not in idx:
+                    return
+                f.seek(idx[self.chrom])
+            for line in f:
+                row = line.rstrip("\r\n").split("\t", first)
+                if len(row) <= first:
+                    continue
+                if self.chrom and row[0] != self.chrom:
+                    break
+                vals = row[first]
+                n = vals.count("\t")
+                if n != ntabs:
+                    if n < ntabs:
+                        continue
+                    vals = "\t".join(vals.split("\t")[:self.ncols])
+                chroms.append(row[0])
+                pos.append(row[1])
+                values.append(vals)
+                if len(pos) == self.chunksize:
+                    yield self.makeChunk(chroms, pos, values)
+                    chroms = []
+                    pos = []
+                    values = []
+        if pos:
+            yield self.makeChunk(chroms, pos, values)
+
 class REGreader(BEDreader):
 
     def storeCurrent(self, data):
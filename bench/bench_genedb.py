@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+### Benchmark for loading a genes database (DBloader with preload, GenelistDB.getAllTranscripts).
+### Builds a synthetic database with the schema created by GeneList.initializeDB, then compares
+### the old loaders, which issue one transcript query per gene and one exon query per transcript,
+### with the current ones, which read each table once (the preload) or once per chromosome
+### (getAllTranscripts) and merge the rows.
+###
+### Usage: bench_genedb.py [ngenes]
+
+import os
+import sys
+import time
+import random
+import tempfile
+import sqlite3 as sql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeneList
+
+def makeDB(filename, ngenes, nchroms=20, seed=1):
+    """Write `ngenes' genes with 1-4 transcripts of 1-10 exons each to a new database in `filename'."""
+    r = random.Random(seed)
+    genes = []
+    transcripts = []
+    exons = []
+    for i in range(ngenes):
+        chrom = "chr{}".format(r.randint(1, nchroms))
+        strand = r.choice([1, -1])
+        start = r.randint(1, 100000000)
+        gid = "G{}".format(i)
+        gend = start
+        for t in range(r.randint(1, 4)):
+            tid = "{}.{}".format(gid, t)
+            p = start + r.randint(0, 1000)
+            txstart = p
+            for e in range(r.randint(1, 10)):
+                end = p + r.randint(50, 500)
+                exons.append((tid, e, chrom, p, end))
+                p = end + r.randint(100, 5000)
+            transcripts.append((tid, gid, "T" + tid, chrom, strand, txstart, end, txstart, end))
+            gend = max(gend, end)
+        genes.append((gid, "N{}".format(i), "protein_coding", chrom, strand, start, gend))
+    GeneList.initializeDB(filename)
+    conn = sql.connect(filename)
+    with conn:
+        conn.executemany("INSERT INTO Genes (ID, name, biotype, chrom, strand, start, end) VALUES (?, ?, ?, ?, ?, ?, ?);", genes)
+        conn.executemany("INSERT INTO Transcripts (ID, parentID, name, chrom, strand, txstart, txend, cdsstart, cdsend) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", transcripts)
+        conn.executemany("INSERT INTO Exons (ID, idx, chrom, start, end) VALUES (?, ?, ?, ?, ?);", exons)
+        conn.execute("INSERT INTO Counts (ngenes, ntranscripts, nexons) VALUES (?, ?, ?);", (len(genes), len(transcripts), len(exons)))
+    conn.close()
+    return (len(genes), len(transcripts), len(exons))
+
+def oldPreload(filename):
+    """The per-row preload previously used by DBloader. Returns the number of exons read."""
+    nexons = 0
+    gl = GeneList.GenelistDB()
+    conn = sql.connect(filename)
+    gcur = conn.cursor()
+    tcur = conn.cursor()
+    ecur = conn.cursor()
+    for row in gcur.execute("SELECT ID, name, geneid, ensg, biotype, chrom, strand, start, end, description FROM Genes"):
+        g = GeneList.Gene(row[0], row[5], row[6])
+        for pair in zip(['ID', 'name', 'geneid', 'ensg', 'biotype', 'chrom', 'strand', 'start', 'end', 'description'], row):
+            setattr(g, pair[0], pair[1])
+        gl.add(g, g.chrom)
+        for trow in tcur.execute("SELECT ID, name, accession, enst, chrom, strand, txstart, txend, cdsstart, cdsend, canonical FROM Transcripts WHERE parentID=?", (row[0],)):
+            tr = GeneList.Transcript(trow[0], trow[4], trow[5], trow[6], trow[7])
+            for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
+                setattr(tr, pair[0], pair[1])
+            tr.canonical = (trow[10] == 'Y')
+            tr.exons = []
+            for erow in ecur.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (trow[0],)):
+                tr.addExon(erow[0], erow[1])
+                nexons += 1
+            g.addTranscript(tr)
+    conn.close()
+    return nexons
+
+def oldAllTranscripts(filename):
+    """The per-row getAllTranscripts previously used by GenelistDB. Returns the number of exons read."""
+    nexons = 0
+    conn = sql.connect(filename)
+    ecur = conn.cursor()
+    for trow in conn.execute("SELECT t.ID, t.name, accession, enst, t.chrom, t.strand, txstart, txend, cdsstart, cdsend, g.name FROM Transcripts t, Genes g WHERE t.parentID = g.ID ORDER BY t.chrom, txstart"):
+        tr = GeneList.Transcript(trow[0], trow[4], trow[5], trow[6], trow[7])
+        tr.gene = trow[10]
+        tr.exons = []
+        for pair in zip(['ID', 'name', 'accession', 'enst', 'chrom', 'strand', 'txstart', 'txend', 'cdsstart', 'cdsend'], trow):
+            setattr(tr, pair[0], pair[1])
+        for erow in ecur.execute("SELECT start, end FROM Exons WHERE ID=? ORDER BY idx", (trow[0],)):
+            tr.addExon(erow[0], erow[1])
+            nexons += 1
+    conn.close()
+    return nexons
+
+def newPreload(filename):
+    loader = GeneList.DBloader(filename)
+    loader._load(preload=True)
+    gl = loader.gl
+    return sum([ len(tr.exons) for genes in gl.genes.values() for g in genes for tr in g.transcripts ])
+
+def newAllTranscripts(filename):
+    gl = GeneList.DBloader(filename).load(preload=False)
+    return sum([ len(tr.exons) for tr in gl.getAllTranscripts() ])
+
+def timeit(func, filename):
+    t0 = time.time()
+    n = func(filename)
+    return (time.time() - t0, n)
+
+def main(args):
+    ngenes = int(args[0]) if len(args) > 0 else 60000
+
+    tmpdir = tempfile.mkdtemp()
+    dbfile = os.path.join(tmpdir, "genes.db")
+    t0 = time.time()
+    (ng, nt, ne) = makeDB(dbfile, ngenes)
+    sys.stdout.write("{} genes, {} transcripts, {} exons (database built in {:.2f}s).\n\n".format(ng, nt, ne, time.time() - t0))
+
+    sys.stdout.write("Operation\tOld (s)\tNew (s)\tSpeedup\tSame exons\n")
+    for (name, old, new) in [("preload", oldPreload, newPreload), ("alltranscripts", oldAllTranscripts, newAllTranscripts)]:
+        (t1, n1) = timeit(old, dbfile)
+        (t2, n2) = timeit(new, dbfile)
+        sys.stdout.write("{}\t{:.2f}\t{:.2f}\t{:.1f}x\t{}\n".format(name, t1, t2, t1/t2, "Y" if n1 == n2 else "N"))
+
+    os.remove(dbfile)
+    os.rmdir(tmpdir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
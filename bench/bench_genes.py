@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+### Benchmark for Genelist.allIntersecting on random queries.
+### Compares the interval index built by Genelist.buildIndexes with the old index, which
+### grouped genes into blocks of 100 and scanned the blocks linearly, only looking at one
+### block on each side of the one containing the query start. Genes have realistic lengths
+### (mostly 1-100kb, with a few very long ones), so the old index also misses some hits.
+###
+### Usage: bench_genes.py [ngenes] [nqueries] [querysize]
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeneList
+
+class BlockGenelist(GeneList.Genelist):
+    """Genelist using the old block index."""
+
+    def buildIndexes(self):
+        step = 100
+        idxs = {}
+        for chrom, genes in self.genes.items():
+            ng = len(genes)
+            d = []
+            for i in range(0, len(genes), step):
+                i2 = min(i+step, ng) - 1
+                d.append([genes[i].start, genes[i2].end, i, i2])
+            idxs[chrom] = d
+        self.indexes = idxs
+
+    def positionsToRange(self, chrom, start, end):
+        first = last = 0
+        if chrom in self.indexes:
+            idxs = self.indexes[chrom]
+            for i in range(0, len(idxs)):
+                iblock = idxs[i]
+                if iblock[0] <= start <= iblock[1]:
+                    sb = iblock
+                    eb = iblock
+                    if i > 0:
+                        sb = idxs[i-1]
+                    if i < len(idxs) - 1:
+                        eb = idxs[i+1]
+                    first = sb[2]
+                    last  = eb[3]
+                    break
+        return (first, last)
+
+    def allIntersecting(self, chrom, start, end):
+        result = []
+        genes = self.selectChrom(chrom)
+        (first, last) = self.positionsToRange(chrom, start, end)
+        for i in range(first, last+1):
+            if self.classifyIntersection(start, end, genes[i]):
+                result.append(genes[i])
+        return result
+
+def makeGenes(gl, ngenes, nchroms, chromsize, seed=1):
+    r = random.Random(seed)
+    for i in range(ngenes):
+        chrom = "chr{}".format(r.randint(1, nchroms))
+        g = GeneList.Gene("G{}".format(i), chrom, r.choice([1, -1]))
+        size = r.randint(100000, 2000000) if r.random() < 0.01 else r.randint(1000, 100000)
+        g.start = r.randint(1, chromsize - size)
+        g.end = g.start + size
+        gl.add(g, chrom)
+    gl.sortGenes()
+    gl.buildIndexes()
+    return gl
+
+def makeQueries(nqueries, nchroms, chromsize, querysize, seed=2):
+    r = random.Random(seed)
+    queries = []
+    for i in range(nqueries):
+        start = r.randint(1, chromsize)
+        queries.append(("chr{}".format(r.randint(1, nchroms)), start, start + querysize))
+    return queries
+
+def timeit(gl, queries):
+    t0 = time.time()
+    hits = [ [ g.ID for g in gl.allIntersecting(*q) ] for q in queries ]
+    return (time.time() - t0, hits)
+
+def main(args):
+    ngenes    = int(args[0]) if len(args) > 0 else 60000
+    nqueries  = int(args[1]) if len(args) > 1 else 20000
+    querysize = int(args[2]) if len(args) > 2 else 1000
+    nchroms   = 20
+    chromsize = 100000000
+
+    sys.stdout.write("{} genes on {} chromosomes, {} queries of {} bp.\n\n".format(ngenes, nchroms, nqueries, querysize))
+    queries = makeQueries(nqueries, nchroms, chromsize, querysize)
+    sys.stdout.write("Index\tBuild (s)\tQueries (s)\tQueries/s\tHits\n")
+    for (name, gl) in [("blocks", BlockGenelist()), ("interval", GeneList.Genelist())]:
+        t0 = time.time()
+        makeGenes(gl, ngenes, nchroms, chromsize)
+        tb = time.time() - t0
+        (tq, hits) = timeit(gl, queries)
+        sys.stdout.write("{}\t{:.2f}\t{:.2f}\t{:.0f}\t{}\n".format(name, tb, tq, nqueries / tq, sum([ len(h) for h in hits ])))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
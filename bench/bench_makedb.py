@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+### Benchmark for writing a genes database (Genelist.saveAllToDB, as used by `genes.py makedb').
+### Builds a synthetic Genelist, then compares the old way of saving it, which created the
+### indexes first and inserted one row at a time, with the bulk build, which inserts rows with
+### executemany and creates the indexes after loading. The old way also chose canonical
+### transcripts with one query per gene after loading, while the bulk build marks them in
+### memory before inserting. Also checks that the two databases have the same contents.
+###
+### Usage: bench_makedb.py [ngenes]
+
+import os
+import sys
+import time
+import random
+import hashlib
+import tempfile
+import sqlite3 as sql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeneList
+
+def makeGenes(ngenes, nchroms=20, seed=1):
+    """Returns a Genelist containing `ngenes' genes with 1-4 transcripts of 1-10 exons each."""
+    r = random.Random(seed)
+    gl = GeneList.Genelist()
+    gl.source = "synthetic"
+    for i in range(ngenes):
+        chrom = "chr{}".format(r.randint(1, nchroms))
+        g = GeneList.Gene("G{}".format(i), chrom, r.choice([1, -1]))
+        g.name = "N{}".format(i)
+        g.biotype = "protein_coding"
+        start = r.randint(1, 100000000)
+        for t in range(r.randint(1, 4)):
+            p = start + r.randint(0, 1000)
+            tr = GeneList.Transcript("{}.{}".format(g.ID, t), chrom, g.strand, p, p)
+            tr.exons = []
+            for e in range(r.randint(1, 10)):
+                end = p + r.randint(50, 500)
+                tr.addExon(p, end)
+                p = end + r.randint(100, 5000)
+            tr.txend = tr.cdsend = end
+            tr.cdsstart = tr.txstart
+            g.addTranscript(tr)
+        gl.add(g, chrom)
+    return gl
+
+def oldSetCanonical(conn):
+    """The per-gene setCanonical previously used by saveAllToDB."""
+    c = conn.cursor()
+    for r in conn.execute("SELECT ID FROM Genes;"):
+        gid = r[0]
+        maxtr = 0
+        best  = ""
+        for tr in c.execute("SELECT ID, txstart, txend FROM Transcripts WHERE parentID=?;", (gid,)):
+            m = int(tr[2]) - int(tr[1])
+            if m > maxtr:
+                maxtr = m
+                best = tr[0]
+        c.execute("UPDATE Genes SET canonical=? WHERE ID=?;", (best, gid))
+        c.execute("UPDATE Transcripts SET canonical='Y' WHERE ID=?;", (best,))
+
+def oldSave(gl, filename):
+    """The per-row saveAllToDB previously used by `genes.py makedb'."""
+    GeneList.initializeDB(filename)
+    conn = sql.connect(filename)
+    with conn:
+        for chrom in gl.chroms:
+            for g in gl.genes[chrom]:
+                g.saveToDB(conn)
+        gl.setTSS(conn)
+        oldSetCanonical(conn)
+        gl.setCounts(conn)
+        conn.execute("INSERT INTO Source (filename) values (?);", (gl.source,))
+    conn.close()
+
+def newSave(gl, filename):
+    GeneList.initializeDB(filename, indexes=False)
+    gl.saveAllToDB(filename)
+
+def checksum(filename):
+    """Returns a digest of the contents of the Genes, Transcripts, Exons and Counts tables."""
+    h = hashlib.md5()
+    conn = sql.connect(filename)
+    for table in ["Genes", "Transcripts", "Exons", "Counts"]:
+        for row in conn.execute("SELECT * FROM {} ORDER BY rowid;".format(table)):
+            h.update(repr(tuple(row)))
+    conn.close()
+    return h.hexdigest()
+
+def main(args):
+    ngenes = int(args[0]) if len(args) > 0 else 60000
+
+    t0 = time.time()
+    gl = makeGenes(ngenes)
+    sys.stdout.write("{} genes (built in {:.2f}s).\n\n".format(ngenes, time.time() - t0))
+
+    tmpdir = tempfile.mkdtemp()
+    stderr = sys.stderr
+    sys.stdout.write("Method\tTime (s)\tSize (MB)\n")
+    sums = []
+    for (name, func) in [("old", oldSave), ("bulk", newSave)]:
+        dbfile = os.path.join(tmpdir, name + ".db")
+        sys.stderr = open(os.devnull, "w")
+        try:
+            t0 = time.time()
+            func(gl, dbfile)
+            t = time.time() - t0
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        sys.stdout.write("{}\t{:.2f}\t{:.1f}\n".format(name, t, os.path.getsize(dbfile) / 1048576.0))
+        sums.append(checksum(dbfile))
+        os.remove(dbfile)
+    os.rmdir(tmpdir)
+    sys.stdout.write("\nSame contents: {}\n".format("Y" if sums[0] == sums[1] else "N"))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+### Benchmark for region queries on a genes database with and without the R*Tree indexes
+### (GeneList.initializeDB with rtree=True, `genes.py makedb -rt').
+### Builds the same synthetic gene list into two databases, then times GenelistDB.allIntersecting
+### and GenelistDB.findClosestGene (on transcripts) on random intervals, and checks that the two
+### databases give the same answers (including which gene is chosen among ties).
+###
+### Usage: bench_rtree.py [nqueries] [ngenes] [querysize]
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeneList
+from bench_makedb import makeGenes
+
+def makeQueries(nqueries, nchroms, chromsize, querysize, seed=2):
+    r = random.Random(seed)
+    queries = []
+    for i in range(nqueries):
+        start = r.randint(1, chromsize)
+        queries.append(("chr{}".format(r.randint(1, nchroms)), start, start + querysize))
+    return queries
+
+def buildDB(gl, filename, rtree):
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+    try:
+        GeneList.initializeDB(filename, indexes=False, rtree=rtree)
+        gl.saveAllToDB(filename)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+def runQueries(filename, queries):
+    """Returns the time taken by allIntersecting and findClosestGene on all `queries', and their results."""
+    gl = GeneList.GenelistDB()
+    gl.dbname = filename
+    with gl:
+        t0 = time.time()
+        hits = [ sorted([ g.ID for g in gl.allIntersecting(*q) ]) for q in queries ]
+        t1 = time.time()
+        closest = [ gl.findClosestGene(*q) for q in queries ]
+        t2 = time.time()
+    return (t1 - t0, t2 - t1, hits, closest)
+
+def main(args):
+    nqueries  = int(args[0]) if len(args) > 0 else 1000000
+    ngenes    = int(args[1]) if len(args) > 1 else 60000
+    querysize = int(args[2]) if len(args) > 2 else 1000
+    nchroms   = 20
+    chromsize = 100000000
+
+    gl = makeGenes(ngenes, nchroms=nchroms)
+    queries = makeQueries(nqueries, nchroms, chromsize, querysize)
+    sys.stdout.write("{} genes on {} chromosomes, {} queries of {} bp.\n\n".format(ngenes, nchroms, nqueries, querysize))
+
+    tmpdir = tempfile.mkdtemp()
+    sys.stdout.write("Schema\tBuild (s)\tOverlap (s)\tOverlap (us/query)\tClosest (s)\tClosest (us/query)\tHits\n")
+    results = []
+    for (name, rtree) in [("btree", False), ("rtree", True)]:
+        dbfile = os.path.join(tmpdir, name + ".db")
+        t0 = time.time()
+        buildDB(gl, dbfile, rtree)
+        tb = time.time() - t0
+        (to, tc, hits, closest) = runQueries(dbfile, queries)
+        sys.stdout.write("{}\t{:.2f}\t{:.2f}\t{:.0f}\t{:.2f}\t{:.0f}\t{}\n".format(name, tb, to, 1e6 * to / nqueries, tc, 1e6 * tc / nqueries, sum([ len(h) for h in hits ])))
+        results.append((hits, closest))
+        os.remove(dbfile)
+    os.rmdir(tmpdir)
+    sys.stdout.write("\nSame overlaps: {}\nSame closest genes: {}\n".format("Y" if results[0][0] == results[1][0] else "N",
+                                                                             "Y" if results[0][1] == results[1][1] else "N"))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+### Benchmark for window-based dmaptools commands (winavg, winmat, dmr) on sparse data.
+### Generates synthetic RRBS-like data (small clusters of sites separated by large gaps).
+### The dmr window loop is timed with and without skipping of empty windows; winavg and
+### winmat only ever visit non-empty windows, and are timed once.
+###
+### Usage: bench_windows.py [nchroms] [chromsize] [winsize]
+
+import os
+import sys
+import time
+import random
+import tempfile
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmaptools
+
+def makeSites(nchroms, chromsize, seed=1):
+    """Returns a list of (chrom, pos) tuples, in clusters of 5-30 sites every 20-80kb."""
+    r = random.Random(seed)
+    sites = []
+    for c in range(nchroms):
+        chrom = "chr{}".format(c+1)
+        p = 0
+        while True:
+            p += r.randint(20000, 80000)
+            if p >= chromsize:
+                break
+            q = p
+            for i in range(r.randint(5, 30)):
+                q += r.randint(2, 40)
+                sites.append((chrom, q))
+            p = q
+    return sites
+
+def writeBED(filename, sites, seed):
+    r = random.Random(seed)
+    with open(filename, "w") as out:
+        for (chrom, pos) in sites:
+            cov = r.randint(1, 40)
+            c = r.randint(0, cov)
+            out.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(chrom, pos, pos+1, 100.0*c/cov, cov, c))
+
+def writeMAT(filename, sites, seed, nreps=4):
+    r = random.Random(seed)
+    with open(filename, "w") as out:
+        out.write("Chrom\tPos\tAvg\tStdev\t" + "\t".join([ "R{}".format(i+1) for i in range(nreps) ]) + "\n")
+        for (chrom, pos) in sites:
+            vals = [ "NA" if r.random() < 0.1 else str(round(r.random(), 3)) for i in range(nreps) ]
+            out.write("{}\t{}\t0.5\t0.1\t{}\n".format(chrom, pos, "\t".join(vals)))
+
+def timeit(cmd, method, skip=True):
+    cmd.skipEmpty = skip
+    out = StringIO()
+    olderr = sys.stderr
+    sys.stderr = dmaptools.NullStream()
+    try:
+        t0 = time.time()
+        method(out)
+        t1 = time.time()
+    finally:
+        sys.stderr = olderr
+    return (t1 - t0, out.getvalue())
+
+def main(args):
+    nchroms   = int(args[0]) if len(args) > 0 else 3
+    chromsize = int(args[1]) if len(args) > 1 else 50000000
+    winsize   = int(args[2]) if len(args) > 2 else 100
+
+    tmpdir = tempfile.mkdtemp()
+    bed1 = os.path.join(tmpdir, "test.bed")
+    bed2 = os.path.join(tmpdir, "ctrl.bed")
+    mat = os.path.join(tmpdir, "test.mat")
+    sites = makeSites(nchroms, chromsize)
+    writeBED(bed1, sites, 2)
+    writeBED(bed2, sites, 3)
+    writeMAT(mat, sites, 4)
+    sys.stdout.write("{} sites on {} chromosomes of {} bp, window size {}.\n\n".format(len(sites), nchroms, chromsize, winsize))
+
+    W = dmaptools.WINAVG()
+    W.bedfile = bed1
+    W.winsize = winsize
+    W.mincov = 1
+    W.minsites = 1
+
+    M = dmaptools.WINMAT()
+    M.matfile = mat
+    M.winsize = winsize
+
+    D = dmaptools.DMR()
+    D.bedfile1 = bed1
+    D.bedfile2 = bed2
+    D.winsize = winsize
+    D.minsites1 = 1
+    D.scorer = dmaptools.FisherScorer()
+
+    sys.stdout.write("Command\tAll windows (s)\tSkip empty (s)\tSpeedup\tSame output\n")
+    (t0, out0) = timeit(D, D.findDMRs, False)
+    (t1, out1) = timeit(D, D.findDMRs, True)
+    sys.stdout.write("{}\t{:.2f}\t{:.2f}\t{:.1f}x\t{}\n".format("dmr", t0, t1, t0/t1, "Y" if out0 == out1 else "N"))
+    (t1, out1) = timeit(W, lambda out: W.winAvg(dmaptools.OutputSet([out])))
+    sys.stdout.write("{}\t-\t{:.2f}\n".format("winavg", t1))
+    (t1, out1) = timeit(M, M.winMat)
+    sys.stdout.write("{}\t-\t{:.2f}\n".format("winmat", t1))
+
+    for f in [bed1, bed2, mat]:
+        os.remove(f)
+    os.rmdir(tmpdir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import csv
+import heapq
+import itertools
+import hashlib
+import multiprocessing
 import numpy as np
 import scipy.stats
+from collections import OrderedDict
 
-from Utils import BEDreader, DualBEDreader, MATreader, METHreader, REGreader, readDelim, filenameNoExt, safeInt
+from Utils import PY3, BEDreader, COLreader, MATreader, METHreader, REGreader, readDelim, filenameNoExt, safeInt, loadindex, indexedChroms, packMethFile, MatIndex, MATchunks
 
 import Script
 from Regions import BEDdict
 
+if PY3:
+    from io import StringIO
+else:
+    from cStringIO import StringIO
+
 # COMMANDS = "merge, avgmeth, histmeth, dmr, dmr2, winavg, winmat, cmerge, regavg, corr, dodmeth"
 
 # def usage(what=None):
@@ -221,8 +232,260 @@ from Regions import BEDdict
 #     else:
 #         P.usage()
 
+### Parallel execution
+### Commands that support --threads implement a chromJob(chrom) method that processes a single
+### chromosome and returns a tuple (chrom, output, count), where output is the text to be written
+### for that chromosome and count is the number of records it contains. The tuple may have a fourth
+### element with statistics collected by the worker for that chromosome, which is passed to the
+### chromStats() method of the command in the parent process.
+
+_JOB = None                     # Command being executed by the worker processes
+
+class NullStream():
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+def _chromWorker(chrom):
+    sys.stderr = NullStream()   # per-chromosome messages are written by the parent process
+    return _JOB.chromJob(chrom)
+
+def _fileWorker(filename):
+    return _JOB.fileJob(filename)
+
+def runFiles(cmd, filenames, nthreads):
+    """Call cmd.fileJob() on all files in `filenames' using a pool of `nthreads' processes. Returns
+the list of results, in the same order as `filenames'."""
+    global _JOB
+    _JOB = cmd
+    pool = multiprocessing.Pool(nthreads)
+    try:
+        results = pool.map(_fileWorker, filenames)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def runParallel(cmd, chroms, out, nthreads, what):
+    """Call cmd.chromJob() on all chromosomes in `chroms' using a pool of `nthreads' processes.
+Results are written to `out' in the order of `chroms' as soon as they are available, and a summary
+line for each chromosome is written to standard error. Returns the total count."""
+    global _JOB
+    _JOB = cmd
+    total = 0
+    out.flush()                 # don't let the workers inherit buffered output
+    pool = multiprocessing.Pool(nthreads)
+    try:
+        for result in pool.imap(_chromWorker, chroms):
+            (chrom, text, n) = result[:3]
+            out.write(text)
+            sys.stderr.write("{}: {} {}\n".format(chrom, n, what))
+            total += n
+            if len(result) > 3:
+                cmd.chromStats(result[3])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    sys.stderr.write("Total: {} {}\n".format(total, what))
+    return total
+
+def commonChroms(filename1, filename2, header=False):
+    """Returns the chromosomes of `filename1' that also appear in `filename2', in the order of `filename1'."""
+    chroms2 = set(indexedChroms(filename2, header=header))
+    return [ c for c in indexedChroms(filename1, header=header) if c in chroms2 ]
+
+def mergeChromLists(lists):
+    """Returns all chromosomes in the lists `lists' in a single order consistent with each of them, so
+that a chromosome missing from some lists is placed among the ones surrounding it in the others. Ties
+are broken by order of first appearance. Raises ValueError if two lists have conflicting orders."""
+    first = OrderedDict()       # chrom -> rank of first appearance
+    after = {}                  # chrom -> chromosomes that follow it in some list
+    npred = {}                  # chrom -> number of chromosomes that must come before it
+    for chroms in lists:
+        for c in chroms:
+            if c not in first:
+                first[c] = len(first)
+                after[c] = set()
+                npred[c] = 0
+        for (c1, c2) in zip(chroms, chroms[1:]):
+            if c2 not in after[c1]:
+                after[c1].add(c2)
+                npred[c2] += 1
+    ready = [ (r, c) for (c, r) in first.items() if npred[c] == 0 ]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        (r, c) = heapq.heappop(ready)
+        order.append(c)
+        for c2 in after[c]:
+            npred[c2] -= 1
+            if npred[c2] == 0:
+                heapq.heappush(ready, (first[c2], c2))
+    if len(order) < len(first):
+        raise ValueError("Chromosomes are not in the same order in all input files.")
+    return order
+
+def unionChroms(filenames, header=False):
+    """Returns all the chromosomes in files `filenames' (using their .bidx indexes), in an order consistent
+with all of them (see mergeChromLists)."""
+    return mergeChromLists([ indexedChroms(f, header=header) for f in filenames ])
+
+def bedChroms(reader):
+    """Yield a tuple (chrom, positions, ...) for each chromosome read by BEDreader `reader', with the arrays
+returned by its readChromosomeArrays() method (positions, coverage and C counts for a BEDreader)."""
+    while reader.stream is not None:
+        chrom = reader.chrom
+        yield (chrom,) + reader.readChromosomeArrays()
+
+class ChromWalker():
+    """Positions a BEDreader on the chromosomes of a file requested by name, without using its .bidx
+index: the reader moves forward, and the file is reopened when a chromosome that was already passed is
+requested. Once the end of the file has been reached, chromosomes it does not contain are recognized
+without reading it again. `opener' is called with the filename to create the reader (default: BEDreader)."""
+    filename = ""
+    opener = None
+    reader = None
+    passed = None               # Chromosomes started by the current reader
+    allchroms = None            # Chromosomes seen so far
+    complete = False            # True when allchroms contains all the chromosomes in the file
+
+    def __init__(self, filename, opener=BEDreader):
+        self.filename = filename
+        self.opener = opener
+        self.allchroms = set()
+        self.open()
+
+    def open(self):
+        self.reader = self.opener(self.filename)
+        self.passed = set()
+        self.note()
+
+    def note(self):
+        if self.reader.stream is not None:
+            self.passed.add(self.reader.chrom)
+            self.allchroms.add(self.reader.chrom)
+
+    def find(self, chrom):
+        """Returns the reader positioned on the first site of `chrom', or None if the file has no sites on it."""
+        if self.complete and chrom not in self.allchroms:
+            return None
+        self.note()
+        if self.reader.stream is None or (chrom in self.passed and self.reader.chrom != chrom):
+            self.close()
+            self.open()
+        reader = self.reader
+        while reader.stream is not None and reader.chrom != chrom:
+            current = reader.chrom
+            while reader.stream is not None and reader.chrom == current:
+                reader.readNext()
+            self.note()
+        if reader.stream is None:
+            self.complete = True
+            return None
+        return reader
+
+    def close(self):
+        if self.reader.stream is not None:
+            self.reader.close()
+
+def walkChroms(reader, walker):
+    """Yield pairs of tuples (chrom, arrays...) for the chromosomes read by `reader' that are also present in
+the file followed by ChromWalker `walker', with the arrays returned by readChromosomeArrays(). Neither file
+needs a .bidx index."""
+    while reader.stream is not None:
+        chrom = reader.chrom
+        other = walker.find(chrom)
+        t1 = (chrom,) + reader.readChromosomeArrays()
+        if other:
+            yield (t1, (chrom,) + other.readChromosomeArrays())
+    walker.close()
+
+def pairChroms(src1, src2, chroms):
+    """Given two iterators returning tuples (chrom, positions, ...) for consecutive chromosomes, yield
+pairs of tuples for the chromosomes in `chroms' (the ones present in both sources, see commonChroms), in
+that order. Each source is advanced to the wanted chromosome by name; tuples for chromosomes that are
+wanted later (if the sources list them in a different order) are kept until they are needed."""
+    wanted = set(chroms)
+    sources = [src1, src2]
+    pending = [{}, {}]
+    for chrom in chroms:
+        pair = []
+        for i in [0, 1]:
+            t = pending[i].pop(chrom, None)
+            while t is None:
+                t = next(sources[i], None)
+                if t is None:
+                    break
+                if t[0] != chrom:
+                    if t[0] in wanted:
+                        pending[i][t[0]] = t
+                    t = None
+            pair.append(t)
+        if pair[0] and pair[1]:
+            yield (pair[0], pair[1])
+
+def joinSites(pos1, pos2):
+    """Returns the positions common to `pos1' and `pos2', and their indexes in the two arrays."""
+    return np.intersect1d(pos1, pos2, return_indices=True)
+
 # Merger
 
+class MatCursor():
+    """Forward-only cursor over a position-sorted mat file, used by the merge-join in Merger.
+Moving to a new chromosome seeks to its start using the .bidx index of the file."""
+    filename = ""
+    stream = None
+    idx = {}
+    chrom = None
+    pos = 0
+    line = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stream = open(filename, "r")
+        self.hdr = self.stream.readline().rstrip("\r\n").split("\t")
+        self.idx = loadindex(filename)
+
+    def close(self):
+        self.stream.close()
+
+    def readLine(self):
+        line = self.stream.readline()
+        if line:
+            tp = line.find("\t")
+            if line[:tp] == self.chrom:
+                self.line = line.rstrip("\r\n")
+                self.pos = int(line[tp+1:line.find("\t", tp+1)])
+                return
+        self.line = None
+
+    def seekChrom(self, chrom):
+        self.chrom = chrom
+        if chrom in self.idx:
+            self.stream.seek(self.idx[chrom])
+            self.readLine()
+        else:
+            self.line = None
+
+    def find(self, chrom, pos):
+        """Returns the line for site `pos' in `chrom', or None. Calls for the same chromosome should
+be in increasing order of position."""
+        if chrom != self.chrom:
+            self.seekChrom(chrom)
+        while self.line is not None and self.pos < pos:
+            self.readLine()
+        if self.line is not None and self.pos == pos:
+            return self.line
+        return None
+
 class Merger(Script.Command):
     """report per-replicate methylation values at differentially methylated sites"""
     _cmd = "merge"
@@ -230,11 +493,14 @@ class Merger(Script.Command):
     matfile1 = None
     matfile2 = None
     outfile = None
+    sortedInput = False
 
     def parseArgs(self, args):
         nfiles = 0
         for a in args:
-            if nfiles == 0:
+            if a == "-s":
+                self.sortedInput = True
+            elif nfiles == 0:
                 self.mcompfile = P.isFile(a)
                 nfiles += 1
             elif nfiles == 1:
@@ -247,55 +513,25 @@ class Merger(Script.Command):
                 self.outfile = a
         if nfiles < 3:
             P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
 
-Usage: dmaptools.py merge mcompfile matfile1 matfile2 [outfile]
+Usage: dmaptools.py merge [-s] mcompfile matfile1 matfile2 [outfile]
 
 Merge methylation data from two "mat" files `matfile1' and `matfile2' at the sites
 listed in `mcompfile', containing differentially-methylated C positions. Write
 the results to standard output or to `outfile' if specified.
 
-""")
+By default, sites are looked up through an index of each mat file, saved to a .midx
+file next to it and reused in later runs. With -s, all three files are assumed to be
+sorted by position within each chromosome, and are read in a single forward pass
+(using the .bidx index of the mat files to locate each chromosome).
 
-    def makeMatMap(self, matfile):
-        hdr = []
-        mmap = {}
-        with open(matfile, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            line = c.next()
-            hdr = line[4:]
-            p = f.tell()
-            for line in c:
-                key = line[0] + ":" + line[1]
-                # print("{} -> {}".format(key, p))
-                # raw_input()
-                mmap[key] = p
-                p = f.tell()
-        return (hdr, mmap)
+""")
 
-    def mergeMatFiles(self, out):
-        """Merge the contents of `matfile1' and `matfile2' at all locations contained in `mcompfile'.
-    Write results to `outfile'."""
-        hdr1 = []
-        hdr2 = []
-        nhdr1 = 0
-        nhdr2 = 0
-        map1 = {}
-        map2 = {}
-
-        sys.stderr.write("Indexing sites in `{}'... ".format(self.matfile1))
-        (hdr1, map1) = self.makeMatMap(self.matfile1)
-        sys.stderr.write("done, {} sites found.\n".format(len(map1)))
-        sys.stderr.write("Indexing sites in `{}'... ".format(self.matfile2))
-        (hdr2, map2) = self.makeMatMap(self.matfile2)
-        sys.stderr.write("done, {} sites found.\n".format(len(map2)))
-
-        nhdr1 = len(hdr1)
-        nhdr2 = len(hdr2)
-
-        # print("Header lengths: {}, {}".format(nhdr1, nhdr2))
+    def writeHeader(self, out, hdr1, hdr2):
         out.write("Chrom\tPos\tC1:Avg\tC1:Stdev")
         for h in hdr1:
             out.write("\tC1:" + h)
@@ -304,33 +540,89 @@ the results to standard output or to `outfile' if specified.
             out.write("\tC2:" + h)
         out.write("\n")
 
+    def readSites(self):
+        """Generator returning the (chrom, pos) of all sites in `mcompfile'."""
+        with open(self.mcompfile, "r") as f:
+            f.readline()
+            for line in f:
+                line = line.split("\t")
+                yield (line[0], int(line[1]))
+
+    def mergeMatFiles(self, out):
+        """Merge the contents of `matfile1' and `matfile2' at all locations contained in `mcompfile',
+    looking them up in the .midx index of the two files. Write results to `outfile'."""
+        sys.stderr.write("Opening index for `{}'... ".format(self.matfile1))
+        idx1 = MatIndex(self.matfile1)
+        sys.stderr.write("done, {} sites found.\n".format(idx1.nsites))
+        sys.stderr.write("Opening index for `{}'... ".format(self.matfile2))
+        idx2 = MatIndex(self.matfile2)
+        sys.stderr.write("done, {} sites found.\n".format(idx2.nsites))
+        self.writeHeader(out, idx1.hdr[4:], idx2.hdr[4:])
+
         nwritten = 0
         sys.stderr.write("Writing data for sites in `{}'... ".format(self.mcompfile))
-        with open(self.matfile1, "r") as m1:
-            with open(self.matfile2, "r") as m2:
-                with open(self.mcompfile, "r") as f:
-                    f.readline()
-                    for line in f:
-                        line = line.split("\t")
-                        key = line[0] + ":" + line[1]
-                        if key in map1 and key in map2:
-                            fp1 = map1[key]
-                            m1.seek(fp1)
-                            dl1 = m1.readline().rstrip("\r\n")
-                            fp2 = map2[key]
-                            m2.seek(fp2)
-                            dl2 = readDelim(m2)
-                            out.write(dl1 + "\t" + "\t".join(dl2[2:]) + "\n")
-                            nwritten += 1
+        try:
+            with open(self.matfile1, "r") as m1:
+                with open(self.matfile2, "r") as m2:
+                    for (chrom, pos) in self.readSites():
+                        fp1 = idx1.lookup(chrom, pos)
+                        if fp1 is None:
+                            continue
+                        fp2 = idx2.lookup(chrom, pos)
+                        if fp2 is None:
+                            continue
+                        m1.seek(fp1)
+                        dl1 = m1.readline().rstrip("\r\n")
+                        m2.seek(fp2)
+                        dl2 = readDelim(m2)
+                        out.write(dl1 + "\t" + "\t".join(dl2[2:]) + "\n")
+                        nwritten += 1
+        finally:
+            idx1.close()
+            idx2.close()
         sys.stderr.write("done, {} sites in output.\n".format(nwritten))
         return nwritten
-    
+
+    def mergeSortedMatFiles(self, out):
+        """Like mergeMatFiles, but performs a merge-join of the three files, that should be sorted
+    by position within each chromosome."""
+        m1 = MatCursor(self.matfile1)
+        m2 = MatCursor(self.matfile2)
+        self.writeHeader(out, m1.hdr[4:], m2.hdr[4:])
+
+        nwritten = 0
+        prev = (None, 0)
+        sys.stderr.write("Writing data for sites in `{}'... ".format(self.mcompfile))
+        try:
+            for (chrom, pos) in self.readSites():
+                if chrom == prev[0] and pos < prev[1]:
+                    sys.stderr.write("\nError: file `{}' is not sorted at {}:{}.\n".format(self.mcompfile, chrom, pos))
+                    sys.exit(1)
+                prev = (chrom, pos)
+                dl1 = m1.find(chrom, pos)
+                if dl1 is None:
+                    continue
+                dl2 = m2.find(chrom, pos)
+                if dl2 is None:
+                    continue
+                out.write(dl1 + "\t" + "\t".join(dl2.split("\t")[2:]) + "\n")
+                nwritten += 1
+        finally:
+            m1.close()
+            m2.close()
+        sys.stderr.write("done, {} sites in output.\n".format(nwritten))
+        return nwritten
+
     def run(self):
+        if self.sortedInput:
+            merge = self.mergeSortedMatFiles
+        else:
+            merge = self.mergeMatFiles
         if self.outfile:
             with open(self.outfile, "w") as out:
-                self.mergeMatFiles(out)
+                merge(out)
         else:
-            self.mergeMatFiles(sys.stdout)
+            merge(sys.stdout)
 
 ### ColMerger
 
@@ -358,7 +650,7 @@ class ColMerger():
     missing = "NA"              # Value to use for missing data
     skiphdr = False
 
-    def __init__(self, filenames, target, skiphdr=False):
+    def __init__(self, filenames, target, skiphdr=False, missing="NA"):
         self.filenames = filenames
         self.colnames = [ self.cleanFilename(f) for f in filenames ]
         self.nsources = len(filenames)
@@ -367,6 +659,7 @@ class ColMerger():
         self.recids = []
         self.records = {}
         self.skiphdr = skiphdr
+        self.missing = missing
 
     def cleanFilename(self, f):
         """Move this somewhere else..."""
@@ -418,6 +711,57 @@ class ColMerger():
                     out.write("\t{}".format(v))
                 out.write("\n")
 
+    def readSource(self, idx):
+        """Generator returning (chrom, start, end, value) tuples from source number `idx'."""
+        with open(self.filenames[idx], "r") as f:
+            if self.skiphdr:
+                f.readline()
+            for line in f:
+                if len(line) > 0 and line[0] != '#':
+                    parsed = line.rstrip("\r\n").split("\t")
+                    yield (parsed[0], int(parsed[1]), int(parsed[2]), parsed[self.target])
+
+    def advance(self, idx, source, heap, ranks, last):
+        """Push the next record of source `idx' onto `heap'. Chromosomes are ranked according to
+`ranks'; raises ValueError if the source is not sorted."""
+        try:
+            (chrom, start, end, val) = source.next()
+        except StopIteration:
+            return
+        if chrom not in ranks:
+            raise ValueError("File `{}' has chromosome {} that is not in its index.".format(self.filenames[idx], chrom))
+        key = (ranks[chrom], start)
+        if key < last[idx]:
+            raise ValueError("File `{}' is not sorted at {}:{}.".format(self.filenames[idx], chrom, start))
+        last[idx] = key
+        heapq.heappush(heap, (key, idx, chrom, end, val))
+
+    def streamMerged(self, out):
+        """Merge position-sorted sources with a k-way merge, writing each row as soon as all sources
+have advanced past it. Only one pending record per source is held in memory. Chromosomes are ranked
+in a single order built from the indexes of all sources, so they may be missing from some of them."""
+        self.chroms = unionChroms(self.filenames, header=self.skiphdr)
+        ranks = dict([ (c, i) for (i, c) in enumerate(self.chroms) ])
+        sources = [ self.readSource(idx) for idx in range(self.nsources) ]
+        heap = []
+        last = [(-1, -1)]*self.nsources
+        nrows = 0
+        for idx in range(self.nsources):
+            self.advance(idx, sources[idx], heap, ranks, last)
+        out.write("#Chrom\tStart\tEnd\t" + "\t".join(self.colnames) + "\n")
+        while heap:
+            (key, idx, chrom, end, val) = heapq.heappop(heap)
+            data = [self.missing]*self.nsources
+            data[idx] = val
+            self.advance(idx, sources[idx], heap, ranks, last)
+            while heap and heap[0][0] == key:
+                (_, idx, _, _, val) = heapq.heappop(heap)
+                data[idx] = val
+                self.advance(idx, sources[idx], heap, ranks, last)
+            out.write("{}\t{}\t{}\t{}\n".format(chrom, key[1], end, "\t".join(data)))
+            nrows += 1
+        sys.stderr.write("{} rows written.\n".format(nrows))
+
 ### Averager
 ### This command reads two -mat files and computes the average methylation of each
 ### sample across both conditions. It then compares the two sets of averages using
@@ -432,16 +776,23 @@ class Averager(Script.Command):
     nreps2 = 0
     outfile = None
     pval = 0.01
+    chunksize = 100000
+    threads = 2
 
     def parseArgs(self, args):
         next = ""
         for a in args:
-            if a in ['-p']:
-                next = a
-            elif next == '-p':
+            if next == '-p':
                 self.pval = P.toFloat(a)
                 next = ""
-            if self.matfile1 == None:
+            elif next == '-n':
+                self.chunksize = P.toInt(a)
+                next = ""
+            elif a in ['-p', '-n']:
+                next = a
+            elif a == '-s':
+                self.threads = 1
+            elif self.matfile1 == None:
                 self.matfile1 = P.isFile(a)
             elif self.matfile2 == None:
                 self.matfile2 = P.isFile(a)
@@ -452,7 +803,7 @@ class Averager(Script.Command):
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
 
-Usage: dmaptools.py avgmeth matfile1 matfile2 [outfile]
+Usage: dmaptools.py avgmeth [options] matfile1 matfile2 [outfile]
 
 Compute the average global methylation rates for all replicates in `matfile1' and `matfile2'
 and report them, then test the significance of the difference between the two groups using
@@ -467,39 +818,53 @@ Replicates2: (number of replicates in matfile2)
 MethRates2: (comma-separated average methylation value for each replicate in matfile2)
 Tstatistics: (T statistics from t-test)
 P-value: (P-value from t-test)
-Significant: (Y or N indicating if P-value < 0.01)
+Significant: (Y or N indicating if P-value < {})
+
+Options:
+
+ -p P  | P-value threshold for significance (default: {}).
+ -n N  | Read N rows at a time (default: {}).
+ -s    | Read the two files one after the other instead of concurrently.
+
+""".format(self.pval, self.pval, self.chunksize))
+
+    def readChunks(self, reader):
+        """Returns the chunks of MATchunks `reader', with negative values set to nan like NAs."""
+        for (chroms, pos, values) in reader:
+            with np.errstate(invalid='ignore'):
+                values[values < 0] = np.nan
+            yield (len(pos), values)
 
-""")
-                
     def methAvg(self, filename):
+        reader = MATchunks(filename, chunksize=self.chunksize)
         nrows = 0
-        sys.stderr.write("Reading {}... ".format(filename))
-        with open(filename, "r") as f:
-            hdr = readDelim(f)
-            nreps = len(hdr) - 4
-            counts = [0]*nreps
-            sums = [0]*nreps
-
-            for line in f:
-                nrows += 1
-                fields = line.split("\t")
-                for i in range(nreps):
-                    d = fields[i+4]
-                    if d != "NA":
-                        v = float(d)
-                        if v >= 0:
-                            counts[i] += 1
-                            sums[i] += v
+        counts = np.zeros(reader.ncols, dtype=int)
+        sums = np.zeros(reader.ncols)
+        for (n, values) in self.readChunks(reader):
+            nrows += n
+            good = ~np.isnan(values)
+            counts += good.sum(axis=0)
+            sums += np.where(good, values, 0.0).sum(axis=0)
 
         goodreps = 0            # replicates for which we have data
         avgs = []
-        for i in range(nreps):
+        for i in range(len(counts)):
             if counts[i] > 0:
-                avgs.append(sums[i] / counts[i])
+                avgs.append(float(sums[i]) / counts[i])
                 goodreps += 1
-        sys.stderr.write("{} rows.\n".format(nrows))
+        sys.stderr.write("Reading {}... {} rows.\n".format(filename, nrows))
         return (goodreps, avgs)
 
+    def fileJob(self, filename):
+        return self.methAvg(filename)
+
+    def readFiles(self):
+        """Process the two -mat files, concurrently unless -s was specified."""
+        filenames = [self.matfile1, self.matfile2]
+        if self.threads > 1:
+            return runFiles(self, filenames, self.threads)
+        return [ self.fileJob(f) for f in filenames ]
+
     def report(self, out, avgs1, avgs2):
         out.write("File1: " + self.matfile1 + "\n")
         out.write("Replicates1: " + str(self.nreps1) + "\n")
@@ -513,10 +878,7 @@ Significant: (Y or N indicating if P-value < 0.01)
         out.write("Significant: " + ("Y" if pval <= self.pval else "N") + "\n")
 
     def run(self):
-        (nreps, avgs1) = self.methAvg(self.matfile1)
-        self.nreps1 = nreps
-        (nreps, avgs2) = self.methAvg(self.matfile2)
-        self.nreps2 = nreps
+        [(self.nreps1, avgs1), (self.nreps2, avgs2)] = self.readFiles()
         if self.outfile:
             with open(self.outfile, "w") as out:
                 self.report(out, avgs1, avgs2)
@@ -535,40 +897,39 @@ class Histcomparer(Averager):
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
 
-Usage: dmaptools.py histmeth matfile1 matfile2 [outfile]
+Usage: dmaptools.py histmeth [options] matfile1 matfile2 [outfile]
 
-(more to come)
+For each replicate in `matfile1' and `matfile2', compute the fraction of sites falling in
+each 10% bin of methylation rate, then compare the fractions in the two groups for each
+bin using a two-sample t-test.
 
-""")
+Options:
+
+ -p P  | P-value threshold for significance (default: {}).
+ -n N  | Read N rows at a time (default: {}).
+ -s    | Read the two files one after the other instead of concurrently.
+
+""".format(self.pval, self.chunksize))
         
     def methHist(self, filename):
+        reader = MATchunks(filename, chunksize=self.chunksize)
         nrows = 0
-        sys.stderr.write("Reading {}... ".format(filename))
-        with open(filename, "r") as f:
-            hdr = f.readline().split("\t")
-            nreps = len(hdr) - 4
-            counts = [0]*nreps
-            hist = [ [0]*nreps for i in range(10) ]
-
-            for line in f:
-                nrows += 1
-                fields = line.split("\t")
-                for i in range(nreps):
-                    d = fields[i+4]
-                    if d != "NA":
-                        v = float(d)
-                        if v >= 0:
-                            bin = int(v*10)
-                            if bin == 10:
-                                bin = 9
-                            counts[i] += 1
-                            hist[bin][i] += 1
-        # print(hist)
-        # print(counts)
+        nreps = reader.ncols
+        hist = np.zeros((10, nreps), dtype=int)
+        for (n, values) in self.readChunks(reader):
+            nrows += n
+            for i in range(nreps):
+                col = values[:,i]
+                bins = np.minimum((col[~np.isnan(col)] * 10).astype(int), 9)
+                hist[:,i] += np.bincount(bins, minlength=10)[:10]
+        counts = hist.sum(axis=0)
         fracs = [ [ 1.0*hist[b][i] / counts[i] for i in range(nreps) ] for b in range(10) ]
-        sys.stderr.write("{} rows.\n".format(nrows))
+        sys.stderr.write("Reading {}... {} rows.\n".format(filename, nrows))
         return (nreps, fracs)
 
+    def fileJob(self, filename):
+        return self.methHist(filename)
+
     def report(self, out, fracs1, fracs2):
         out.write("#Bin\tPval\tSignificant\tAvg1\tAvg2\n")
         for b in range(10):
@@ -579,10 +940,7 @@ Usage: dmaptools.py histmeth matfile1 matfile2 [outfile]
             out.write("\t".join([label, str(pval), ("Y" if pval <= self.pval else "N"), str(sum(row1) / self.nreps1), str(sum(row2) / self.nreps2)]) + "\n")
 
     def run(self):
-        (nreps, fracs1) = self.methHist(self.matfile1)
-        self.nreps1 = nreps
-        (nreps, fracs2) = self.methHist(self.matfile2)
-        self.nreps2 = nreps
+        [(self.nreps1, fracs1), (self.nreps2, fracs2)] = self.readFiles()
         if self.outfile:
             with open(self.outfile, "w") as out:
                 self.report(out, fracs1, fracs2)
@@ -591,6 +949,96 @@ Usage: dmaptools.py histmeth matfile1 matfile2 [outfile]
 
 ## DMRs
 
+def sortedMember(a, b):
+    """Returns a boolean array indicating which elements of `a' are present in the sorted array `b'."""
+    if len(b) == 0:
+        return np.zeros(len(a), dtype=bool)
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return b[idx] == a
+
+class FisherScorer():
+    """Compute P-values of Fisher's exact test on 2x2 tables [[C1, T1], [C2, T2]]. Results are stored
+in a bounded LRU cache, since small tables tend to repeat a lot. If `chisq' is set, tables whose smallest
+expected count is at least `chisq' are scored with the (Yates-corrected) chi-square approximation instead."""
+    maxsize = 100000            # Maximum number of entries in cache
+    chisq = None                # Minimum expected count for chi-square approximation
+    cache = None
+    ntables = 0                 # Total number of tables scored
+    nhits = 0                   # Tables found in cache (or repeated in the same batch)
+    napprox = 0                 # Tables scored with chi-square approximation
+
+    def __init__(self, maxsize=100000, chisq=None):
+        self.maxsize = maxsize
+        self.chisq = chisq
+        self.cache = OrderedDict()
+
+    def pvalue(self, c1, t1, c2, t2):
+        """Returns the P-value for a single table."""
+        self.ntables += 1
+        return self._lookup((int(c1), int(t1), int(c2), int(t2)))
+
+    def _lookup(self, key):
+        if key in self.cache:
+            self.nhits += 1
+            pval = self.cache.pop(key)
+        else:
+            (odds, pval) = scipy.stats.fisher_exact([[key[0], key[1]], [key[2], key[3]]])
+            if self.maxsize <= 0:
+                return pval
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[key] = pval
+        return pval
+
+    def pvalues(self, tables):
+        """Returns an array of P-values for `tables', an (n, 4) array of counts (C1, T1, C2, T2).
+Identical tables are only scored once."""
+        n = len(tables)
+        result = np.ones(n)
+        if n == 0:
+            return result
+        self.ntables += n
+        (utables, inverse) = np.unique(np.asarray(tables, dtype=np.int64), axis=0, return_inverse=True)
+        self.nhits += n - len(utables)
+        upvals = np.ones(len(utables))
+        exact = np.ones(len(utables), dtype=bool)
+
+        if self.chisq is not None:
+            (c1, t1, c2, t2) = [ utables[:,i].astype(float) for i in range(4) ]
+            r1 = c1 + t1
+            r2 = c2 + t2
+            k1 = c1 + c2
+            k2 = t1 + t2
+            tot = r1 + r2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                minexp = np.minimum(r1, r2) * np.minimum(k1, k2) / tot
+                approx = minexp >= self.chisq
+                dev = np.maximum(np.abs(c1*t2 - t1*c2) - tot/2.0, 0.0)
+                stat = tot * dev**2 / (r1 * r2 * k1 * k2)
+            upvals[approx] = scipy.stats.chi2.sf(stat[approx], 1)
+            exact = ~approx
+            self.napprox += int(np.sum(approx))
+
+        for i in np.nonzero(exact)[0]:
+            upvals[i] = self._lookup(tuple(utables[i].tolist()))
+        return upvals[inverse]
+
+    def counts(self):
+        """Returns the current values of the counters, as a list."""
+        return [self.ntables, self.nhits, self.napprox]
+
+    def addCounts(self, counts):
+        """Add `counts' (as returned by counts()) to the counters."""
+        self.ntables += counts[0]
+        self.nhits += counts[1]
+        self.napprox += counts[2]
+
+    def report(self, out):
+        if self.ntables:
+            out.write("Fisher tests: {} tables, {} cache hits ({:.1f}%), {} chi-square approximations.\n".format(
+                self.ntables, self.nhits, 100.0 * self.nhits / self.ntables, self.napprox))
+
 class DMRwriter():
     out = None
     maxdist = 0                 # Maximum distance between DMRs for joining
@@ -599,12 +1047,15 @@ class DMRwriter():
     nd = 0
     growing = []
     
-    def __init__(self, out, maxdist, samedir=True):
+    hdr = "#Chrom\tStart\tEnd\tDiff\tPval\n"
+
+    def __init__(self, out, maxdist, samedir=True, header=True):
         self.out = out
         self.maxdist = maxdist
         self.samedir = samedir
         self.growing = []
-        out.write("#Chrom\tStart\tEnd\tDiff\tPval\n")
+        if header:
+            out.write(self.hdr)
 
     def writeDMR(self):
         """Write out the DMRs in `growing'."""
@@ -660,6 +1111,16 @@ class DMR(Script.Command):
     growing = None              # buffer for DMRs that can potentially be joined
     jump = False                # Skip to this chrom?
     one = False                 # Do a single chromosome?
+    fast = False                # Use vectorized per-chromosome engine?
+    skipEmpty = True            # Jump over windows containing no sites?
+    scorer = None               # FisherScorer
+    memosize = FisherScorer.maxsize
+    chisq = None                # Minimum expected count for chi-square approximation
+    threads = 1                 # Number of chromosomes processed in parallel
+    cachefile = None            # Window statistics cache (--cache)
+    cachecov = 50               # Coverage levels above this are merged in the cache
+    verify = False              # Always check the cache against the checksum of the input files
+    cacheVersion = 2            # Format of the cache; version 1 could miss chromosomes
 
     def parseArgs(self, args):
         next = ""
@@ -695,10 +1156,26 @@ class DMR(Script.Command):
                 self.jump = a
                 self.one = True
                 next = ""
-            elif a in ['-w', '-s', '-t', '-c', '-d', '-p', '-o', '-g', '-j', '-J']:
+            elif next == '--memo':
+                self.memosize = P.toInt(a)
+                next = ""
+            elif next == '--chisq':
+                self.chisq = P.toFloat(a)
+                next = ""
+            elif next == '--threads':
+                self.threads = P.toInt(a)
+                next = ""
+            elif next == '--cache':
+                self.cachefile = a
+                next = ""
+            elif a in ['-w', '-s', '-t', '-c', '-d', '-p', '-o', '-g', '-j', '-J', '--memo', '--chisq', '--threads', '--cache']:
                 next = a
             elif a == '-a':
                 self.samedir = False
+            elif a == '-f':
+                self.fast = True
+            elif a == '--verify':
+                self.verify = True
             elif self.bedfile1 == None:
                 self.bedfile1 = P.isFile(a)
             else:
@@ -737,8 +1214,23 @@ Options:
  -p pval      | P-value threshold (default: {}).
  -g gap       | Maximum gap for DMR joining (default: {}).
  -a           | Allow joining of DMRs in different directions.
-
-""".format(self.winsize, self.minsites1, self.minsites2, self.mincov, self.methdiff, self.pval, self.gap))
+ -f           | Use the vectorized engine: load each chromosome in memory and score
+                all its windows in a single pass (much faster on large inputs).
+ --memo N     | Remember the P-values of the last N distinct tables (default: {}).
+ --chisq E    | Use the chi-square approximation instead of Fisher's exact test for
+                tables whose smallest expected count is at least E.
+ --threads N  | Process N chromosomes in parallel (uses the .bidx index of the input
+                files, creating it if necessary).
+ --cache C    | Use file C as a cache of window statistics. If C does not exist, or was
+                created from different input files or window size, it is (re)built
+                from the input files; otherwise the input files are not read at all.
+                Useful to try different values of -t, -s, -c, -d, -p, -g. Values of -c
+                above {} cannot be served from the cache.
+ --verify     | Input files are recognized by path, size and modification time, and
+                only checksummed when these change. With this option, always compare
+                their checksum with the one stored in the cache.
+
+""".format(self.winsize, self.minsites1, self.minsites2, self.mincov, self.methdiff, self.pval, self.gap, self.memosize, self.cachecov))
 
     def isDMR(self, data1, data2):
         """data1 = test, data2 = control."""
@@ -766,6 +1258,8 @@ Options:
         # Do we have a sufficient number of sites?
         if ngood1 < self.minsites1 or ngood2 < self.minsites2:
             return None
+        if totC1 + totT1 == 0 or totC2 + totT2 == 0:
+            return None
 
         # Compute methdiff ratio. Is it above our threshold?
         ratio1 = 1.0 * totC1 / (totC1 + totT1)
@@ -776,75 +1270,313 @@ Options:
         #print(diff, [[totC1, totT1], [totC2, totT2]])
 
         # Compute p-value
-        (odds, pval) = scipy.stats.fisher_exact([[totC1, totT1], [totC2, totT2]])
+        if self.chisq is None:
+            pval = self.scorer.pvalue(totC1, totT1, totC2, totT2)
+        else:
+            pval = self.scorer.pvalues([[totC1, totT1, totC2, totT2]])[0]
         #print(odds, pval, diff, [[totC1, totT1], [totC2, totT2]])
         if pval <= self.pval:
             return (pval, diff)
         else:
             return None
         
-    def findDMRs(self, out, avgout=None):
-        DW = DMRwriter(out, self.gap*self.winsize, samedir=self.samedir)
-        BR1 = BEDreader(self.bedfile1, jump=self.jump)
-        BR2 = BEDreader(self.bedfile2, jump=self.jump)
-        chrom = BR1.chrom       # assume that both BED files start with the same chrom - should check this!
-        
+    def chromList(self):
+        """Returns the chromosomes to process: those present in both files (see commonChroms), starting
+at the one given with -j, or only the one given with -J."""
+        chroms = commonChroms(self.bedfile1, self.bedfile2)
+        if self.jump:
+            chroms = chroms[chroms.index(self.jump):] if self.jump in chroms else []
+            if self.one:
+                chroms = chroms[:1]
+        return chroms
+
+    def chromDMRs(self, DW, chrom, BR1, BR2):
+        """Write the DMRs of chromosome `chrom' to DMRwriter `DW', reading the sites from `BR1' and `BR2'
+(positioned on the first site of `chrom'). Returns the number of DMRs found."""
         start = 0
         end = self.winsize
         nfound = 0
-        totfound = 0
 
         while BR1.stream != None and BR2.stream != None:
             data1 = BR1.readUntil(chrom, end)
             data2 = BR2.readUntil(chrom, end)
-
-            if isinstance(data1, basestring): # BR1 is at new chrom?
-                sys.stderr.write("{}: {} DMRs\n".format(chrom, nfound))
-                if self.one:
-                    break
-                BR2.skipToChrom(data1)        # BR2 should join it
-                totfound += nfound
-                nfound = 0
-                chrom = data1
-                start = 0
-                end = self.winsize
-
-            elif isinstance(data2, basestring): # BR2 is at new chrom?
-                sys.stderr.write("{}: {} DMRs\n".format(chrom, nfound))
-                if self.one:
-                    break
-                BR1.skipToChrom(data2)        # BR1 should join it
-                totfound += nfound
-                nfound = 0
-                chrom = data2
-                start = 0
-                end = self.winsize
-            
-            else:               # Both are lists, OK
-                if len(data1) > 0 and len(data2) > 0:
-                    result = self.isDMR(data1, data2)
-                    if result:
-                        nfound += 1
-                        (pval, diff) = result
-                        DW.addDMR([chrom, start, end, diff, pval])
-                    if avgout:
-                        ratios1 = [ (1.0*v[1])/v[0] for v in data1 ]
-                        ratios2 = [ (1.0*v[1])/v[0] for v in data2 ]
+            if isinstance(data1, basestring) or isinstance(data2, basestring):
+                break       # One of the files has moved past this chromosome
+
+            if len(data1) > 0 and len(data2) > 0:
+                result = self.isDMR(data1, data2)
+                if result:
+                    nfound += 1
+                    (pval, diff) = result
+                    DW.addDMR([chrom, start, end, diff, pval])
             # Move forward
-            start += self.winsize                                                    
+            start += self.winsize
             end += self.winsize
+            if self.skipEmpty and BR1.chrom == chrom and BR2.chrom == chrom:
+                nextpos = min(BR1.pos, BR2.pos)
+                if nextpos >= end: # jump to window containing next site
+                    start = nextpos - nextpos % self.winsize
+                    end = start + self.winsize
         sys.stderr.write("{}: {} DMRs\n".format(chrom, nfound))
+        return nfound
+
+    def findDMRs(self, out, avgout=None, header=True):
+        """Find DMRs one window at a time. The chromosomes of the first file are read in order, and the
+second file follows them by name; the .bidx indexes are only used to start from the -j/-J chromosome."""
+        DW = DMRwriter(out, self.gap*self.winsize, samedir=self.samedir, header=header)
+        totfound = 0
+
+        if self.jump:
+            for chrom in self.chromList():
+                BR1 = BEDreader(self.bedfile1, jump=chrom)
+                BR2 = BEDreader(self.bedfile2, jump=chrom)
+                totfound += self.chromDMRs(DW, chrom, BR1, BR2)
+                if BR1.stream != None:
+                    BR1.close()
+                if BR2.stream != None:
+                    BR2.close()
+        else:
+            BR1 = BEDreader(self.bedfile1)
+            W2 = ChromWalker(self.bedfile2)
+            while BR1.stream != None:
+                chrom = BR1.chrom
+                BR2 = W2.find(chrom)
+                if BR2:
+                    totfound += self.chromDMRs(DW, chrom, BR1, BR2)
+                while BR1.stream != None and BR1.chrom == chrom:
+                    BR1.readNext()
+            W2.close()
         sys.stderr.write("Total: {} DMRs\n".format(totfound))
         DW.finish()
-        # BR1.close()
-        # BR2.close()
+        return totfound
+
+    # Vectorized engine
+
+    def windowStats(self, s1, s2):
+        """Compute the statistics of all windows in one chromosome. `s1' and `s2' are tuples of arrays
+(positions, coverage, C counts) for test and control, as returned by BEDreader.readChromosomeArrays().
+Returns a tuple of arrays (ngood1, totC1, totT1, ngood2, totC2, totT2) indexed by window number."""
+        (pos1, cov1, c1) = s1
+        (pos2, cov2, c2) = s2
+        good1 = sortedMember(pos1, pos2) & (cov1 >= self.mincov)
+        good2 = sortedMember(pos2, pos1) & (cov2 >= self.mincov)
+        w1 = pos1[good1] // self.winsize
+        w2 = pos2[good2] // self.winsize
+        nw = 1 + max(w1[-1] if len(w1) else 0, w2[-1] if len(w2) else 0)
+        return (np.bincount(w1, minlength=nw),
+                np.bincount(w1, weights=c1[good1], minlength=nw),
+                np.bincount(w1, weights=cov1[good1] - c1[good1], minlength=nw),
+                np.bincount(w2, minlength=nw),
+                np.bincount(w2, weights=c2[good2], minlength=nw),
+                np.bincount(w2, weights=cov2[good2] - c2[good2], minlength=nw))
+
+    def scoreWindows(self, chrom, stats):
+        """Apply the DMR tests to the window statistics `stats' (as returned by windowStats) for
+chromosome `chrom'. Returns the list of DMRs found, in the format expected by DMRwriter.addDMR()."""
+        (ngood1, totC1, totT1, ngood2, totC2, totT2) = stats
+        den1 = totC1 + totT1
+        den2 = totC2 + totT2
+        cand = np.nonzero((ngood1 >= self.minsites1) & (ngood2 >= self.minsites2) & (den1 > 0) & (den2 > 0))[0]
+        diff = totC1[cand] / den1[cand] - totC2[cand] / den2[cand]
+        keep = np.abs(diff) >= self.methdiff
+        cand = cand[keep]
+        diff = diff[keep]
+
+        pvals = self.scorer.pvalues(np.column_stack((totC1[cand], totT1[cand], totC2[cand], totT2[cand])))
+        keep = pvals <= self.pval
+
+        result = []
+        for (w, d, pval) in zip(cand[keep].tolist(), diff[keep].tolist(), pvals[keep]):
+            start = w * self.winsize
+            result.append([chrom, start, start + self.winsize, d, pval])
+        return result
+
+    def chromosomeArrays(self, chroms):
+        """Generator returning (chrom, s1, s2) for each chromosome in `chroms' (which should be present
+in both files), where `s1' and `s2' are the arrays returned by BEDreader.readChromosomeArrays()."""
+        if not chroms:
+            return
+        BR1 = BEDreader(self.bedfile1, jump=chroms[0])
+        BR2 = BEDreader(self.bedfile2, jump=chroms[0])
+        for (t1, t2) in pairChroms(bedChroms(BR1), bedChroms(BR2), chroms):
+            yield (t1[0], t1[1:], t2[1:])
+
+    def findDMRsFast(self, out, header=True):
+        """Like findDMRs(), but loads one chromosome at a time from both files and scores all
+its windows at once."""
+        stats = ( (chrom, self.windowStats(s1, s2)) for (chrom, s1, s2) in self.chromosomeArrays(self.chromList()) )
+        return self.writeDMRs(out, stats, header)
+
+    def writeDMRs(self, out, stats, header=True):
+        """Score the windows of each (chrom, stats) pair in `stats' and write the resulting DMRs."""
+        DW = DMRwriter(out, self.gap*self.winsize, samedir=self.samedir, header=header)
+        totfound = 0
+        for (chrom, st) in stats:
+            dmrs = self.scoreWindows(chrom, st)
+            for d in dmrs:
+                DW.addDMR(d)
+            sys.stderr.write("{}: {} DMRs\n".format(chrom, len(dmrs)))
+            totfound += len(dmrs)
+        sys.stderr.write("Total: {} DMRs\n".format(totfound))
+        DW.finish()
+        return totfound
+
+    # Window statistics cache
+
+    def cacheKey(self):
+        """Returns a string identifying the format, window size and coverage levels of the cache."""
+        return "v{}:{}:{}".format(self.cacheVersion, self.winsize, self.cachecov)
+
+    def fileStamps(self):
+        """Returns a string identifying the input files by path, size and modification time."""
+        stamps = []
+        for filename in [self.bedfile1, self.bedfile2]:
+            st = os.stat(filename)
+            stamps.append("{}:{}:{}".format(os.path.abspath(filename), st.st_size, int(st.st_mtime)))
+        return "|".join(stamps)
+
+    def checksum(self):
+        """Returns the MD5 checksum of the contents of the input files."""
+        md5 = hashlib.md5()
+        for filename in [self.bedfile1, self.bedfile2]:
+            with open(filename, "rb") as f:
+                while True:
+                    data = f.read(1048576)
+                    if not data:
+                        break
+                    md5.update(data)
+        return md5.hexdigest()
+
+    def sampleStats(self, ci, pos, good, cov, c):
+        """Summarize the good sites of one sample in chromosome number `ci' into (chrom, window,
+coverage level, sites, C, T) rows, one for each distinct window and coverage level."""
+        win = pos[good] // self.winsize
+        level = np.minimum(cov[good], self.cachecov).astype(np.int64)
+        (keys, inv) = np.unique(win * (self.cachecov + 1) + level, return_inverse=True)
+        return (np.full(len(keys), ci, dtype=np.int32),
+                keys // (self.cachecov + 1),
+                (keys % (self.cachecov + 1)).astype(np.int16),
+                np.bincount(inv),
+                np.bincount(inv, weights=c[good]),
+                np.bincount(inv, weights=cov[good] - c[good]))
+
+    def buildCache(self, key, checksum=None):
+        """Read both input files and save the window statistics of all chromosomes to the cache."""
+        sys.stderr.write("Building window statistics cache `{}'...\n".format(self.cachefile))
+        chroms = []
+        rows = [[], []]
+        for (chrom, s1, s2) in self.chromosomeArrays(commonChroms(self.bedfile1, self.bedfile2)):
+            ci = len(chroms)
+            chroms.append(chrom)
+            (pos1, cov1, c1) = s1
+            (pos2, cov2, c2) = s2
+            rows[0].append(self.sampleStats(ci, pos1, sortedMember(pos1, pos2), cov1, c1))
+            rows[1].append(self.sampleStats(ci, pos2, sortedMember(pos2, pos1), cov2, c2))
+        data = {'key': np.array([key]), 'stamp': np.array([self.fileStamps()]),
+                'md5': np.array([checksum or self.checksum()]), 'chroms': np.array(chroms)}
+        fields = ['chrom', 'win', 'level', 'n', 'c', 't']
+        for s in range(2):
+            for i in range(len(fields)):
+                data["{}{}".format(fields[i], s + 1)] = np.concatenate([ r[i] for r in rows[s] ]) if rows[s] else np.zeros(0)
+        self.writeCache(data)
+
+    def writeCache(self, data):
+        with open(self.cachefile, "wb") as f:
+            np.savez(f, **data)
+
+    def loadCache(self):
+        """Returns the contents of the cache, building it first if missing or out of date."""
+        key = self.cacheKey()
+        checksum = None
+        if os.path.isfile(self.cachefile):
+            data = np.load(self.cachefile)
+            if 'stamp' in data.files and str(data['key'][0]) == key:
+                if not self.verify and str(data['stamp'][0]) == self.fileStamps():
+                    sys.stderr.write("Reading window statistics from cache `{}'.\n".format(self.cachefile))
+                    return data
+                checksum = self.checksum()
+                if str(data['md5'][0]) == checksum:
+                    sys.stderr.write("Reading window statistics from cache `{}' (checksum verified).\n".format(self.cachefile))
+                    stamp = self.fileStamps()
+                    if str(data['stamp'][0]) == stamp:
+                        return data
+                    # Files were touched or moved but not changed: store their new stamps
+                    contents = dict([ (k, data[k]) for k in data.files ])
+                    data.close()
+                    contents['stamp'] = np.array([stamp])
+                    self.writeCache(contents)
+                    return np.load(self.cachefile)
+            sys.stderr.write("Cache `{}' does not match input files or window size.\n".format(self.cachefile))
+        self.buildCache(key, checksum)
+        return np.load(self.cachefile)
+
+    def cachedStats(self, data):
+        """Generator returning (chrom, stats) for each chromosome in the cache, where stats is in
+the format returned by windowStats() for the current value of mincov."""
+        chroms = data['chroms'].tolist()
+        samples = []
+        for s in ["1", "2"]:
+            keep = data['level' + s] >= self.mincov
+            samples.append([ data[f + s][keep] for f in ['chrom', 'win', 'n', 'c', 't'] ])
+        started = not self.jump
+        for ci in range(len(chroms)):
+            if chroms[ci] == self.jump:
+                started = True
+            if not started:
+                continue
+            parts = [ [ a[sample[0] == ci] for a in sample[1:] ] for sample in samples ]
+            nw = 1 + max([ p[0].max() if len(p[0]) else 0 for p in parts ])
+            stats = []
+            for (win, n, c, t) in parts:
+                stats.append(np.bincount(win, weights=n, minlength=nw))
+                stats.append(np.bincount(win, weights=c, minlength=nw))
+                stats.append(np.bincount(win, weights=t, minlength=nw))
+            yield (str(chroms[ci]), tuple(stats))
+            if self.one:
+                break
+
+    def findDMRsCached(self, out, header=True):
+        """Like findDMRsFast(), but using the window statistics from the cache."""
+        return self.writeDMRs(out, self.cachedStats(self.loadCache()), header)
+
+    def chromJob(self, chrom):
+        self.jump = chrom
+        self.one = True
+        out = StringIO()
+        before = self.scorer.counts()
+        if self.fast:
+            n = self.findDMRsFast(out, header=False)
+        else:
+            n = self.findDMRs(out, header=False)
+        # The scorer of each worker is reused across chromosomes, so only return what this one added
+        return (chrom, out.getvalue(), n, [ a - b for (a, b) in zip(self.scorer.counts(), before) ])
+
+    def chromStats(self, counts):
+        self.scorer.addCounts(counts)
+
+    def findDMRsParallel(self, out):
+        out.write(DMRwriter.hdr)
+        runParallel(self, self.chromList(), out, self.threads, "DMRs")
 
     def run(self):
+        self.scorer = FisherScorer(maxsize=self.memosize, chisq=self.chisq)
+        if self.cachefile and self.mincov > self.cachecov:
+            sys.stderr.write("Warning: minimum coverage is above {}, not using cache.\n".format(self.cachecov))
+            self.cachefile = None
+        if self.cachefile:
+            finder = self.findDMRsCached
+        elif self.threads > 1:
+            finder = self.findDMRsParallel
+        elif self.fast:
+            finder = self.findDMRsFast
+        else:
+            finder = self.findDMRs
         if self.outfile:
             with open(self.outfile, "w") as out:
-                self.findDMRs(out)
+                finder(out)
         else:
-            self.findDMRs(sys.stdout)
+            finder(sys.stdout)
+        self.scorer.report(sys.stderr)
 
 class DMR2writer():
     out = None
@@ -857,17 +1589,16 @@ class DMR2writer():
     positions = []              # Position of sites in this DMR
     data = []                   # Diffmeth values for sites in this DMR
     insig_max = None            # Maximum number of insignificant sites (--insig)
-    insig_count = 0             # Number of insignificant sites in this DMR
+    insig_count = 0             # Number of insignificant sites in this DMR (reset on each new chromosome)
+    nwritten = 0                # Number of DMRs written
    
+    def reset(self):
+        """Forget the current DMR (call after maybeWriteDMR() to start from scratch)."""
+        self.chrom = ""
+        self.positions = []
+        self.data = []
+        self.insig_count = 0
     
-    def start(self, chrom, pos, diff):
-        self.maybeWriteDMR()
-        self.chrom = chrom
-        self.pos = pos
-        self.direction = "+" if diff > 0 else "-"
-        self.positions = [pos]
-        self.data = [diff]
-
     def maybeWriteDMR(self):
         ns = len(self.positions)
         if ns < self.minsites:
@@ -878,45 +1609,68 @@ class DMR2writer():
         if end - start < self.mindmrsize:
             #sys.stderr.write("skipping due to length\n")
             return
-        #sys.stderr.write("{}\n".format(self.data))
-        #sys.stderr.write("Writing DMR: {}\n".format((self.chrom, start, end, end-start, sum(self.data) / ns, ns)))
-        self.out.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(self.chrom, start, end, end-start, sum(self.data) / ns, ns))
-
-    def add(self, chrom, pos, diff):
-        # If we are tracking insignificant sites...
-        if self.insig_max is not None:
-            # ...and the # of insig. sites is greater than max
-            if self.insig_count > self.insig_max:
-                # ... start new DMR
-                self.start(chrom, pos, diff)
-                self.insig_count = 0
-                return
-        #sys.stderr.write("Adding: {}\n".format((chrom, pos, diff)))
-
-        # If we changed chromosomes...
+        self.writeDMR(self.chrom, start, end, self.data)
+
+    def writeDMR(self, chrom, start, end, data):
+        ns = len(data)
+        self.out.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(chrom, start, end, end-start, sum(data) / ns, ns))
+        self.nwritten += 1
+
+    def addChromosome(self, chrom, pos, diff, sig):
+        """Add the sites of a chromosome to the current DMR, starting a new one on a change of chromosome
+or direction, after a gap longer than maxsitedist, or after more than insig_max insignificant sites (if
+set). `pos' and `diff' contain the sites that passed the coverage filter, `sig' is a boolean array marking
+the significant ones. The last DMR is left open, so that it can be extended by the following sites or
+written by maybeWriteDMR()."""
         if chrom != self.chrom:
-            # ... start new DMR
-            self.start(chrom, pos, diff)
-            return
-        thisDir = "+" if diff > 0 else "-"
-        # If we changed chromosomes...
-        if thisDir != self.direction:
-            # ... start new DMR
-            self.start(chrom, pos, diff)
+            self.insig_count = 0         # Insignificant sites are only counted within a chromosome
+        ninsig = np.cumsum(~sig)[sig]    # Insignificant sites before each significant one
+        pos = pos[sig]
+        diff = diff[sig]
+        n = len(pos)
+        if n == 0:
+            if self.insig_max is not None:
+                self.insig_count += len(sig)
             return
 
-        # If we're too far away from previous site...
-        if (pos - self.pos) > self.maxsitedist:
-            # ... start new DMR
-            self.start(chrom, pos, diff)
-            return
+        # A new DMR starts on a change of chromosome, of direction, or after a gap
+        up = diff > 0
+        breaks = np.empty(n, dtype=bool)
+        breaks[0] = chrom != self.chrom or up[0] != (self.direction == "+") or pos[0] - self.pos > self.maxsitedist
+        breaks[1:] = (up[1:] != up[:-1]) | (np.diff(pos) > self.maxsitedist)
+
+        # ... or when too many insignificant sites were seen since the last time this happened
+        if self.insig_max is not None:
+            ninsig += self.insig_count
+            base = 0
+            k = -1
+            while True:
+                k = max(np.searchsorted(ninsig, base + self.insig_max, 'right'), k + 1)
+                if k >= n:
+                    break
+                breaks[k] = True
+                base = ninsig[k]
+            self.insig_count += len(sig) - n - base
+
+        starts = np.flatnonzero(breaks)
+        if len(starts) == 0:
+            self.positions.extend(pos.tolist())
+            self.data.extend(diff.tolist())
+        else:
+            self.positions.extend(pos[:starts[0]].tolist())
+            self.data.extend(diff[:starts[0]].tolist())
+            self.maybeWriteDMR()
+            ends = np.append(starts[1:], n)
+            good = ((ends - starts) >= self.minsites) & ((pos[ends - 1] - pos[starts]) >= self.mindmrsize)
+            good[-1] = False    # Last one stays open
+            for (i, j) in zip(starts[good], ends[good]):
+                self.writeDMR(chrom, int(pos[i]), int(pos[j - 1]), diff[i:j].tolist())
+            self.chrom = chrom
+            self.positions = pos[starts[-1]:].tolist()
+            self.data = diff[starts[-1]:].tolist()
+        self.pos = int(pos[-1])
+        self.direction = "+" if up[-1] else "-"
 
-        
-        # Otherwise, extend current DMR
-        self.pos = pos
-        self.positions.append(pos)
-        self.data.append(diff)
-        
 class DMR2(Script.Command):
     """detect differentially methylated regions (method #2)"""
     _cmd = "dmr2"
@@ -927,6 +1681,8 @@ class DMR2(Script.Command):
     bedfile2 = None          # BED file for control condition
     outfile  = None
     track_insig = False      # True if insignificant sites should be tracked
+    threads  = 1             # Number of chromosomes processed in parallel
+    jump     = False         # Only process this chromosome
 
     def parseArgs(self, args):
         self.DW = DMR2writer()
@@ -957,7 +1713,10 @@ class DMR2(Script.Command):
                 self.DW.insig_max = int(a)
                 self.track_insig = True
                 next = ""
-            elif a in ['-w', '-s', '-t', '-c', '-d', '-p', '-o', '--insig']:
+            elif next == '--threads':
+                self.threads = P.toInt(a)
+                next = ""
+            elif a in ['-w', '-s', '-t', '-c', '-d', '-p', '-o', '--insig', '--threads']:
                 next = a
             elif self.bedfile1 == None:
                 self.bedfile1 = P.isFile(a)
@@ -989,59 +1748,349 @@ Options:
  -s maxdist   | Maximum distance between sites in a window (default: {}).
  -w minsize   | Minimum size of a DMR (default: {}).
  --insig num  | Maximum number of sites below methdiff allowed in DMR (default: {}).
+                Sites are counted separately on each chromosome.
+ --threads N  | Process N chromosomes in parallel (uses the .bidx index of the input
+                files, creating it if necessary).
 
 """.format(DMR2writer.minsites, self.mincov, self.methdiff, DMR2writer.maxsitedist, DMR2writer.mindmrsize, DMR2writer.insig_max))
             
-    def findDMRs(self, out):
+    def chromList(self):
+        """Returns the chromosomes to process: those present in both files (see commonChroms), or
+only the one being processed by this job."""
+        chroms = commonChroms(self.bedfile1, self.bedfile2)
+        if self.jump:
+            chroms = [ c for c in chroms if c == self.jump ]
+        return chroms
+
+    def chromosomePairs(self):
+        """Returns an iterator over pairs of tuples (chrom, positions, coverage, C counts) for the chromosomes
+present in both files. A parallel job jumps to its chromosome using the .bidx indexes; otherwise the second
+file follows the first by name (see walkChroms), and no index is needed."""
+        if self.jump:
+            BR1 = BEDreader(self.bedfile1, jump=self.jump)
+            BR2 = BEDreader(self.bedfile2, jump=self.jump)
+            return pairChroms(bedChroms(BR1), bedChroms(BR2), self.chromList())
+        return walkChroms(BEDreader(self.bedfile1), ChromWalker(self.bedfile2))
+
+    def findDMRs(self, out, header=True):
         self.DW.out = out
-        out.write("#Chrom\tStart\tEnd\tLen\tDiffmeth\tNsites\n")
-        BR = DualBEDreader(self.bedfile1, self.bedfile2)
-        while True:
-            if BR.readNext():
-                c1 = BR.current1
-                c2 = BR.current2
-                if c1[0] < self.mincov or c2[0] < self.mincov:
-                    continue
-                m1 = 1.0 * c1[1] / c1[0]
-                m2 = 1.0 * c2[1] / c2[0]
-                d = m1 - m2
-                if abs(d) > self.methdiff:
-                    self.DW.add(BR.chrom, BR.pos, d)
-                # if we are tracking
-                elif self.track_insig:
-                    self.DW.insig_count += 1
-            else:
-                return
+        if header:
+            out.write("#Chrom\tStart\tEnd\tLen\tDiffmeth\tNsites\n")
+        for ((chrom, pos1, cov1, c1), (_, pos2, cov2, c2)) in self.chromosomePairs():
+            (pos, i1, i2) = joinSites(pos1, pos2)
+            cov1 = cov1[i1]
+            cov2 = cov2[i2]
+            good = (cov1 >= self.mincov) & (cov2 >= self.mincov)
+            d = c1[i1][good].astype(float) / cov1[good] - c2[i2][good].astype(float) / cov2[good]
+            self.DW.addChromosome(chrom, pos[good], d, np.abs(d) > self.methdiff)
         self.DW.maybeWriteDMR()
+
+    def chromJob(self, chrom):
+        self.jump = chrom
+        self.DW.reset()
+        nw = self.DW.nwritten
+        out = StringIO()
+        self.findDMRs(out, header=False)
+        return (chrom, out.getvalue(), self.DW.nwritten - nw)
+
+    def findDMRsParallel(self, out):
+        out.write("#Chrom\tStart\tEnd\tLen\tDiffmeth\tNsites\n")
+        runParallel(self, self.chromList(), out, self.threads, "DMRs")
         
     def run(self):
+        if self.threads > 1:
+            finder = self.findDMRsParallel
+        else:
+            finder = self.findDMRs
         try:
             if self.outfile:
                 with open(self.outfile, "w") as out:
-                    self.findDMRs(out)
+                    finder(out)
             else:
-                self.findDMRs(sys.stdout)
+                finder(sys.stdout)
         except KeyboardInterrupt:
             return
         except IOError:
             return
 
+### DMRMAT
+
+def parseGroups(spec):
+    """Parse a group specification of the form `1,2,3:4-6' into a list of lists of 0-based column
+indexes. Returns None if the specification is invalid."""
+    groups = []
+    try:
+        for g in spec.split(":"):
+            cols = []
+            for piece in g.split(","):
+                if "-" in piece:
+                    (a, b) = piece.split("-")
+                    cols.extend(range(int(a) - 1, int(b)))
+                else:
+                    cols.append(int(piece) - 1)
+            groups.append(cols)
+    except ValueError:
+        return None
+    return groups
+
+class DMRMAT(Script.Command):
+    """detect differentially methylated regions between groups of replicates"""
+    _cmd = "dmrmat"
+    winsize = 100
+    minsites = 1    # Minimum number of sites in window for each replicate
+    minreps = 2     # Minimum number of replicates with data in each group
+    methdiff = 0.2
+    pval = 0.01
+    gap = 0         # Maximum number of non-DMR regions that can be joined
+    samedir = True  # Only join DMRs in same direction?
+    matfiles = []
+    groups = None   # Two lists of replicate indexes (test, control)
+    outfile = None
+
+    def parseArgs(self, args):
+        self.matfiles = []
+        next = ""
+        for a in args:
+            if next == '-w':
+                self.winsize = P.toInt(a)
+                next = ""
+            elif next == '-t':
+                self.minsites = P.toInt(a)
+                next = ""
+            elif next == '-r':
+                self.minreps = P.toInt(a)
+                next = ""
+            elif next == '-d':
+                self.methdiff = P.toFloat(a)
+                next = ""
+            elif next == '-p':
+                self.pval = P.toFloat(a)
+                next = ""
+            elif next == '-g':
+                self.gap = P.toInt(a)
+                next = ""
+            elif next == '-o':
+                self.outfile = a
+                next = ""
+            elif next == '-G':
+                self.groups = parseGroups(a)
+                if self.groups is None or len(self.groups) != 2:
+                    sys.stderr.write("Error: -G should specify two groups of replicates, e.g. 1,2,3:4-6.\n")
+                    return False
+                next = ""
+            elif a in ['-w', '-t', '-r', '-d', '-p', '-g', '-o', '-G']:
+                next = a
+            elif a == '-a':
+                self.samedir = False
+            else:
+                self.matfiles.append(P.isFile(a))
+        if not self.matfiles:
+            P.errmsg(P.NOFILE)
+        if self.groups is None:
+            if len(self.matfiles) != 2:
+                sys.stderr.write("Error: use -G to specify the replicate groups, unless two mat files are given.\n")
+                return False
+        return True
+
+    def usage(self, parent, out=sys.stdout):
+        out.write("""dmaptools.py - Operate on methylation data.
+
+Usage: dmaptools.py dmrmat [options] matfiles...
+
+This command detects regions of differential methylation (DMRs) between two groups of
+replicates (test and control respectively), using the per-replicate methylation values
+in one or more -mat files. If two files are specified and -G is not used, the replicates
+in the first file are the test group and those in the second file are the control group.
+Otherwise, use -G to assign replicates to groups; replicates are numbered from 1, across
+all files in the order they are specified.
+
+The genome is divided into consecutive windows of `winsize' nucleotides, and the average
+methylation of each replicate in each window is computed over its sites with a value (NA
+and negative values are ignored). A window is identified as a DMR if: at least `minreps'
+replicates in each group have at least `minsites' sites in it; the difference between the
+average methylation of the two groups is at least `methdiff'; and the P-value of this
+difference, computed with a two-sample t-test on the replicate averages, is not larger than
+`pval'. DMRs are joined as in the dmr command. All replicates are processed in a single pass
+over the input files. A chromosome may be missing from some files, but the chromosomes they
+have in common should appear in the same order.
+
+Options:
+
+ -o outfile   | Write output to `outfile' instead of standard output.
+ -G groups    | Replicates in test and control groups, e.g. 1,2,3:4-6.
+ -w winsize   | Set window size (default: {}).
+ -t minsites  | Minimum number of sites in window for each replicate (default: {}).
+ -r minreps   | Minimum number of replicates in each group (default: {}).
+ -d methdiff  | Minimum difference of methylation rates (default: {}).
+ -p pval      | P-value threshold (default: {}).
+ -g gap       | Maximum gap for DMR joining (default: {}).
+ -a           | Allow joining of DMRs in different directions.
+
+""".format(self.winsize, self.minsites, self.minreps, self.methdiff, self.pval, self.gap))
+
+    def readChromosomes(self, readers):
+        """Generator returning (chrom, pos, values) for each chromosome in any of the files, where
+`values' is the (sites x replicates) array of all replicates in all files, with NaN for missing
+values. Chromosomes are visited in a single order consistent with all files (see unionChroms), and
+each reader is advanced to the chromosome being processed."""
+        nreps = [ r.nreps for r in readers ]
+        filechroms = [ set(indexedChroms(r.filename, header=True)) for r in readers ]
+        for chrom in unionChroms([ r.filename for r in readers ], header=True):
+            parts = []
+            for (r, n, fc) in zip(readers, nreps, filechroms):
+                if r.stream != None and r.chrom != chrom and chrom in fc:
+                    r.skipToChrom(chrom)
+                if r.stream != None and r.chrom == chrom:
+                    (pos, values) = r.readChromosomeArrays()
+                else:
+                    (pos, values) = (np.zeros(0, dtype=np.int64), np.zeros((0, n)))
+                parts.append((pos, values))
+            if len(parts) == 1:
+                yield (chrom, parts[0][0], parts[0][1])
+                continue
+            # Stack the files side by side, with NaN where a file has no value for a site
+            allpos = np.unique(np.concatenate([ p[0] for p in parts ]))
+            values = np.full((len(allpos), sum(nreps)), np.nan)
+            col = 0
+            for ((pos, v), n) in zip(parts, nreps):
+                values[np.searchsorted(allpos, pos), col:col+n] = v
+                col += n
+            yield (chrom, allpos, values)
+
+    def windowMeans(self, pos, values):
+        """Returns the window numbers and the (windows x replicates) array of per-replicate window
+averages, with NaN where a replicate has fewer than `minsites' sites in a window."""
+        with np.errstate(invalid='ignore'):
+            good = values >= 0
+        (wins, inv) = np.unique(pos // self.winsize, return_inverse=True)
+        sums = np.zeros((len(wins), values.shape[1]))
+        counts = np.zeros((len(wins), values.shape[1]))
+        np.add.at(sums, inv, np.where(good, values, 0.0))
+        np.add.at(counts, inv, good)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.where(counts >= max(self.minsites, 1), sums / counts, np.nan)
+        return (wins, means)
+
+    def groupStats(self, means, cols):
+        """Returns the number of replicates with data, mean and variance of the replicate averages
+in columns `cols' for each window."""
+        m = means[:, cols]
+        good = ~np.isnan(m)
+        n = good.sum(axis=1)
+        x = np.where(good, m, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg = x.sum(axis=1) / n
+            var = np.where(good, m - avg[:, None], 0.0)
+            var = (var * var).sum(axis=1) / (n - 1)
+        return (n, avg, var)
+
+    def scoreWindows(self, chrom, wins, means):
+        """Returns the DMRs in chromosome `chrom', in the format expected by DMRwriter.addDMR()."""
+        (n1, avg1, var1) = self.groupStats(means, self.groups[0])
+        (n2, avg2, var2) = self.groupStats(means, self.groups[1])
+        minreps = max(self.minreps, 2)
+        cand = np.nonzero((n1 >= minreps) & (n2 >= minreps))[0]
+        diff = avg1[cand] - avg2[cand]
+        keep = np.abs(diff) >= self.methdiff
+        cand = cand[keep]
+        diff = diff[keep]
+        (n1, var1, n2, var2) = (n1[cand], var1[cand], n2[cand], var2[cand])
+        df = n1 + n2 - 2
+        sp = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tstat = diff / np.sqrt(sp * (1.0 / n1 + 1.0 / n2))
+        pvals = 2 * scipy.stats.t.sf(np.abs(tstat), df)
+        with np.errstate(invalid='ignore'):
+            keep = pvals <= self.pval
+        result = []
+        for (w, d, pval) in zip(wins[cand][keep].tolist(), diff[keep].tolist(), pvals[keep].tolist()):
+            start = w * self.winsize
+            result.append([chrom, start, start + self.winsize, d, pval])
+        return result
+
+    def findDMRs(self, out):
+        readers = [ MATreader(f) for f in self.matfiles ]
+        if self.groups is None:
+            self.groups = [ list(range(readers[0].nreps)), list(range(readers[0].nreps, readers[0].nreps + readers[1].nreps)) ]
+        nreps = sum([ r.nreps for r in readers ])
+        for c in self.groups[0] + self.groups[1]:
+            if not 0 <= c < nreps:
+                sys.stderr.write("Error: replicate numbers should be between 1 and {}.\n".format(nreps))
+                return 0
+        DW = DMRwriter(out, self.gap*self.winsize, samedir=self.samedir)
+        totfound = 0
+        for (chrom, pos, values) in self.readChromosomes(readers):
+            (wins, means) = self.windowMeans(pos, values)
+            dmrs = self.scoreWindows(chrom, wins, means)
+            for d in dmrs:
+                DW.addDMR(d)
+            sys.stderr.write("{}: {} DMRs\n".format(chrom, len(dmrs)))
+            totfound += len(dmrs)
+        sys.stderr.write("Total: {} DMRs\n".format(totfound))
+        DW.finish()
+        return totfound
+
+    def run(self):
+        if self.outfile:
+            with open(self.outfile, "w") as out:
+                self.findDMRs(out)
+        else:
+            self.findDMRs(sys.stdout)
+
 ### WINAVG
 
+class OutputSet():
+    """A set of output streams written together: write() takes a list with one string for each stream."""
+    streams = []
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def write(self, texts):
+        for (out, text) in zip(self.streams, texts):
+            out.write(text)
+
+    def flush(self):
+        for out in self.streams:
+            out.flush()
+
+def windowStarts(pos, winsize, step):
+    """Returns the start positions of all windows of size `winsize' starting at multiples of `step'
+that contain at least one of the positions in sorted array `pos'."""
+    if len(pos) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Site at position p is in windows kmin..kmax
+    kmin = np.maximum(0, -((winsize - 1 - pos) // step))
+    kmax = pos // step
+    # Merge the (sorted) ranges of consecutive sites when they overlap
+    new = np.concatenate(([True], kmin[1:] > kmax[:-1]))
+    first = np.nonzero(new)[0]
+    lo = kmin[first]
+    hi = kmax[np.append(first[1:], len(pos)) - 1]
+    lengths = hi - lo + 1
+    offsets = np.cumsum(lengths) - lengths
+    ks = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(lo, lengths)
+    return ks * step
+
 class WINAVG(Script.Command):
     """generate a BED file containing average methylation in consecutive windows"""
     _cmd = "winavg"
     winsize = 100
+    winsizes = []  # All window sizes requested with -w
+    step = None    # Distance between window starts (default: window size)
     minsites = 0   # Minimum number of sites in window
     mincov = 4     # Minimum coverage of sites counted
     bedfile = None # Input file
     outfile = None # Output file
+    threads = 1    # Number of chromosomes processed in parallel
+    jump = False   # Only process this chromosome
 
     def parseArgs(self, args):
         next = ""
         for a in args:
             if next == '-w':
-                self.winsize = P.toInt(a)
+                self.winsizes = [ P.toInt(w) for w in a.split(",") ]
+                self.winsize = self.winsizes[0]
                 next = ""
             elif next == '-t':
                 self.minsites = P.toInt(a)
@@ -1052,12 +2101,22 @@ class WINAVG(Script.Command):
             elif next == '-o':
                 self.outfile = a
                 next = ""
-            elif a in ['-w', '-t', '-c', '-o']:
+            elif next == '--step':
+                self.step = P.toInt(a)
+                next = ""
+            elif next == '--threads':
+                self.threads = P.toInt(a)
+                next = ""
+            elif a in ['-w', '-t', '-c', '-o', '--step', '--threads']:
                 next = a
             elif self.bedfile == None:
                 self.bedfile = P.isFile(a)
         if self.bedfile == None:
             P.errmsg(P.NOFILE)
+        if len(self.winsizes) > 1 and not self.outfile:
+            sys.stderr.write("Error: -o is required when specifying more than one window size.\n")
+            return False
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
@@ -1070,64 +2129,96 @@ mcall or cscall; in particular the first four columns should contain chromosome,
 end of site, site % methylation respectively. The output file will also have four columns: 
 chromosome, start of window, end of window, average % methylation in window.
 
+Windows are consecutive by default; use --step to generate overlapping (or spaced) windows.
+Several window sizes can be computed at once, separated by commas: in this case the output
+for each window size W is written to a separate file, obtained by adding .W before the
+extension of `outfile'.
+
 Options:
  
  -o outfile   | Write output to `outfile' instead of standard output.
- -w winsize   | Set window size (default: {}).
+ -w winsize   | Set window size, or comma-separated list of window sizes (default: {}).
+ --step S     | Start a window every S bases (default: window size).
  -t minsites  | Minimum number of sites in window (default: {}).
  -c mincov    | Minimum coverage of sites for -t (default: {}).
+ --threads N  | Process N chromosomes in parallel (uses the .bidx index of the input
+                file, creating it if necessary).
 
 """.format(self.winsize, self.minsites, self.mincov))
 
-    def getAvg(self, data):
-        ngood = 0
-        totCov = 0
-        totC = 0
-
-        for d in data:
-            if d[0] >= self.mincov:
-                ngood += 1
-                totCov += d[0]
-                totC += d[1]
-        if ngood >= self.minsites:
-            return 1.0*totC/totCov
-        else:
-            return False
+    def chromWindows(self, chrom, sites, winsize):
+        """Returns the text of the windows of size `winsize' on chromosome `chrom' and their number.
+`sites' is a tuple of arrays of positions, prefix sums of good sites, coverage and C counts."""
+        (pos, ngood, totcov, totc) = sites
+        step = self.step or winsize
+        starts = windowStarts(pos, winsize, step)
+        lo = np.searchsorted(pos, starts, 'left')
+        hi = np.searchsorted(pos, starts + winsize, 'left')
+        tc = totc[hi] - totc[lo]
+        tcov = totcov[hi] - totcov[lo]
+        keep = ((ngood[hi] - ngood[lo]) >= self.minsites) & (tcov > 0) & (tc > 0)
+        starts = starts[keep].tolist()
+        avgs = (tc[keep] / tcov[keep]).tolist()
+        text = "".join([ "{}\t{}\t{}\t{}\n".format(chrom, st, st + winsize, avg) for (st, avg) in zip(starts, avgs) ])
+        return (text, len(starts))
 
     def winAvg(self, out):
-        BR = BEDreader(self.bedfile)
-        chrom = BR.chrom
-        start = 0
-        end = self.winsize
-        nwins = 0
+        """Write the windows for all window sizes. `out' is an OutputSet with one stream for
+each window size. Windows are found from prefix sums over the sites of each chromosome, so
+the cost does not depend on the window size or on the overlap between windows."""
+        BR = BEDreader(self.bedfile, jump=self.jump)
+        winsizes = self.winsizes or [self.winsize]
         totwins = 0
 
         while BR.stream != None:
-            data = BR.readUntil(chrom, end)
-            if isinstance(data, basestring): # New chrom?
-                sys.stderr.write("{}: {} windows\n".format(chrom, nwins))
-                totwins += nwins
-                nwins = 0
-                chrom = data
-                start = 0
-                end = self.winsize
-            else:
-                if len(data) > 0:
-                    avg = self.getAvg(data)
-                    if avg:
-                        out.write("{}\t{}\t{}\t{}\n".format(chrom, start, end, avg))
-                        nwins += 1
-                start += self.winsize
-                end += self.winsize
-        sys.stderr.write("{}: {} windows\n".format(chrom, nwins))
+            chrom = BR.chrom
+            (pos, cov, c) = BR.readChromosomeArrays()
+            good = cov >= self.mincov
+            sites = (pos,
+                     np.concatenate(([0], np.cumsum(good))),
+                     np.concatenate(([0.0], np.cumsum(np.where(good, cov, 0.0)))),
+                     np.concatenate(([0.0], np.cumsum(np.where(good, c, 0.0)))))
+            texts = []
+            nwins = 0
+            for w in winsizes:
+                (text, n) = self.chromWindows(chrom, sites, w)
+                texts.append(text)
+                nwins += n
+            out.write(texts)
+            sys.stderr.write("{}: {} windows\n".format(chrom, nwins))
+            totwins += nwins
+            if self.jump:
+                break
         sys.stderr.write("Total: {} windows\n".format(totwins))
+        return totwins
+
+    def chromJob(self, chrom):
+        self.jump = chrom
+        outs = [ StringIO() for w in (self.winsizes or [self.winsize]) ]
+        n = self.winAvg(OutputSet(outs))
+        return (chrom, [ o.getvalue() for o in outs ], n)
+
+    def outputFilenames(self):
+        if len(self.winsizes) > 1:
+            (base, ext) = os.path.splitext(self.outfile)
+            return [ "{}.{}{}".format(base, w, ext) for w in self.winsizes ]
+        return [self.outfile]
 
     def run(self):
         if self.outfile:
-            with open(self.outfile, "w") as out:
-                self.winAvg(out)
+            streams = [ open(f, "w") for f in self.outputFilenames() ]
         else:
-            self.winAvg(sys.stdout)
+            streams = [sys.stdout]
+        out = OutputSet(streams)
+        try:
+            if self.threads > 1:
+                runParallel(self, indexedChroms(self.bedfile), out, self.threads, "windows")
+            else:
+                self.winAvg(out)
+        finally:
+            if self.outfile:
+                for s in streams:
+                    s.close()
 
 ### WINMAT
 
@@ -1138,6 +2229,9 @@ class WINMAT(Script.Command):
     minsites = 0   # Minimum number of sites in window
     matfile = None # Input file
     outfile = None # Output file
+    threads = 1    # Number of chromosomes processed in parallel
+    jump = False   # Only process this chromosome
+    chunksize = 100000 # Number of rows read at a time
 
     def parseArgs(self, args):
         next = ""
@@ -1151,12 +2245,19 @@ class WINMAT(Script.Command):
             elif next == '-o':
                 self.outfile = a
                 next = ""
-            elif a in ['-w', '-t', '-o']:
+            elif next == '-n':
+                self.chunksize = P.toInt(a)
+                next = ""
+            elif next == '--threads':
+                self.threads = P.toInt(a)
+                next = ""
+            elif a in ['-w', '-t', '-o', '-n', '--threads']:
                 next = a
             elif self.matfile == None:
                 self.matfile = P.isFile(a)
         if self.matfile == None:
             P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
@@ -1171,54 +2272,126 @@ Options:
  -o outfile   | Write output to `outfile' instead of standard output.
  -w winsize   | Set window size (default: {}).
  -t minsites  | Minimum number of sites in window (default: {}).
+ -n N         | Read N rows of the input file at a time (default: {}).
+ --threads N  | Process N chromosomes in parallel (uses the .bidx index of the input
+                file, creating it if necessary).
+
+""".format(self.winsize, self.minsites, self.chunksize))
+
+    def writeWindows(self, out, chroms, pos, values):
+        """Write the averages of the positive values in the windows containing the sites in the
+given arrays. Returns the chromosome of each window written."""
+        win = pos // self.winsize
+        brk = np.nonzero((chroms[1:] != chroms[:-1]) | (win[1:] != win[:-1]))[0] + 1
+        starts = np.concatenate(([0], brk))
+        gid = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(pos))))
+        with np.errstate(invalid='ignore'):
+            good = values > 0
+        sums = np.zeros((len(starts), values.shape[1]))
+        cnts = np.zeros((len(starts), values.shape[1]), dtype=int)
+        np.add.at(sums, gid, np.where(good, values, 0.0))
+        np.add.at(cnts, gid, good)
+        wchroms = chroms[starts].tolist()
+        wstarts = (win[starts] * self.winsize).tolist()
+        sums = sums.tolist()
+        cnts = cnts.tolist()
+        for w in range(len(starts)):
+            avgs = [ str(s/c if c > 0 else 0) for (s, c) in zip(sums[w], cnts[w]) ]
+            out.write("{}\t{}\t{}\t{}\n".format(wchroms[w], wstarts[w], wstarts[w] + self.winsize, "\t".join(avgs)))
+        return wchroms
+
+    def winMat(self, out, header=True):
+        reader = MATchunks(self.matfile, chunksize=self.chunksize, chrom=self.jump or None)
+        counts = OrderedDict()  # Number of windows by chromosome
+        carry = None            # Sites of last window in previous chunk, may continue in next chunk
+
+        if header:
+            out.write("#Chrom\tStart\tEnd\t" + "\t".join(reader.hdr[4:]) + "\n")
+        for chunk in reader:
+            if carry:
+                chunk = [ np.concatenate((c, d)) for (c, d) in zip(carry, chunk) ]
+            (chroms, pos, values) = chunk
+            # Hold back the last window, it may continue in the next chunk
+            last = len(pos) - 1
+            while last > 0 and chroms[last-1] == chroms[-1] and pos[last-1] // self.winsize == pos[-1] // self.winsize:
+                last -= 1
+            carry = (chroms[last:], pos[last:], values[last:])
+            if last > 0:
+                for chrom in self.writeWindows(out, chroms[:last], pos[:last], values[:last]):
+                    counts[chrom] = counts.get(chrom, 0) + 1
+        if carry:
+            for chrom in self.writeWindows(out, *carry):
+                counts[chrom] = counts.get(chrom, 0) + 1
+        for chrom in counts:
+            sys.stderr.write("{}: {} windows\n".format(chrom, counts[chrom]))
+        totwins = sum(counts.values())
+        sys.stderr.write("Total: {} windows\n".format(totwins))
+        return totwins
 
-""".format(self.winsize, self.minsites))
-    
-    def winMat(self, out):
-        BR = MATreader(self.matfile)
-        chrom = BR.chrom
-        start = 0
-        end = self.winsize
-        nwins = 0
-        totwins = 0
+    def chromJob(self, chrom):
+        self.jump = chrom
+        out = StringIO()
+        n = self.winMat(out, header=False)
+        return (chrom, out.getvalue(), n)
 
-        out.write("#Chrom\tStart\tEnd\t" + "\t".join(BR.hdr[4:]) + "\n")
-        while BR.stream != None:
-            data = BR.readUntil(chrom, end)
-            if isinstance(data, basestring): # New chrom?
-                sys.stderr.write("{}: {} windows\n".format(chrom, nwins))
-                totwins += nwins
-                nwins = 0
-                chrom = data
-                start = 0
-                end = self.winsize
-            else:
-                nd = len(data)
-                if nd > 0:
-                    sums = [0]*BR.nreps
-                    cnts = [0]*BR.nreps
-                    for d in data:
-                        for i in range(BR.nreps):
-                            v = d[i]
-                            if v != 'NA':
-                                v = float(v)
-                                if v > 0:
-                                    sums[i] += float(d[i])
-                                    cnts[i] += 1
-                    avgs = [ str(sums[i]/cnts[i] if cnts[i] > 0 else 0) for i in range(BR.nreps) ]
-                    out.write("{}\t{}\t{}\t{}\n".format(chrom, start, end, "\t".join(avgs)))
-                    nwins += 1
-                start += self.winsize
-                end += self.winsize
-        sys.stderr.write("{}: {} windows\n".format(chrom, nwins))
-        sys.stderr.write("Total: {} windows\n".format(totwins))
+    def winMatParallel(self, out):
+        hdr = MATchunks(self.matfile).hdr
+        out.write("#Chrom\tStart\tEnd\t" + "\t".join(hdr[4:]) + "\n")
+        runParallel(self, indexedChroms(self.matfile, header=True), out, self.threads, "windows")
 
     def run(self):
+        if self.threads > 1:
+            finder = self.winMatParallel
+        else:
+            finder = self.winMat
         if self.outfile:
             with open(self.outfile, "w") as out:
-                self.winMat(out)
+                finder(out)
         else:
-            self.winMat(sys.stdout)
+            finder(sys.stdout)
+
+### PACK
+
+class PACK(Script.Command):
+    """convert a methylation BED file or -mat file to a binary store"""
+    _cmd = "pack"
+    infile = None
+    outfile = None
+    kind = "bed"
+
+    def parseArgs(self, args):
+        for a in args:
+            if a == '-m':
+                self.kind = "mat"
+            elif self.infile == None:
+                self.infile = P.isFile(a)
+            elif self.outfile == None:
+                self.outfile = a
+        if self.infile == None or self.outfile == None:
+            P.errmsg(P.NOFILE)
+        return True
+
+    def usage(self, parent, out=sys.stdout):
+        out.write("""dmaptools.py - Operate on methylation data.
+
+Usage: dmaptools.py pack [options] infile outfile
+
+Convert the methylation BED file (in the format produced by mcall or cscall) or -mat
+file `infile' to a binary store in `outfile'. The store contains per-chromosome arrays
+of positions, coverage and methylated counts (or per-replicate values for -mat files)
+that are memory-mapped when read, and can be used in place of the original file by
+the dmr, dmr2, dodmeth (columns 4 to 6), winavg, winmat and regavg commands.
+
+Options:
+
+ -m           | Input is a -mat file.
+
+""")
+
+    def run(self):
+        sys.stderr.write("Packing `{}' into `{}'... ".format(self.infile, self.outfile))
+        n = packMethFile(self.infile, self.outfile, kind=self.kind)
+        sys.stderr.write("done, {} sites.\n".format(n))
 
 ### CMERGE
 
@@ -1231,6 +2404,7 @@ class CMERGE(Script.Command):
     outfile = None
     missing = "NA"
     skiphdr = False
+    stream = False
 
     def parseArgs(self, args):
         self.filenames = []
@@ -1249,10 +2423,13 @@ class CMERGE(Script.Command):
                 next = a
             elif a == '-s':
                 self.skiphdr = True
+            elif a == '-m':
+                self.stream = True
             else:
                 self.filenames.append(P.isFile(a))
         if len(self.filenames) == 0:
             P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
@@ -1271,29 +2448,46 @@ Options:
  -c targetcol | Specify column containing values to be merged (default: {}).
  -x missing   | Value to use for missing elements (default: {}).
  -s           | Skip first row in each input file (default: False).
+ -m           | Streaming mode: merge files on the fly instead of loading them in memory. All input
+                files should be sorted by position, with chromosomes in the same order (a chromosome
+                may be missing from some of the files).
 
-""".format(self.targetcol, self.missing))
+""".format(self.targetcol + 1, self.missing))
 
     def run(self):
-        self.colmerger = ColMerger(self.filenames, self.targetcol, self.skiphdr)
-        self.colmerger.parseAllSources()
-        if self.outfile:
-            sys.stderr.write("Writing merged file to {}\n".format(self.outfile))
-            with open(self.outfile, "w") as out:
-                self.colmerger.writeMerged(out)
+        self.colmerger = ColMerger(self.filenames, self.targetcol, self.skiphdr, missing=self.missing)
+        if self.stream:
+            merge = self.colmerger.streamMerged
         else:
-            self.colmerger.writeMerged(sys.stdout)
+            self.colmerger.parseAllSources()
+            merge = self.colmerger.writeMerged
+        try:
+            if self.outfile:
+                sys.stderr.write("Writing merged file to {}\n".format(self.outfile))
+                with open(self.outfile, "w") as out:
+                    merge(out)
+            else:
+                merge(sys.stdout)
+        except ValueError as e:
+            sys.stderr.write("Error: {}\n".format(e))
+            sys.exit(1)
 
 ### REGAVG
 
+def roundHalfUp(x):
+    """Round the non-negative values in array `x' to the nearest integer, with halves rounded up
+(like Python's round()). Returns an integer array."""
+    r = np.floor(x)
+    return (r + ((x - r) >= 0.5)).astype(np.int64)
+
 class REGAVG(Script.Command):
     """compute average methylation over a set of regions"""
     _cmd = "regavg"
-    bedfile   = None
+    bedfiles  = []
     regfile   = None
     outfile   = None
     genesfile = None            # File containing names of genes represented in output
-    label     = None
+    labels    = []
 
     # Sizes
     vectsize = 1000             # Size of vector representing transcript
@@ -1302,15 +2496,19 @@ class REGAVG(Script.Command):
     winsize  = 40               # Smooting window size
     scaled   = True             # If false, up/down regions are not scaled
 
+    txblock  = 5000             # Number of regions processed at once
+
     # Computed
     margfact = 0.0
     totsize = 0                 # Length of averages vector
-    vector = None
+    vector = None               # Accumulators, shape (samples, 2, totsize)
     regreader = None
-    bedreader = None
+    bedreaders = []
+    bedchroms = []              # Chromosomes not yet read from each bed file
 
     def parseArgs(self, args):
         prev = ""
+        self.bedfiles = []
         for a in args:
             if prev == '-o':
                 self.outfile = a
@@ -1328,7 +2526,7 @@ class REGAVG(Script.Command):
                 self.winsize = P.toInt(a)
                 prev = ""
             elif prev == "-l":
-                self.label = a
+                self.labels = a.split(",")
                 prev = ""
             elif prev == "-g":
                 self.genesfile = a
@@ -1337,35 +2535,46 @@ class REGAVG(Script.Command):
                 prev = a
             elif a == "-f":
                 self.scaled = False
-            elif self.bedfile is None:
-                self.bedfile = P.isFile(a)
             else:
-                self.regfile = P.isFile(a)
+                self.bedfiles.append(P.isFile(a))
+        if len(self.bedfiles) < 2:
+            return P.errmsg(P.NOFILE)
+        self.regfile = self.bedfiles.pop()
+        if self.labels and len(self.labels) != len(self.bedfiles):
+            sys.stderr.write("Error: -l should specify one label for each bed file.\n")
+            return False
         if self.scaled:
             self.margfact = 1.0 * self.margsize / self.vectsize
         else:
             self.margfact = 1.0 * self.margsize / self.upsizebp
         self.totsize = self.margsize + self.vectsize + self.margsize
             
-        self.vector = np.zeros((2, self.totsize))
+        self.vector = np.zeros((len(self.bedfiles), 2, self.totsize))
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
 
-Usage: dmaptools.py regavg [options] bedfile regionsfile
+Usage: dmaptools.py regavg [options] bedfiles... regionsfile
 
 Compute average methylation over a set of regions (e.g. gene transcripts) mapping
-site positions to a fixed-size vector. File `bedfile' should have at least four
+site positions to a fixed-size vector. Each of the `bedfiles' should have at least four
 columns: chromosome, site start, site end, methylation. File `regionsfile' should 
 have at least four columns: chromsome, region start, region end, strand (+ or -). 
+All files should be sorted, with chromosomes in the same order. Chromosomes may be
+missing from some of the files.
 
-Output is tab-delimited with three columns: position, average methylation at that 
-position, moving average at that position (computed over a window extending S 
-positions in both directions, where S is specified with the -s option).
+Output is tab-delimited with two columns for position followed by two columns for
+each bed file: average methylation at that position, moving average at that position
+(computed over a window extending S positions in both directions, where S is specified
+with the -s option). The mapping of sites to positions is computed once for all bed
+files.
 
 Options:
 
   -o O | Write results to file O (default: stdout).
+  -l L | Comma-separated list of labels for the bed files, used in the header line.
+  -g G | Write names of regions containing at least one site to file G.
   -w W | Map regions to a vector of size W (default: {}).
   -m M | Map up/downstream of region to a vector of size M (default: {}).
   -s S | Use smooting window of S positions (default: {}).
@@ -1376,8 +2585,12 @@ Options:
 """.format(self.vectsize, self.margsize, self.winsize, self.upsizebp))
 
     def run(self):
-        self.bedreader = METHreader(self.bedfile, skipHdr=False)
-        self.bedreader.readNext()
+        self.bedreaders = []
+        for bedfile in self.bedfiles:
+            br = METHreader(bedfile, skipHdr=False)
+            br.readNext()
+            self.bedreaders.append(br)
+        self.bedchroms = [ set(indexedChroms(bedfile)) for bedfile in self.bedfiles ]
         self.regreader = REGreader(self.regfile, skipHdr=False)
         self.regreader.readNext()
         totst = 0               # Total number of sites
@@ -1396,40 +2609,25 @@ Options:
                 regions = self.regreader.readChromosome()
                 if regions is None:
                     break
-                sites = self.bedreader.readChromosome()
-                if not sites:
-                    continue
                 chrom = regions[0][0]
-                nst = len(sites)
+                sites = self.readSites(chrom)
+                if sites is None:
+                    continue
+                nst = len(sites[0])
                 ntx = len(regions)
                 totst += nst
                 tottx += ntx
                 ns = 0
                 nt = 0
-                
-                for tx in regions:
-                    found = False
-                    txlen = tx[2] - tx[1]
-                    if self.scaled:
-                        updn = int(txlen * self.margfact)
-
-                    p1 = tx[1] - updn
-                    p2 = tx[2] + updn
-                    for site in sites:
-                        if site[1] > p2:
-                            break
-                        if site[1] >= p1:
-                            if self.scaled:
-                                self.storeSite(site, p1, p2, tx[3])
-                            else:
-                                self.storeSiteFixed(site, tx)
-                            ns += 1
-                            if not found:
-                                found = True
-                                if genesout:
-                                    genesout.write("{}\n".format(tx[4]))
-                    if found:
-                        nt += 1
+
+                for b in range(0, ntx, self.txblock):
+                    block = regions[b:b+self.txblock]
+                    (bns, found) = self.storeRegions(block, sites)
+                    ns += bns
+                    nt += len(found)
+                    if genesout:
+                        for i in found:
+                            genesout.write("{}\n".format(block[i][4]))
                 sys.stderr.write("{}\t{}\t{}\t{}\t{}\n".format(chrom, ntx, nst, nt, ns))
                 totns += ns
                 totnt += nt
@@ -1444,63 +2642,133 @@ Options:
         else:
             self.writeResults(sys.stdout)
 
+    def readSites(self, chrom):
+        """Read the sites in chromosome `chrom' from all bed files, advancing each of them to `chrom'
+by name. Returns a tuple containing the sorted union of their positions and a (samples x positions)
+matrix of methylation values, with NaN where a sample has no site, or None if there are no sites."""
+        data = []
+        for (br, chroms) in zip(self.bedreaders, self.bedchroms):
+            if chrom not in chroms:
+                data.append(None)
+                continue
+            chroms.remove(chrom)
+            br.skipToChrom(chrom)
+            if br.stream is None:
+                data.append(None)
+                continue
+            sites = br.readChromosomeArrays()
+            if sites is None or len(sites[0]) == 0:
+                data.append(None)
+            else:
+                data.append(sites)
+        present = [ d for d in data if d is not None ]
+        if not present:
+            return None
+        if len(data) == 1:
+            (spos, smeth) = present[0]
+            return (spos, smeth.reshape(1, -1))
+        spos = np.unique(np.concatenate([ d[0] for d in present ]))
+        smeth = np.full((len(data), len(spos)), np.nan)
+        for i in range(len(data)):
+            if data[i] is not None:
+                smeth[i, np.searchsorted(spos, data[i][0])] = data[i][1]
+        return (spos, smeth)
+
+    def storeRegions(self, regions, sites):
+        """Add the sites (a tuple of the array of positions and the samples x positions matrix of
+methylation values) falling in `regions' (or in their up/downstream regions) to the accumulator
+vectors. The first site of each region is found by binary search. Returns the number of sites
+stored and the indexes of the regions containing at least one site."""
+        (spos, smeth) = sites
+        txstart = np.array([ tx[1] for tx in regions ], dtype=np.int64)
+        txend = np.array([ tx[2] for tx in regions ], dtype=np.int64)
+        minus = np.array([ tx[3] == '-' for tx in regions ], dtype=bool)
+        if self.scaled:
+            updn = ((txend - txstart) * self.margfact).astype(np.int64)
+        else:
+            updn = self.upsizebp
+        p1 = txstart - updn
+        p2 = txend + updn
+        first = np.searchsorted(spos, p1, 'left')
+        nsites = np.searchsorted(spos, p2, 'right') - first
+        nsites[p2 == p1] = 0    # zero-length region, can't be scaled
+        if not self.scaled:
+            nsites[txend == txstart] = 0
+        found = np.nonzero(nsites)[0]
+        total = int(np.sum(nsites))
+        if total == 0:
+            return (0, found)
+
+        # One entry for each (region, site) pair, in region order
+        rx = np.repeat(np.arange(len(regions)), nsites)
+        sx = np.arange(total) - np.repeat(np.cumsum(nsites) - nsites, nsites) + first[rx]
+        p = spos[sx].astype(np.int64)
+        if self.scaled:
+            frac = (p - p1[rx]).astype(float) / (p2 - p1)[rx]
+            frac[minus[rx]] = 1.0 - frac[minus[rx]]
+            idx = roundHalfUp(frac * (self.totsize - 1))
+        else:
+            s = txstart[rx]
+            e = txend[rx]
+            m = minus[rx]
+            up = p < s
+            down = p > e
+            inside = ~(up | down)
+            d = np.where(up, s - p, p - e)
+            r = roundHalfUp(d * self.margfact)
+            after = self.margsize + self.vectsize + r - 1
+            before = self.margsize - r
+            idx = np.where(up ^ m, before, after)
+            frac = (p[inside] - s[inside]).astype(float) / (e - s)[inside]
+            frac[m[inside]] = 1.0 - frac[m[inside]]
+            idx[inside] = self.margsize + roundHalfUp(frac * (self.vectsize - 1))
+            idx[idx == self.totsize] = self.totsize - 1 # hack
+        for i in range(len(smeth)):
+            m = smeth[i][sx]
+            good = ~np.isnan(m)
+            if good.all():
+                np.add.at(self.vector[i][0], idx, m)
+                np.add.at(self.vector[i][1], idx, 1)
+            else:
+                np.add.at(self.vector[i][0], idx[good], m[good])
+                np.add.at(self.vector[i][1], idx[good], 1)
+        return (total, found)
+
+    def averages(self, vector):
+        """Returns the averages and moving averages for accumulator `vector'."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avgs = vector[0] / vector[1]
+            mavgs = np.zeros(self.totsize)
+            csum = np.concatenate(([0.0], np.cumsum(vector[0])))
+            ccnt = np.concatenate(([0.0], np.cumsum(vector[1])))
+            idx = np.arange(self.winsize, self.totsize - self.winsize)
+            mavgs[idx] = (csum[idx+self.winsize] - csum[idx-self.winsize]) / (ccnt[idx+self.winsize] - ccnt[idx-self.winsize])
+        return (avgs.tolist(), mavgs.tolist())
+
     def writeResults(self, stream):
-        if self.label:
-            stream.write("#Position\tTX\t{} - average\t{} - moving average\n".format(self.label, self.label))
+        labels = self.labels
+        if not labels and len(self.bedfiles) > 1:
+            labels = self.bedfiles
+        if labels:
+            stream.write("#Position\tTX\t" + "\t".join([ "{} - average\t{} - moving average".format(l, l) for l in labels ]) + "\n")
         else:
             stream.write("#Position\tTX\taverage\tmoving average\n")
-        avgs = self.vector[0] / self.vector[1]
-        mavgs = np.zeros(self.totsize)
+        results = [ self.averages(v) for v in self.vector ]
         b = self.totsize - self.margsize
-        for idx in range(self.winsize, self.totsize - self.winsize):
-            mavgs[idx] = sum(self.vector[0][idx-self.winsize:idx+self.winsize]) / sum(self.vector[1][idx-self.winsize:idx+self.winsize]) 
         for idx in range(self.totsize):
             if self.margsize < idx < b:
                 tx = "0"
             else:
                 tx = "."
-            if mavgs[idx] == 0.0:
-                stream.write("{}\t{}\t{}\t\n".format(idx - self.margsize, tx, avgs[idx]))
-            else:
-                stream.write("{}\t{}\t{}\t{}\n".format(idx - self.margsize, tx, avgs[idx], mavgs[idx]))
-
-    def storeSite(self, site, p1, p2, strand):
-        size = p2 - p1
-        frac = 1.0 * (site[1] - p1) / size
-        if strand == '-':
-            frac = 1.0 - frac
-        idx = int(round(frac * (self.totsize - 1)))
-        self.vector[0][idx] += site[2]
-        self.vector[1][idx] += 1
-
-    def storeSiteFixed(self, site, tx):
-        p = site[1]
-        if p < tx[1]:
-            d = (tx[1] - p)
-            # sys.stderr.write("d = {}\n".format(d))
-            if tx[3] == '+':
-                idx = self.margsize - int(round(d * self.margfact))
-            else:
-                idx = self.margsize + self.vectsize + int(round(d * self.margfact)) - 1
-        elif p > tx[2]:
-            d = (p - tx[2])
-            # sys.stderr.write("d = {}\n".format(d))
-            if tx[3] == '+':
-                idx = self.margsize + self.vectsize + int(round(d * self.margfact)) - 1
-            else:
-                idx = self.margsize - int(round(d * self.margfact))
-        else:
-            size = tx[2] - tx[1]
-            frac = 1.0 * (site[1] - tx[1]) / size
-            if tx[3] == '-':
-                frac = 1.0 - frac
-            idx = self.margsize + int(round(frac * (self.vectsize - 1)))
-        if idx == self.totsize:
-            idx = self.totsize - 1 # hack
-        # sys.stderr.write("Idx = {}\n".format(idx))
-        self.vector[0][idx] += site[2]
-        self.vector[1][idx] += 1
-        
+            row = [str(idx - self.margsize), tx]
+            for (avgs, mavgs) in results:
+                row.append(str(avgs[idx]))
+                if mavgs[idx] == 0.0:
+                    row.append("")
+                else:
+                    row.append(str(mavgs[idx]))
+            stream.write("\t".join(row) + "\n")
+
 ### Correlation of methylation values
 
 class Colpair():                # Used by CORR
@@ -1508,14 +2776,55 @@ class Colpair():                # Used by CORR
     col2 = None
     name1 = ""
     name2 = ""
-    v1 = []
-    v2 = []
 
     def __init__(self, c1, c2):
-        self.col1 = c1 + 3
-        self.col2 = c2 + 3
-        self.v1 = []
-        self.v2 = []
+        self.col1 = c1 - 1
+        self.col2 = c2 - 1
+
+class CoMoments():
+    """Streaming accumulators for the correlation between all pairs of columns of a matrix, using
+pairwise-complete observations (NaN marks a missing value). For each pair (i, j) we keep the number
+of rows where both columns are present, the mean and sum of squared deviations of column i over
+those rows, and the co-moment of i and j. Chunks are combined with the pairwise update formula, so
+memory only depends on the number of columns."""
+    ncols = 0
+    n = None
+    mean = None
+    m2 = None
+    cm = None
+
+    def __init__(self, ncols):
+        self.ncols = ncols
+        self.n = np.zeros((ncols, ncols))
+        self.mean = np.zeros((ncols, ncols))
+        self.m2 = np.zeros((ncols, ncols))
+        self.cm = np.zeros((ncols, ncols))
+
+    def add(self, values):
+        """Add the rows of (rows x ncols) array `values' to the accumulators."""
+        good = ~np.isnan(values)
+        M = good.astype(float)
+        V = np.where(good, values, 0.0)
+        nb = M.T.dot(M)
+        sx = V.T.dot(M)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mb = np.where(nb > 0, sx / nb, 0.0)
+        m2b = (V*V).T.dot(M) - sx * mb
+        cmb = V.T.dot(V) - sx * mb.T
+        cmb = (cmb + cmb.T) / 2
+        na = self.n
+        n = na + nb
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.where(n > 0, na * nb / n, 0.0)
+            d = mb - self.mean
+            self.mean = np.where(n > 0, self.mean + d * nb / n, 0.0)
+        self.m2 += m2b + d * d * f
+        self.cm += cmb + d * d.T * f
+        self.n = n
+
+    def correlation(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.cm / np.sqrt(self.m2 * self.m2.T)
 
 class CORR(Script.Command):
     """compute correlation between methylation levels of replicates of a condition"""
@@ -1523,14 +2832,19 @@ class CORR(Script.Command):
     matfile = None
     outfile = None
     colpairs = []
+    chunksize = 100000
 
     def parseArgs(self, args):
         prev = ""
+        self.colpairs = []
         for a in args:
             if prev == "-o":
                 self.outfile = a
                 prev = ""
-            elif a == "-o":
+            elif prev == "-n":
+                self.chunksize = P.toInt(a)
+                prev = ""
+            elif a in ["-o", "-n"]:
                 prev = a
             elif self.matfile is None:
                 self.matfile = P.isFile(a)
@@ -1539,10 +2853,33 @@ class CORR(Script.Command):
                 if pair:
                     cp = Colpair(pair[0], pair[1])
                     self.colpairs.append(cp)
+        if self.matfile is None:
+            P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
-        out.write("TBW\n")
-        
+        out.write("""dmaptools.py - Operate on methylation data.
+
+Usage: dmaptools.py corr [options] matfile [pairs...]
+
+Compute the correlation between the methylation levels of the replicates in `matfile'.
+Each pair should be of the form P,Q where P and Q are replicate numbers (starting at 1).
+For each pair, the output reports the number of sites where both replicates have a
+value, the mean of each replicate over those sites, and their correlation.
+
+If no pairs are specified, the output contains the correlation matrix for all pairs
+of replicates, followed by the matrix of the number of sites used for each pair.
+
+Missing (NA) and negative values are ignored, separately for each pair. The file is
+read in a single pass, in chunks.
+
+Options:
+
+  -o O | Write results to file O (default: stdout).
+  -n N | Read N rows at a time (default: {}).
+
+""".format(self.chunksize))
+
     def splitCols(self, s):
         pieces = s.split(",")
         if len(pieces) == 2:
@@ -1551,39 +2888,58 @@ class CORR(Script.Command):
                 b = int(pieces[1])
                 return (a, b)
             except:
-                sys.stderr.write("Warning: argument `{}' should be of the form P,Q where P and Q are column numbers.\n")
+                pass
+        sys.stderr.write("Warning: argument `{}' should be of the form P,Q where P and Q are column numbers.\n".format(s))
         return None
 
-    def run(self):
-        name1 = ""
-        name2 = ""
-        v1 = []
-        v2 = []
-
-        with open(self.matfile, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            hdr = c.next()
-            for cp in self.colpairs:
-                cp.name1 = hdr[cp.col1]
-                cp.name2 = hdr[cp.col2]
-            for line in c:
-                for cp in self.colpairs:
-                    x1 = float(line[cp.col1])
-                    x2 = float(line[cp.col2])
-                    if x1 >= 0 and x2 >= 0:
-                        cp.v1.append(x1)
-                        cp.v2.append(x2)
+    def accumulate(self):
+        reader = MATchunks(self.matfile, chunksize=self.chunksize)
+        acc = CoMoments(reader.ncols)
+        nsites = 0
+        for (chroms, pos, values) in reader:
+            with np.errstate(invalid='ignore'):
+                values = np.where(values >= 0, values, np.nan)
+            acc.add(values)
+            nsites += len(pos)
+        sys.stderr.write("{} sites read from `{}'.\n".format(nsites, self.matfile))
+        return (reader.hdr[reader.first:], acc)
+
+    def writePairs(self, out, names, acc):
+        cc = acc.correlation().tolist()
+        for cp in self.colpairs:
+            (i, j) = (cp.col1, cp.col2)
+            out.write("Sample1:\t{}\n".format(names[i]))
+            out.write("Sample2:\t{}\n".format(names[j]))
+            out.write("Num sites:\t{}\n".format(int(acc.n[i,j])))
+            out.write("Mean1:\t{}\n".format(float(acc.mean[i,j])))
+            out.write("Mean2:\t{}\n".format(float(acc.mean[j,i])))
+            out.write("Correlation:\t{}\n\n".format(cc[i][j]))
+
+    def writeMatrix(self, out, names, acc):
+        cc = acc.correlation().tolist()
+        counts = acc.n.astype(int).tolist()
+        out.write("#Correlation\t" + "\t".join(names) + "\n")
+        for i in range(len(names)):
+            out.write(names[i] + "\t" + "\t".join([ str(x) for x in cc[i] ]) + "\n")
+        out.write("\n#Sites\t" + "\t".join(names) + "\n")
+        for i in range(len(names)):
+            out.write(names[i] + "\t" + "\t".join([ str(x) for x in counts[i] ]) + "\n")
 
+    def run(self):
+        (names, acc) = self.accumulate()
         for cp in self.colpairs:
-            a1 = np.array(cp.v1, dtype=float)
-            a2 = np.array(cp.v2, dtype=float)
-            cc = np.corrcoef(a1, a2)
-            sys.stdout.write("Sample1:\t{}\n".format(cp.name1))
-            sys.stdout.write("Sample2:\t{}\n".format(cp.name2))
-            sys.stdout.write("Num sites:\t{}\n".format(len(a1)))
-            sys.stdout.write("Mean1:\t{}\n".format(np.mean(a1)))
-            sys.stdout.write("Mean2:\t{}\n".format(np.mean(a2)))
-            sys.stdout.write("Correlation:\t{}\n\n".format(cc[0,1]))
+            if not (0 <= cp.col1 < len(names) and 0 <= cp.col2 < len(names)):
+                sys.stderr.write("Error: replicate numbers should be between 1 and {}.\n".format(len(names)))
+                return
+        if self.colpairs:
+            write = self.writePairs
+        else:
+            write = self.writeMatrix
+        if self.outfile:
+            with open(self.outfile, "w") as out:
+                write(out, names, acc)
+        else:
+            write(sys.stdout, names, acc)
 
 ### Difference of differential methylation rates.
 
@@ -1595,6 +2951,8 @@ class DIFF(Script.Command):
     outfile = None
     column = 4
     threshold = 0.0
+    threads = 1
+    jump = False
 
     def parseArgs(self, args):
         prev = ""
@@ -1608,7 +2966,10 @@ class DIFF(Script.Command):
             elif prev == "-t":
                 self.threshold = P.toFloat(a)
                 prev = ""
-            elif a in ["-o", "-c", "-t"]:
+            elif prev == "--threads":
+                self.threads = P.toInt(a)
+                prev = ""
+            elif a in ["-o", "-c", "-t", "--threads"]:
                 prev = a
             elif self.bedfile1 is None:
                 self.bedfile1 = P.isFile(a)
@@ -1616,84 +2977,92 @@ class DIFF(Script.Command):
                 self.bedfile2 = P.isFile(a)
         if self.bedfile1 == None or self.bedfile2 == None:
             P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
-        out.write("TBW.\n")
+        out.write("""dmaptools.py - Operate on methylation data.
+
+Usage: dmaptools.py dodmeth [options] bedfile1 bedfile2
+
+Write the difference between the values in column C of `bedfile1' and `bedfile2'
+at all sites present in both files.
+
+Options:
+
+ -o outfile   | Write output to `outfile' instead of standard output.
+ -c C         | Column containing values (default: {}).
+ -t T         | Skip sites with a value lower than T in either file (default: {}).
+ --threads N  | Process N chromosomes in parallel (uses the .bidx index of the input
+                files, creating it if necessary).
+
+""".format(self.column + 1, self.threshold))
 
     def run(self):
+        if self.threads > 1:
+            finder = self.do_difference_parallel
+        else:
+            finder = self.do_difference
         if self.outfile:
             with open(self.outfile, "w") as out:
-                self.do_difference(out)
+                finder(out)
         else:
-            self.do_difference(sys.stdout)
+            finder(sys.stdout)
+
+    def chromList(self):
+        """Returns the chromosomes to process: those present in both files (see commonChroms), or
+only the one being processed by this job."""
+        chroms = commonChroms(self.bedfile1, self.bedfile2, header=True)
+        if self.jump:
+            chroms = [ c for c in chroms if c == self.jump ]
+        return chroms
+
+    def openColumn(self, filename, jump=False):
+        return COLreader(filename, column=self.column, jump=jump)
 
     def do_difference(self, out):
-        with open(self.bedfile1, "r") as f1:
-            with open(self.bedfile2, "r") as f2:
-                f1.readline()
-                f2.readline()
-                r1 = csv.reader(f1, delimiter='\t')
-                r2 = csv.reader(f2, delimiter='\t')
-                (nout, nbad) = self.do_difference_aux(out, r1, r2)
-                sys.stderr.write("{} differences written.\n".format(nout))
-                sys.stderr.write("{} outliers skipped.\n".format(nbad))
-
-    def do_difference_aux(self, out, r1, r2):
+        R1 = self.openColumn(self.bedfile1, jump=self.jump)
+        if self.jump:
+            R2 = self.openColumn(self.bedfile2, jump=self.jump)
+            (nout, nbad) = self.do_difference_aux(out, pairChroms(bedChroms(R1), bedChroms(R2), self.chromList()))
+            if R2.stream != None:
+                R2.close()
+        else:
+            # Serial mode: the second file follows the first by name, without .bidx indexes
+            (nout, nbad) = self.do_difference_aux(out, walkChroms(R1, ChromWalker(self.bedfile2, opener=self.openColumn)))
+        if R1.stream != None:
+            R1.close()
+        sys.stderr.write("{} differences written.\n".format(nout))
+        sys.stderr.write("{} outliers skipped.\n".format(nbad))
+        return nout
+
+    def chromJob(self, chrom):
+        self.jump = chrom
+        out = StringIO()
+        n = self.do_difference(out)
+        return (chrom, out.getvalue(), n)
+
+    def do_difference_parallel(self, out):
+        runParallel(self, self.chromList(), out, self.threads, "differences")
+
+    def do_difference_aux(self, out, pairs):
+        """Write the differences for each pair of tuples (chrom, positions, values) in `pairs'."""
         nout = 0                # Site differences written
         nbad = 0                # Outliers
 
-        line1 = r1.next()
-        line2 = r2.next()
-        chrom = line1[0]        # Assume both start with the same chrom
-        pos1 = int(line1[1])
-        pos2 = int(line2[1])
-        while True:
-            try:
-                if pos1 == pos2:
-                    v1 = float(line1[self.column])
-                    v2 = float(line2[self.column])
-                    if v1 >= self.threshold and v2 >= self.threshold:
-                        diff = v1 - v2
-                        out.write("{}\t{}\t{}\t{}\n".format(chrom, pos1, pos1 + 1, diff))
-                        nout += 1
-                    else:
-                        nbad += 1
-                    line1 = r1.next()
-                    line2 = r2.next()
-                    pos1 = int(line1[1])
-                    pos2 = int(line2[1])
-                elif pos1 < pos2:
-                    line1 = r1.next()
-                    pos1 = int(line1[1])
-                else:
-                    line2 = r2.next()
-                    pos2 = int(line2[1])
-
-                if line1[0] != chrom:
-                    chrom = line1[0]
-                    line2 = self.readUntil(r2, chrom)
-                    pos2 = int(line2[1])
-                elif line2[0] != chrom:
-                    chrom = line2[0]
-                    line1 = self.readUntil(r1, chrom)
-                    pos1 = int(line1[1])
-            except StopIteration:
-                return (nout, nbad)
-
-    def readUntil(self, r, chrom):
-        while True:
-            line = r.next()
-            if line[0] == chrom:
-                return line
+        for ((chrom, pos1, vals1), (_, pos2, vals2)) in pairs:
+            (pos, i1, i2) = joinSites(pos1, pos2)
+            v1 = vals1[i1].astype(float)
+            v2 = vals2[i2].astype(float)
+            good = (v1 >= self.threshold) & (v2 >= self.threshold)
+            pos = pos[good].tolist()
+            diff = (v1[good] - v2[good]).tolist()
+            out.write("".join([ "{}\t{}\t{}\t{}\n".format(chrom, p, p + 1, d) for (p, d) in zip(pos, diff) ]))
+            nout += len(pos)
+            nbad += len(good) - len(pos)
+        return (nout, nbad)
 
 ### For Metilene output
 
-def makePayload(ncols):
-
-    def payload_maker():
-        return [ [0.0, 0] for _ in range(ncols) ]
-    return payload_maker
-
 class DMRAVG(Script.Command):
     """Generate per-sample averages in DMR regions from Metilene output."""
     _cmd = "dmravg"
@@ -1703,6 +3072,9 @@ class DMRAVG(Script.Command):
     data = {}
     ncols = 0
     header = None
+    chunksize = 100000
+    offsets = {}                # Index of the first region of each chromosome in payload
+    payload = None              # Sums and counts, (regions x samples x 2)
 
     def parseArgs(self, args):
         prev = ""
@@ -1710,7 +3082,10 @@ class DMRAVG(Script.Command):
             if prev == "-o":
                 self.outfile = a
                 prev = ""
-            elif a in ["-o"]:
+            elif prev == "-n":
+                self.chunksize = P.toInt(a)
+                prev = ""
+            elif a in ["-o", "-n"]:
                 prev = a
             elif self.dmrfile is None:
                 self.dmrfile = a
@@ -1719,7 +3094,7 @@ class DMRAVG(Script.Command):
         if self.dmrfile and self.matfile:
             return True
         else:
-            P.errmsg(P.nofile)
+            P.errmsg(P.NOFILE)
 
     def run(self):
         self.readDMRs()
@@ -1729,44 +3104,51 @@ class DMRAVG(Script.Command):
     def readDMRs(self):
         self.data = BEDdict(self.dmrfile)
         sys.stderr.write("{} regions read from DMR file {}.\n".format(self.data.nregs, self.dmrfile))
+        self.offsets = {}
+        offset = 0
+        for chrom in self.data.allChroms():
+            self.offsets[chrom] = offset
+            offset += len(self.data.chromRegions(chrom))
 
     def readMatrix(self):
         nsites = 0
         nfound = 0
-        with open(self.matfile, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            self.header = c.next()
-            self.ncols = len(self.header) - 2 
-            self.data.setPayloads(makePayload(self.ncols))
-            for line in c:
-                nsites += 1
-                chrom = line[0]
-                pos = int(line[1])
-                reg = self.data.findPos(chrom, pos)
-                if not reg:
+        reader = MATchunks(self.matfile, chunksize=self.chunksize, first=2, masked=True)
+        self.header = reader.hdr
+        self.ncols = reader.ncols
+        self.payload = np.zeros((self.data.nregs, self.ncols, 2))
+        for (chroms, positions, values) in reader:
+            nsites += len(positions)
+            brk = np.nonzero(chroms[1:] != chroms[:-1])[0] + 1
+            bounds = np.concatenate(([0], brk, [len(positions)])).tolist()
+            good = ~np.ma.getmaskarray(values)
+            values = values.filled(0.0)
+            for (a, b) in zip(bounds[:-1], bounds[1:]):
+                idx = self.data.chromIndex(chroms[a])
+                if idx is None:
                     continue
-
-                # We found a region containing this position
-                nfound += 1
-                col = 2
-                for idx in range(self.ncols):
-                    if line[col] == "NA":
-                        continue
-                    v = float(line[col])
-                    reg.payload[idx][0] += v
-                    reg.payload[idx][1] += 1
-                    col += 1
+                # Each site is looked up by binary search in the interval index, so sites need not be sorted
+                ridx = idx.batchFirst(positions[a:b])
+                found = np.nonzero(ridx >= 0)[0] + a
+                ridx = ridx[ridx >= 0] + self.offsets[chroms[a]]
+                nfound += len(ridx)
+                np.add.at(self.payload[:,:,0], ridx, values[found])
+                np.add.at(self.payload[:,:,1], ridx, good[found])
         sys.stderr.write("{} sites read from file {}.\n{} sites in DMRs.\n".format(nsites, self.matfile, nfound))
 
     def writeOutput(self):
+        sums = self.payload[:,:,0].tolist()
+        counts = self.payload[:,:,1].astype(int).tolist()
         with open(self.outfile, "w") as out:
             out.write("#Chrom\tStart\tEnd\t" + "\t".join(self.header[2:]) + "\n")
+            i = 0
             for chrom in self.data.allChroms():
                 for reg in self.data.chromRegions(chrom):
                     out.write("{}\t{}\t{}".format(reg.chrom, reg.start, reg.end))
-                    for p in reg.payload:
-                        out.write("\t{}".format(p[0] / p[1] if p[1] > 0 else 0))
+                    for (s, n) in zip(sums[i], counts[i]):
+                        out.write("\t{}".format(s / n if n > 0 else 0))
                     out.write("\n")
+                    i += 1
                 
 ### Report average methylation rates by chromosome
 
@@ -1776,9 +3158,13 @@ class BYCHROM(Script.Command):
     bedfiles = []
     labels = []
     nsamples = 0
-    chroms = []
-    data = {}
     outfile = "/dev/stdout"
+    threads = 1                 # Number of files processed in parallel
+    chunksize = 100000
+
+    def __init__(self):
+        self.bedfiles = []
+        self.labels = []
 
     def parseArgs(self, args):
         prev = ""
@@ -1789,84 +3175,94 @@ class BYCHROM(Script.Command):
             elif prev == "-l":
                 self.labels = a.split(",")
                 prev = ""
-            elif a in ["-o", "-l"]:
+            elif prev == "-n":
+                self.chunksize = P.toInt(a)
+                prev = ""
+            elif prev == "--threads":
+                self.threads = P.toInt(a)
+                prev = ""
+            elif a in ["-o", "-l", "-n", "--threads"]:
                 prev = a
             else:
-                self.bedfiles.append(a)
+                self.bedfiles.append(P.isFile(a))
+        if not self.bedfiles:
+            P.errmsg(P.NOFILE)
         self.nsamples = len(self.bedfiles)
         if not self.labels:
             self.labels = [ filenameNoExt(f) for f in self.bedfiles ]
-        self.chroms = []
-        self.data = {}
+        return True
 
     def usage(self, parent, out=sys.stdout):
-        out.write("TBW.\n")
-        
+        out.write("""dmaptools.py - Operate on methylation data.
+
+Usage: dmaptools.py bychr [options] bedfiles...
+
+Write a table containing the average methylation rate of each chromosome in each of the
+specified BED files (total number of C reads over total number of reads, from columns 6
+and 5). Chromosomes whose name contains an underscore are ignored. The table has one row for
+each chromosome appearing in at least one file, in order of first appearance; a chromosome
+missing from a file gets a value of 0.0.
+
+Options:
+
+ -o outfile   | Write output to `outfile' instead of standard output.
+ -l labels    | Comma-separated column labels (default: file names without extension).
+ -n N         | Read N lines at a time (default: {}).
+ --threads N  | Process up to N files in parallel (default: {}).
+
+""".format(self.chunksize, self.threads))
+
     def run(self):
-        self.readFirst()
-        i = 1
-        for bed in self.bedfiles[1:]:
-            self.readOther(bed, i)
-            i += 1
+        nthreads = min(self.threads, len(self.bedfiles))
+        if nthreads > 1:
+            results = runFiles(self, self.bedfiles, nthreads)
+        else:
+            results = [ self.fileJob(bed) for bed in self.bedfiles ]
 
+        chroms = []
+        for sums in results:
+            chroms += [ ch for ch in sums if ch not in chroms ]
         with open(self.outfile, "w") as out:
             out.write("#Chrom\t" + "\t".join(self.labels) + "\n")
-            for ch in self.chroms:
-                cdata = self.data[ch]
+            for ch in chroms:
+                cdata = []
+                for sums in results:
+                    (nr, nc) = sums.get(ch, (0, 0))
+                    cdata.append(float(nc)/nr if nr else 0.0)
                 out.write(ch + "\t" + "\t".join([str(x) for x in cdata]) + "\n")
 
-    def readFirst(self):
-        chrom = ""
-        nr = 0
-        nc = 0
-        sys.stderr.write("Parsing {}... ".format(self.bedfiles[0]))
-        with open(self.bedfiles[0], "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            for line in c:
-                this = line[0]
-                if "_" in this: # Skip "fake" chromosomes
-                    continue
-                if this != chrom: # new chromosome?
-                    if chrom:
-                        # sys.stderr.write("Creating cdata for {}\n".format(chrom))
-                        cdata = [0.0]*self.nsamples
-                        cdata[0] = float(nc)/nr
-                        self.data[chrom] = cdata
-                        nr = 0
-                        nc = 0
-                    self.chroms.append(this)
-                    chrom = this
-                nr += int(line[4])
-                nc += int(line[5])
-            cdata = [0.0]*self.nsamples
-            cdata[0] = float(nc)/nr
-            self.data[chrom] = cdata
-        sys.stderr.write("done.\n")
-
-    def readOther(self, filename, i):
-        chrom = ""
-        nr = 0
-        nc = 0
-        sys.stderr.write("Parsing {}... ".format(filename))
+    def readChunks(self, f):
+        """Yield (chroms, reads, C) arrays for chunks of `chunksize' lines from BED file `f'."""
+        while True:
+            rows = [ line.split("\t", 6) for line in itertools.islice(f, self.chunksize) ]
+            if not rows:
+                return
+            rows = [ r for r in rows if r[0][:1] != "#" ]
+            if rows:
+                yield (np.array([ r[0] for r in rows ]),
+                       np.array([ r[4] for r in rows ]).astype(np.int64),
+                       np.array([ r[5] for r in rows ]).astype(np.int64))
+
+    def chromSums(self, filename):
+        """Returns an OrderedDict mapping each chromosome in `filename' to its total number of
+reads and of C reads."""
+        sums = OrderedDict()
         with open(filename, "r") as f:
-            c = csv.reader(f, delimiter='\t')
-            for line in c:
-                this = line[0]
-                if "_" in this:
-                    continue
-                if this != chrom: # new chromosome?
-                    if chrom:
-                        # sys.stderr.write("Creating cdata for {}\n".format(chrom))
-                        cdata = self.data[chrom]
-                        cdata[i] = float(nc)/nr
-                        nr = 0
-                        nc = 0
-                    chrom = this
-                nr += int(line[4])
-                nc += int(line[5])
-            cdata = self.data[chrom]
-            cdata[i] = float(nc)/nr
-        sys.stderr.write("done.\n")
+            for (chroms, nr, nc) in self.readChunks(f):
+                starts = np.concatenate(([0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1))
+                for (ch, r, c) in zip(chroms[starts].tolist(), np.add.reduceat(nr, starts).tolist(), np.add.reduceat(nc, starts).tolist()):
+                    if "_" in ch: # Skip "fake" chromosomes
+                        continue
+                    if ch in sums:
+                        sums[ch][0] += r
+                        sums[ch][1] += c
+                    else:
+                        sums[ch] = [r, c]
+        sys.stderr.write("Parsing {}... done.\n".format(filename))
+        return sums
+
+    def fileJob(self, filename):
+        return self.chromSums(filename)
 
 # CpG Islands stats
 
@@ -1898,6 +3294,40 @@ class CpGisland():
         else:
             return ""
 
+CPG_CLASSES = ["", "I", "S", "F"]
+
+class CpGzones():
+    """Classification of the positions of a chromosome into island, shore and shelf zones, stored as
+a sorted array of boundaries and the class code (an index into CPG_CLASSES) of the segment starting
+at each boundary. A position is assigned to the first island (in order of start) whose shelf contains
+it, and classified according to that island's zones."""
+    bounds = None
+    codes = None
+
+    def __init__(self, islands):
+        islands = sorted(islands, key=lambda i: i.start)
+        S = np.array([ i.start for i in islands ], dtype=np.int64)
+        E = np.array([ i.end for i in islands ], dtype=np.int64)
+        S2 = np.array([ i.start2 for i in islands ], dtype=np.int64)
+        E2 = np.array([ i.end2 for i in islands ], dtype=np.int64)
+        S3 = np.array([ i.start3 for i in islands ], dtype=np.int64)
+        E3 = np.array([ i.end3 for i in islands ], dtype=np.int64)
+        # The class can only change where a zone starts or ends
+        B = np.unique(np.concatenate((S3, S2, S, E + 1, E2 + 1, E3 + 1)))
+        idx = np.searchsorted(np.maximum.accumulate(E3), B, 'left')
+        ok = idx < np.searchsorted(S3, B, 'right')
+        i = np.where(ok, idx, 0)
+        codes = np.where((S[i] <= B) & (B <= E[i]), 1,
+                         np.where((S2[i] <= B) & (B <= E2[i]), 2,
+                                  np.where((S3[i] <= B) & (B <= E3[i]), 3, 0)))
+        self.bounds = B
+        self.codes = np.where(ok, codes, 0)
+
+    def classify(self, pos):
+        """Returns the class codes of the positions in array `pos'."""
+        j = np.searchsorted(self.bounds, pos, 'right') - 1
+        return np.where(j >= 0, self.codes[j], 0)
+
 class CPGCOUNT(Script.Command):
     """Count number of sites in CpG islands, shores, shelves in one or more BED file."""
     _cmd = "cpg"
@@ -1906,6 +3336,8 @@ class CPGCOUNT(Script.Command):
     cpgdb = {}
     reportfile = "/dev/stdout"
     outfile = True
+    threads = 1
+    chunksize = 100000
 
     def __init__(self):
         self.bedfiles = []
@@ -1914,7 +3346,7 @@ class CPGCOUNT(Script.Command):
     def parseArgs(self, args):
         prev = ""
         for a in args:
-            if prev == "-r":
+            if prev in ["-r", "-o"]:
                 self.reportfile = a
                 prev = ""
             elif prev == "-f":
@@ -1923,7 +3355,10 @@ class CPGCOUNT(Script.Command):
             elif prev == "-e":
                 CpGisland.shore = int(a)
                 prev = ""
-            elif a in ["-r", "-f", "-e"]:
+            elif prev == "--threads":
+                self.threads = P.toInt(a)
+                prev = ""
+            elif a in ["-r", "-o", "-f", "-e", "--threads"]:
                 prev = a
             elif a == "-x":
                 self.outfile = False
@@ -1931,6 +3366,9 @@ class CPGCOUNT(Script.Command):
                 self.cpgfile = a
             else:
                 self.bedfiles.append(a)
+        if self.cpgfile is None or not self.bedfiles:
+            P.errmsg(P.NOFILE)
+        return True
 
     def usage(self, parent, out=sys.stdout):
         out.write("""dmaptools.py - Operate on methylation data.
@@ -1939,74 +3377,97 @@ Usage: dmaptools.py cpg [options] cpgfile bedfiles...
 
 This command reports the number of methylation sites in the specified BED files 
 that fall within or close to the CpG islands defined in `cpgfile'. Sites are classified
-as being internal to the island, in the island shore, or in the island shelf.
+as being internal to the island, in the island shore, or in the island shelf. For each
+BED file, the classified sites are also written to a file with the same name and extension
+.cpg.csv in the current directory.
 
 Options:
 
-  -o O | Write output to file O (default: stdout)
-  -e E | Specify size of CpG island shore (default: {})
-  -f F | Specify size of CpG island shelf (default: {})
+  -o O        | Write output to file O (default: stdout)
+  -e E        | Specify size of CpG island shore (default: {})
+  -f F        | Specify size of CpG island shelf (default: {})
+  -x          | Do not write the .cpg.csv files.
+  --threads N | Process N BED files in parallel.
 
 """.format(CpGisland.shore, CpGisland.shelf))
 
     def run(self):
         self.readCpGfile()
+        if self.threads > 1:
+            results = runFiles(self, self.bedfiles, self.threads)
+        else:
+            results = [ self.fileJob(bed) for bed in self.bedfiles ]
         with open(self.reportfile, "w") as out:
             out.write("#Filename\tSites\tNisland\tNshore\tNshelf\tSitelist\n")
-            for bed in self.bedfiles:
-                (n0, n1, n2, n3, of) = self.countSites(bed)
+            for (bed, (n0, n1, n2, n3, of)) in zip(self.bedfiles, results):
                 out.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(bed, n0, n1, n2, n3, of))
 
     def readCpGfile(self):
+        islands = {}
         with open(self.cpgfile, "r") as f:
             c = csv.reader(f, delimiter='\t')
             for line in c:
                 chrom = line[0]
-                if chrom not in self.cpgdb:
-                    self.cpgdb[chrom] = []
+                if chrom not in islands:
+                    islands[chrom] = []
                 s = CpGisland(int(line[1]), int(line[2]))
-                self.cpgdb[chrom].append(s)
-
-    def findIsland(self, chrom, pos):
-        if chrom not in self.cpgdb:
-            return None
-        ilist = self.cpgdb[chrom]
-        for i in ilist:
-            if i.start3 <= pos <= i.end3:
-                return i
-            if i.start3 > pos:
-                return None
+                islands[chrom].append(s)
+        for chrom in islands:
+            self.cpgdb[chrom] = CpGzones(islands[chrom])
+
+    def classifyChunk(self, chroms, positions):
+        """Returns the class codes of the sites in a chunk."""
+        codes = np.zeros(len(positions), dtype=int)
+        chroms = np.array(chroms)
+        positions = np.array(positions, dtype=np.int64)
+        brk = np.nonzero(chroms[1:] != chroms[:-1])[0] + 1
+        bounds = np.concatenate(([0], brk, [len(positions)])).tolist()
+        for (a, b) in zip(bounds[:-1], bounds[1:]):
+            if chroms[a] in self.cpgdb:
+                codes[a:b] = self.cpgdb[chroms[a]].classify(positions[a:b])
+        return codes
+
+    def countChunk(self, bedfile, chroms, positions, counts, out):
+        codes = self.classifyChunk(chroms, positions)
+        counts += np.bincount(codes, minlength=4)
+        if out:
+            for i in np.nonzero(codes)[0].tolist():
+                out.write("{}\t{}\t{}\t{}\n".format(bedfile, chroms[i], positions[i], CPG_CLASSES[codes[i]]))
 
     def countSites(self, bedfile):
-        n0 = n1 = n2 = n3 = 0
+        n0 = 0
+        counts = np.zeros(4, dtype=int)
         out = None
+        outfilename = ""
         if self.outfile:
             outfilename = filenameNoExt(bedfile) + ".cpg.csv"
             out = open(outfilename, "w")
         try:
             with open(bedfile, "r") as f:
                 c = csv.reader(f, delimiter='\t')
+                chroms = []
+                positions = []
                 for line in c:
-                    chrom = line[0]
                     pos = safeInt(line[1])
                     if pos is None:
                         continue
-                    n0 += 1
-                    island = self.findIsland(chrom, pos)
-                    if island:
-                        x = island.classify(pos)
-                        if x == "I":
-                            n1 += 1
-                        elif x == "S":
-                            n2 += 1
-                        elif x == "F":
-                            n3 += 1
-                        if x and out:
-                            out.write("{}\t{}\t{}\t{}\n".format(bedfile, chrom, pos, x))
+                    chroms.append(line[0])
+                    positions.append(pos)
+                    if len(positions) == self.chunksize:
+                        self.countChunk(bedfile, chroms, positions, counts, out)
+                        n0 += len(positions)
+                        chroms = []
+                        positions = []
+                if positions:
+                    self.countChunk(bedfile, chroms, positions, counts, out)
+                    n0 += len(positions)
         finally:
             if out:
                 out.close()
-        return (n0, n1, n2, n3, outfilename)
+        return (n0, counts[1], counts[2], counts[3], outfilename)
+
+    def fileJob(self, bedfile):
+        return self.countSites(bedfile)
 
 ## window-based DMR analysis:
 ### Params:
@@ -2054,7 +3515,7 @@ class Prog(Script.Script):
 P = Prog("dmaptools.py", version="1.0",
          errors=[('NOCMD', 'Missing command', 'The first argument should be a command name'),
                  ('NOFILE', 'Missing input file(s)', 'One or more input file(s) is missing')])
-P.addCommands([Merger, Averager, Histcomparer, DMR, DMR2, WINAVG, WINMAT, CMERGE, REGAVG, CORR, DIFF, BYCHROM, CPGCOUNT, DMRAVG])
+P.addCommands([Merger, Averager, Histcomparer, DMR, DMR2, DMRMAT, WINAVG, WINMAT, PACK, CMERGE, REGAVG, CORR, DIFF, BYCHROM, CPGCOUNT, DMRAVG])
 
 cmdlist = ""
 for cmd in P._commandNames:
@@ -279,8 +279,8 @@ using gene database `genelist'."""
         names = []
         genes = genelist.allIntersecting(chrom, pos-distance, pos+distance)
         for g in genes:
-            names.append(g[0].name)
-            c = g[0].classifyPosition(pos, distance)
+            names.append(g.name)
+            c = g.classifyPosition(pos, distance)
             if c not in res:
                 res.append(c)
         return (res, names)
@@ -84,14 +84,24 @@ class MakeDB(Script.Command):
 Convert a gene database `dbfile' in gtf/gff/genbank/refFlat format to sqlite3 format. 
 The -o option specifies the output database.
 
-""")
+Options:
+
+  -cp P  | Policy used to choose the canonical transcript of each gene (default: {}). One of:
+           longest - longest transcript;
+           cds     - transcript with the longest CDS (longest transcript for non-coding genes);
+           tag:T   - first transcript with tag T in the gtf/gff file (default: Ensembl_canonical),
+                     or longest transcript if there is none.
+  -rt    | Add R*Tree indexes on gene and transcript positions (faster region and closest queries).
+
+""".format(P.canonicalPolicy))
 
     def run(self, P):
         if len(P.args) == 0:
             P.errmsg(P.NOOUTDB)
         dbfile = P.args[0]
         sys.stderr.write("Saving gene database to {}...\n".format(dbfile))
-        GeneList.initializeDB(dbfile)
+        P.gl.canonicalPolicy = P.canonicalPolicy
+        GeneList.initializeDB(dbfile, indexes=False, rtree=P.rtree)
         ng = P.gl.saveAllToDB(dbfile)
         sys.stderr.write("done, {} genes written.\n".format(ng))
 
@@ -712,6 +722,8 @@ class Prog(Script.Script):
     wanted = ['name']           # Wanted field(s) from db for Annotate
     codingOnly = False          # If True (-pc) only look at protein coding genes in Closest
     canonical = False           # If True (-ca) only look at canonical transcript for each gene in Closest or Classify
+    canonicalPolicy = "longest" # How makedb chooses canonical transcripts (-cp)
+    rtree = False               # If True (-rt) makedb adds R*Tree indexes to the database
     tss = False                 # If True (-ts) use TSS as reference point for distances in Closest
     unclassified = True         # If True, display regions that have no classification. -X disables this.
     bestonly = False            # If True, display best classification only (-b)
@@ -771,7 +783,13 @@ class Prog(Script.Script):
                 self.enhancers = a
                 self.mode = "a"
                 next = ""
-            elif a in ["-db", "-d", "-dup", "-ddn", "-f", "-r", "-x", "-b", "-o", "-c", "-w", "-e"]:
+            elif next == "-cp":
+                if GeneList.getCanonicalPolicy(a):
+                    self.canonicalPolicy = a
+                    next = ""
+                else:
+                    self.errmsg(self.BADPOLICY)
+            elif a in ["-db", "-d", "-dup", "-ddn", "-f", "-r", "-x", "-b", "-o", "-c", "-w", "-e", "-cp"]:
                 next = a
             elif a == '-p':
                 self.positions = True
@@ -791,6 +809,8 @@ class Prog(Script.Script):
                 self.codingOnly = True
             elif a == "-ca":
                 self.canonical = True
+            elif a == "-rt":
+                self.rtree = True
             elif a == "-ts":
                 self.tss = True
             elif a == "-X":
@@ -820,6 +840,7 @@ P = Prog("genes.py", version="1.0",
                  ('NOFILE', 'The input file does not exist.'),
                  ('BADREGION', 'Bad gene region', "Region should be one of b, u, d."),
                  ('NOOUTDB', 'Missing output database filename', "Please specify the name of the output database file."),
+                 ('BADPOLICY', 'Bad canonical policy', "Policy should be one of longest, cds, tag or tag:T."),
                  ('NOCMD', 'Missing command', "Please specify a command."),
                  ('NOSPECS', 'Missing specs', "Please provide at least one gene or region spec.") ])
 P.addCommand(MakeDB)
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+
+### Tests for dmaptools.py. Run with: python -m unittest discover tests
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmaptools
+import Utils
+
+class TempFiles(unittest.TestCase):
+    """Base class for tests that write their input files to a temporary directory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def writeFile(self, name, rows):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, "w") as out:
+            for row in rows:
+                out.write("\t".join([ str(x) for x in row ]) + "\n")
+        return filename
+
+class TestChromOrder(unittest.TestCase):
+
+    def test_missing_chromosome(self):
+        self.assertEqual(dmaptools.mergeChromLists([["chr1", "chr3"], ["chr1", "chr2", "chr3"]]), ["chr1", "chr2", "chr3"])
+
+    def test_conflicting_orders(self):
+        self.assertRaises(ValueError, dmaptools.mergeChromLists, [["chr1", "chr2"], ["chr2", "chr1"]])
+
+class TestPairChroms(unittest.TestCase):
+
+    def pairs(self, chroms1, chroms2):
+        src1 = iter([ (c, "1" + c) for c in chroms1 ])
+        src2 = iter([ (c, "2" + c) for c in chroms2 ])
+        common = [ c for c in chroms1 if c in chroms2 ]
+        return list(dmaptools.pairChroms(src1, src2, common))
+
+    def test_missing_chromosome(self):
+        self.assertEqual(self.pairs(["chr1", "chr2", "chr3"], ["chr1", "chr3"]),
+                         [(("chr1", "1chr1"), ("chr1", "2chr1")), (("chr3", "1chr3"), ("chr3", "2chr3"))])
+        self.assertEqual(self.pairs(["chr0", "chr1", "chr3"], ["chr1", "chr2", "chr3", "chrX"]),
+                         [(("chr1", "1chr1"), ("chr1", "2chr1")), (("chr3", "1chr3"), ("chr3", "2chr3"))])
+
+    def test_different_order(self):
+        self.assertEqual(self.pairs(["chr1", "chr2"], ["chr2", "chr1"]),
+                         [(("chr1", "1chr1"), ("chr1", "2chr1")), (("chr2", "1chr2"), ("chr2", "2chr2"))])
+
+class TestBEDindex(TempFiles):
+
+    def test_stale_index(self):
+        bedfile = self.writeFile("sites.bed", [["chr1", 10, 0.5], ["chr2", 10, 0.5]])
+        self.assertEqual(dmaptools.indexedChroms(bedfile), ["chr1", "chr2"])
+        self.writeFile("sites.bed", [["chr2", 10, 0.5], ["chr3", 10, 0.5], ["chr4", 10, 0.5]])
+        self.assertEqual(dmaptools.indexedChroms(bedfile), ["chr2", "chr3", "chr4"])
+        # Same size, only the modification time tells the two versions apart
+        self.writeFile("sites.bed", [["chr5", 10, 0.5], ["chr6", 10, 0.5], ["chr7", 10, 0.5]])
+        mtime = os.path.getmtime(bedfile) + 10
+        os.utime(bedfile, (mtime, mtime))
+        self.assertEqual(dmaptools.indexedChroms(bedfile), ["chr5", "chr6", "chr7"])
+
+    def test_unstamped_index(self):
+        bedfile = self.writeFile("sites.bed", [["chr1", 10, 0.5], ["chr2", 10, 0.5]])
+        self.writeFile("sites.bidx", [["chr9", 0]])
+        self.assertEqual(dmaptools.indexedChroms(bedfile), ["chr1", "chr2"])
+
+class TestFisherScorer(unittest.TestCase):
+
+    def test_no_cache(self):
+        scorer = dmaptools.FisherScorer(maxsize=0)
+        self.assertAlmostEqual(scorer.pvalue(10, 2, 3, 9), scorer.pvalue(10, 2, 3, 9))
+        self.assertEqual(len(scorer.cache), 0)
+
+    def test_chisq_min_expected(self):
+        # Rows 10 and 1000, columns 505 and 505: the smallest expected count is 10*505/1010 = 5.
+        scorer = dmaptools.FisherScorer(chisq=5)
+        scorer.pvalues([[5, 5, 500, 500]])
+        self.assertEqual(scorer.napprox, 1)
+        scorer = dmaptools.FisherScorer(chisq=6)
+        scorer.pvalues([[5, 5, 500, 500]])
+        self.assertEqual(scorer.napprox, 0)
+
+class TestColMerger(TempFiles):
+
+    def test_stream_missing_chromosome(self):
+        f1 = self.writeFile("a.bed", [("chr1", 1, 2, "a1"), ("chr1", 5, 6, "a5"), ("chr3", 1, 2, "a31")])
+        f2 = self.writeFile("b.bed", [("chr1", 1, 2, "b1"), ("chr2", 3, 4, "b23"), ("chr3", 1, 2, "b31"), ("chr3", 7, 8, "b37")])
+        out = StringIO()
+        dmaptools.ColMerger([f1, f2], 3).streamMerged(out)
+        self.assertEqual(out.getvalue().split("\n")[1:-1],
+                         ["chr1\t1\t2\ta1\tb1",
+                          "chr1\t5\t6\ta5\tNA",
+                          "chr2\t3\t4\tNA\tb23",
+                          "chr3\t1\t2\ta31\tb31",
+                          "chr3\t7\t8\tNA\tb37"])
+
+class TestMerge(TempFiles):
+
+    def setUp(self):
+        TempFiles.setUp(self)
+        hdr = ("Chrom", "Start", "End", "Strand")
+        self.mat1 = self.writeFile("m1.mat", [hdr + ("A1", "A2"), ("chr1", 10, 11, "+", 0.1, 0.2), ("chr1", 20, 21, "+", 0.3, "NA"),
+                                              ("chr1", 30, 31, "+", 0.5, 0.6), ("chr2", 5, 6, "+", 0.7, 0.8), ("chr3", 1, 2, "+", 0.9, 1.0)])
+        self.mat2 = self.writeFile("m2.mat", [hdr + ("B1",), ("chr1", 10, 11, "+", 0.15), ("chr1", 30, 31, "+", 0.55),
+                                              ("chr3", 1, 2, "+", 0.95), ("chr3", 8, 9, "+", 0.25)])
+        self.sites = self.writeFile("sites.txt", [("Chrom", "Pos"), ("chr1", 10), ("chr1", 20), ("chr1", 30), ("chr2", 5),
+                                                  ("chr3", 1), ("chr3", 8)])
+
+    def merge(self, opts):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.Merger()
+        cmd.parseArgs(opts + [self.sites, self.mat1, self.mat2, outfile])
+        cmd.run()
+        with open(outfile) as f:
+            return f.read().split("\n")
+
+    def test_sorted(self):
+        result = self.merge([])
+        self.assertEqual(result, ["Chrom\tPos\tC1:Avg\tC1:Stdev\tC1:A1\tC1:A2\tC2:Avg\tC2:Stdev\tC2:B1",
+                                  "chr1\t10\t11\t+\t0.1\t0.2\t11\t+\t0.15",
+                                  "chr1\t30\t31\t+\t0.5\t0.6\t31\t+\t0.55",
+                                  "chr3\t1\t2\t+\t0.9\t1.0\t2\t+\t0.95",
+                                  ""])
+        self.assertEqual(self.merge(["-s"]), result)
+
+    def test_index_reuse(self):
+        idx = dmaptools.MatIndex(self.mat1)
+        self.assertEqual(idx.nsites, 5)
+        self.assertEqual(idx.hdr[4:], ["A1", "A2"])
+        self.assertEqual(idx.lookup("chr2", 6), None)
+        fp = idx.lookup("chr2", 5)
+        idx.close()
+        with open(self.mat1) as f:
+            f.seek(fp)
+            self.assertEqual(f.readline(), "chr2\t5\t6\t+\t0.7\t0.8\n")
+        dmaptools.MatIndex(self.mat1).close()
+        self.assertEqual(sys.stderr.getvalue().count("m1.midx"), 1)
+        # A new version of the file, with the same size, is only recognized by its modification time
+        self.writeFile("m1.mat", [("Chrom", "Start", "End", "Strand", "A1", "A2"), ("chr1", 10, 11, "+", 0.1, 0.2), ("chr1", 20, 21, "+", 0.3, "NA"),
+                                  ("chr1", 30, 31, "+", 0.5, 0.6), ("chr4", 5, 6, "+", 0.7, 0.8), ("chr3", 1, 2, "+", 0.9, 1.0)])
+        mtime = os.path.getmtime(self.mat1) + 10
+        os.utime(self.mat1, (mtime, mtime))
+        idx = dmaptools.MatIndex(self.mat1)
+        self.assertEqual(sys.stderr.getvalue().count("m1.midx"), 2)
+        self.assertEqual(idx.lookup("chr2", 5), None)
+        self.assertEqual(idx.lookup("chr4", 5), fp)
+        idx.close()
+
+class TestDMR(TempFiles):
+
+    def sites(self, chrom, c):
+        return [ (chrom, p, p + 1, 100.0 * c / 20, 20, c) for p in [10, 20, 30] ]
+
+    def dmr(self, args):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.DMR()
+        cmd.parseArgs(["-t", "1", "-s", "1", "-c", "1", "-o", outfile] + args)
+        cmd.run()
+        with open(outfile) as f:
+            return [ line.split("\t")[:3] for line in f ][1:]
+
+    def test_missing_chromosome(self):
+        f1 = self.writeFile("a.bed", self.sites("chr1", 18) + self.sites("chr2", 18) + self.sites("chr3", 18))
+        f2 = self.writeFile("b.bed", self.sites("chr1", 2) + self.sites("chr3", 2))
+        expected = [["chr1", "0", "100"], ["chr3", "0", "100"]]
+        cache = os.path.join(self.tmpdir, "w.cache")
+        for opts in [[], ["-f"], ["--threads", "2"], ["-f", "--threads", "2"], ["--cache", cache], ["--cache", cache]]:
+            self.assertEqual(self.dmr(opts + [f1, f2]), expected, opts)
+        self.assertEqual(sys.stderr.getvalue().count("Building window statistics cache"), 1)
+
+    def test_serial_no_index(self):
+        # The plain serial engine follows the chromosomes of the second file by name, without .bidx indexes
+        f1 = self.writeFile("a.bed", self.sites("chr1", 18) + self.sites("chr2", 18) + self.sites("chr3", 18) + self.sites("chr4", 18))
+        f2 = self.writeFile("b.bed", self.sites("chr4", 2) + self.sites("chr3", 2) + self.sites("chr1", 2))
+        self.assertEqual(self.dmr([f1, f2]), [["chr1", "0", "100"], ["chr3", "0", "100"], ["chr4", "0", "100"]])
+        self.assertEqual([ f for f in os.listdir(self.tmpdir) if f.endswith(".bidx") ], [])
+        self.assertFalse("Jumping" in sys.stderr.getvalue())
+
+    def test_jump(self):
+        f1 = self.writeFile("a.bed", self.sites("chr1", 18) + self.sites("chr2", 18) + self.sites("chr3", 18))
+        f2 = self.writeFile("b.bed", self.sites("chr1", 2) + self.sites("chr2", 2) + self.sites("chr3", 2))
+        for (opt, expected) in [("-J", [["chr2", "0", "100"]]), ("-j", [["chr2", "0", "100"], ["chr3", "0", "100"]])]:
+            for opts in [[], ["-f"], ["--threads", "2"], ["-f", "--threads", "2"]]:
+                self.assertEqual(self.dmr(opts + [opt, "chr2", f1, f2]), expected, opts)
+
+    def test_skip_empty(self):
+        # Jumping over empty windows should give the same DMRs as evaluating every window
+        r = random.Random(5)
+        rows = [[], []]
+        for chrom in ["chr1", "chr2", "chr3"]:
+            for start in sorted(r.sample(range(0, 50000, 100), 40)):
+                for p in range(start, start + r.choice([30, 150, 400]), 10):
+                    for k in [0, 1]:
+                        if r.random() < 0.85:
+                            cov = r.randint(1, 20)
+                            c = r.randint(0, cov) if k else r.randint(cov // 2, cov)
+                            rows[k].append((chrom, p, p + 1, 100.0 * c / cov, cov, c))
+        f1 = self.writeFile("a.bed", rows[0])
+        f2 = self.writeFile("b.bed", rows[1])
+        results = []
+        for (skip, gap) in [(True, 0), (False, 0), (True, 2), (False, 2)]:
+            outfile = os.path.join(self.tmpdir, "out.txt")
+            cmd = dmaptools.DMR()
+            cmd.parseArgs(["-t", "1", "-s", "1", "-c", "1", "-g", str(gap), "-o", outfile, f1, f2])
+            cmd.skipEmpty = skip
+            cmd.run()
+            with open(outfile) as f:
+                results.append(f.read())
+        self.assertTrue(len(results[0].split("\n")) > 10)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[2], results[3])
+
+class TestDMR2(TempFiles):
+
+    def dmr2(self, args):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.DMR2()
+        cmd.parseArgs(["-o", outfile] + args)
+        cmd.run()
+        with open(outfile) as f:
+            return f.read()
+
+    def test_insig_threads(self):
+        # The insignificant sites at the end of chr1 should not break the first DMR on chr2
+        f1 = self.writeFile("i1.bed", [("chr1", 100, 101, 100.0, 10, 10), ("chr1", 110, 111, 50.0, 10, 5), ("chr1", 120, 121, 50.0, 10, 5),
+                                       ("chr2", 100, 101, 100.0, 10, 10), ("chr2", 110, 111, 50.0, 10, 5), ("chr2", 120, 121, 100.0, 10, 10),
+                                       ("chr2", 130, 131, 100.0, 10, 10)])
+        f2 = self.writeFile("i2.bed", [("chr1", 100, 101, 0.0, 10, 0), ("chr1", 110, 111, 50.0, 10, 5), ("chr1", 120, 121, 50.0, 10, 5),
+                                       ("chr2", 100, 101, 0.0, 10, 0), ("chr2", 110, 111, 50.0, 10, 5), ("chr2", 120, 121, 0.0, 10, 0),
+                                       ("chr2", 130, 131, 0.0, 10, 0)])
+        opts = ["-t", "2", "-w", "10", "--insig", "2"]
+        serial = self.dmr2(opts + [f1, f2])
+        self.assertEqual(serial.split("\n")[1:], ["chr2\t100\t130\t30\t1.0\t3", ""])
+        self.assertEqual(self.dmr2(opts + ["--threads", "2", f1, f2]), serial)
+
+    def test_serial_no_index(self):
+        sites = lambda chrom, c: [ (chrom, p, p + 1, 100.0 * c / 10, 10, c) for p in [100, 600, 1200] ]
+        f1 = self.writeFile("a.bed", sites("chr1", 10) + sites("chr2", 10) + sites("chr3", 10))
+        f2 = self.writeFile("b.bed", sites("chr3", 0) + sites("chr1", 0))
+        serial = self.dmr2([f1, f2])
+        self.assertEqual(serial.split("\n")[1:], ["chr1\t100\t1200\t1100\t1.0\t3", "chr3\t100\t1200\t1100\t1.0\t3", ""])
+        self.assertEqual([ f for f in os.listdir(self.tmpdir) if f.endswith(".bidx") ], [])
+        self.assertEqual(self.dmr2(["--threads", "2", f1, f2]), serial)
+
+class TestCORR(TempFiles):
+    """The streamed pairwise-complete correlations should match a direct computation on each pair of columns."""
+
+    def setUp(self):
+        TempFiles.setUp(self)
+        r = random.Random(11)
+        rows = []
+        for chrom in ["chr1", "chr2"]:
+            for p in range(0, 3000, 10):
+                base = r.random()
+                vals = [ min(1.0, max(0.0, base + r.gauss(0, 0.2))) for i in range(4) ]
+                vals = [ "NA" if r.random() < 0.15 else (-1 if r.random() < 0.02 else v) for v in vals ]
+                rows.append((chrom, p, p + 1, "+") + tuple(vals))
+        self.values = np.array([ [ np.nan if v == "NA" or v < 0 else v for v in row[4:] ] for row in rows ])
+        self.mat = self.writeFile("m.mat", [("Chrom", "Start", "End", "Strand", "R1", "R2", "R3", "R4")] + rows)
+
+    def expected(self, i, j):
+        both = ~np.isnan(self.values[:,i]) & ~np.isnan(self.values[:,j])
+        (x, y) = (self.values[both,i], self.values[both,j])
+        return (both.sum(), x.mean(), y.mean(), np.corrcoef(x, y)[0,1])
+
+    def corr(self, args):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.CORR()
+        cmd.parseArgs(["-o", outfile] + args)
+        cmd.run()
+        with open(outfile) as f:
+            return [ line.rstrip("\n").split("\t") for line in f ]
+
+    def test_comoments(self):
+        acc = dmaptools.CoMoments(4)
+        for k in range(0, len(self.values), 70):
+            acc.add(self.values[k:k+70])
+        cc = acc.correlation()
+        for i in range(4):
+            for j in range(4):
+                (n, m1, m2, c) = self.expected(i, j)
+                self.assertEqual(acc.n[i,j], n)
+                self.assertAlmostEqual(acc.mean[i,j], m1)
+                self.assertAlmostEqual(cc[i,j], c)
+
+    def test_matrix(self):
+        lines = self.corr(["-n", "97", self.mat])
+        self.assertEqual(lines[0], ["#Correlation", "R1", "R2", "R3", "R4"])
+        self.assertEqual(lines[6], ["#Sites", "R1", "R2", "R3", "R4"])
+        for i in range(4):
+            for j in range(4):
+                (n, m1, m2, c) = self.expected(i, j)
+                self.assertAlmostEqual(float(lines[1 + i][1 + j]), c)
+                self.assertEqual(int(lines[7 + i][1 + j]), n)
+
+    def test_pairs(self):
+        lines = self.corr(["-n", "50", self.mat, "1,3", "4,2"])
+        for (k, (i, j)) in enumerate([(0, 2), (3, 1)]):
+            (n, m1, m2, c) = self.expected(i, j)
+            block = lines[7*k:7*k+6]
+            self.assertEqual(block[:3], [["Sample1:", "R{}".format(i + 1)], ["Sample2:", "R{}".format(j + 1)], ["Num sites:", str(n)]])
+            self.assertAlmostEqual(float(block[3][1]), m1)
+            self.assertAlmostEqual(float(block[4][1]), m2)
+            self.assertAlmostEqual(float(block[5][1]), c)
+
+class TestDIFF(TempFiles):
+
+    def dodmeth(self, args):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.DIFF()
+        cmd.parseArgs(["-o", outfile] + args)
+        cmd.run()
+        with open(outfile) as f:
+            return f.read()
+
+    def test_store(self):
+        hdr = ("#Chrom", "Start", "End", "Meth", "Cov", "C")
+        f1 = self.writeFile("a.bed", [hdr, ("chr1", 10, 11, 0.5, 10, 5), ("chr1", 20, 21, 0.75, 4, 3), ("chr2", 5, 6, 1.0, 8, 8),
+                                      ("chr3", 7, 8, 0.25, 4, 1)])
+        f2 = self.writeFile("b.bed", [hdr, ("chr1", 10, 11, 0.25, 8, 2), ("chr1", 15, 16, 0.5, 2, 1), ("chr1", 20, 21, 0.5, 6, 3),
+                                      ("chr3", 7, 8, 0.0, 2, 0)])
+        s1 = os.path.join(self.tmpdir, "a.dst")
+        s2 = os.path.join(self.tmpdir, "b.dst")
+        dmaptools.packMethFile(f1, s1)
+        dmaptools.packMethFile(f2, s2)
+        text = self.dodmeth(["-c", "4", f1, f2])
+        self.assertEqual(text, "chr1\t10\t11\t0.25\nchr1\t20\t21\t0.25\nchr3\t7\t8\t0.25\n")
+        self.assertEqual(self.dodmeth(["-c", "4", "--threads", "2", f1, f2]), text)
+        self.assertEqual(self.dodmeth(["-c", "4", s1, s2]), text)
+        self.assertEqual(self.dodmeth(["-c", "4", "--threads", "2", s1, f2]), text)
+        self.assertEqual(self.dodmeth(["-t", "5", s1, s2]), self.dodmeth(["-t", "5", f1, f2]))
+
+    def test_serial_no_index(self):
+        hdr = ("#Chrom", "Start", "End", "Meth", "Cov", "C")
+        f1 = self.writeFile("a.bed", [hdr, ("chr1", 10, 11, 0.5, 10, 5), ("chr2", 5, 6, 1.0, 8, 8), ("chr3", 7, 8, 0.25, 4, 1)])
+        f2 = self.writeFile("b.bed", [hdr, ("chr3", 7, 8, 0.0, 2, 0), ("chr1", 10, 11, 0.25, 8, 2)])
+        serial = self.dodmeth([f1, f2])
+        self.assertEqual(serial, "chr1\t10\t11\t2.0\nchr3\t7\t8\t2.0\n")
+        self.assertEqual([ f for f in os.listdir(self.tmpdir) if f.endswith(".bidx") ], [])
+        self.assertEqual(self.dodmeth(["--threads", "2", f1, f2]), serial)
+
+class TestStore(TempFiles):
+    """Commands should give the same results on a text file and on the store packed from it."""
+
+    def setUp(self):
+        TempFiles.setUp(self)
+        r = random.Random(7)
+        self.beds = []
+        for name in ["a", "b"]:
+            rows = []
+            for chrom in ["chr1", "chr2", "chr3"]:
+                for p in sorted(r.sample(range(0, 2000, 2), 300)):
+                    cov = r.randint(1, 20)
+                    c = r.randint(0, cov)
+                    rows.append((chrom, p, p + 1, 1.0 * c / cov, cov, c))
+            self.beds.append(self.writeFile(name + ".bed", rows))
+        rows = [("Chrom", "Start", "End", "Strand", "R1", "R2", "R3")]
+        for chrom in ["chr1", "chr2"]:
+            for p in sorted(r.sample(range(2000), 400)):
+                rows.append((chrom, p, p + 1, "+") + tuple([ "NA" if r.random() < 0.1 else r.random() for i in range(3) ]))
+        self.mat = self.writeFile("m.mat", rows)
+        self.regs = self.writeFile("regs.bed", [("chr1", 100, 600, "+", "g1"), ("chr2", 900, 1500, "-", "g2"), ("chr3", 50, 400, "+", "g3")])
+
+    def pack(self, filename, kind="bed"):
+        outfile = filename + ".dst"
+        dmaptools.packMethFile(filename, outfile, kind=kind)
+        return outfile
+
+    def runCmd(self, cmd, args):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd.parseArgs(["-o", outfile] + args)
+        cmd.run()
+        with open(outfile) as f:
+            return f.read()
+
+    def test_store_reader(self):
+        store = Utils.MethStore(self.pack(self.beds[0]))
+        self.assertEqual(store.chromNames(), ["chr1", "chr2", "chr3"])
+        self.assertEqual(store.nsites, 900)
+        BR = dmaptools.BEDreader(self.beds[0])
+        for chrom in store.chromNames():
+            (i, j) = store.chromRange(chrom)
+            (pos, cov, c) = BR.readChromosomeArrays()
+            self.assertEqual(store.pos[i:j].tolist(), pos.tolist())
+            self.assertEqual(store.cov[i:j].tolist(), cov.tolist())
+            self.assertEqual(store.c[i:j].tolist(), c.tolist())
+
+    def test_dmr(self):
+        stores = [ self.pack(f) for f in self.beds ]
+        for opts in [[], ["-f"], ["--threads", "2"]]:
+            args = opts + ["-w", "200", "-t", "2", "-s", "2", "-c", "1", "-d", "0.05", "-p", "0.5"]
+            text = self.runCmd(dmaptools.DMR(), args + self.beds)
+            self.assertTrue(len(text.split("\n")) > 2)
+            self.assertEqual(self.runCmd(dmaptools.DMR(), args + stores), text, opts)
+
+    def test_dmr2(self):
+        stores = [ self.pack(f) for f in self.beds ]
+        args = ["-t", "2", "-w", "10", "-s", "50", "-d", "0.1"]
+        text = self.runCmd(dmaptools.DMR2(), args + self.beds)
+        self.assertTrue(len(text.split("\n")) > 2)
+        self.assertEqual(self.runCmd(dmaptools.DMR2(), args + stores), text)
+
+    def test_winavg(self):
+        text = self.runCmd(dmaptools.WINAVG(), ["-w", "100", self.beds[0]])
+        self.assertEqual(self.runCmd(dmaptools.WINAVG(), ["-w", "100", self.pack(self.beds[0])]), text)
+
+    def test_winmat(self):
+        text = self.runCmd(dmaptools.WINMAT(), ["-w", "100", self.mat])
+        self.assertEqual(self.runCmd(dmaptools.WINMAT(), ["-w", "100", self.pack(self.mat, kind="mat")]), text)
+
+    def test_regavg(self):
+        args = ["-w", "10", "-m", "2", "-s", "1"]
+        text = self.runCmd(dmaptools.REGAVG(), args + [self.beds[0], self.regs])
+        self.assertEqual(self.runCmd(dmaptools.REGAVG(), args + [self.pack(self.beds[0]), self.regs]), text)
+
+class TestWINAVG(TempFiles):
+
+    def setUp(self):
+        TempFiles.setUp(self)
+        r = random.Random(13)
+        self.sites = []
+        for chrom in ["chr1", "chr2"]:
+            for p in sorted(r.sample(range(5, 3000), 150)):
+                cov = r.randint(0, 12)
+                c = r.randint(0, cov)
+                self.sites.append((chrom, p, p + 1, 100.0 * c / cov if cov else 0.0, cov, c))
+        self.bedfile = self.writeFile("sites.bed", self.sites)
+
+    def brute(self, winsize, step, minsites=0, mincov=4):
+        """Windows computed by summing the sites in each window directly."""
+        result = []
+        for chrom in ["chr1", "chr2"]:
+            sites = [ s for s in self.sites if s[0] == chrom ]
+            last = sites[-1][1]
+            for st in range(0, last + 1, step):
+                inwin = [ s for s in sites if st <= s[1] < st + winsize ]
+                good = [ s for s in inwin if s[4] >= mincov ]
+                tcov = sum([ s[4] for s in good ])
+                tc = sum([ s[5] for s in good ])
+                if inwin and len(good) >= minsites and tcov > 0 and tc > 0:
+                    result.append((chrom, st, st + winsize, 1.0 * tc / tcov))
+        return result
+
+    def readWindows(self, filename):
+        with open(filename) as f:
+            return [ (r[0], int(r[1]), int(r[2]), float(r[3])) for r in [ line.rstrip("\n").split("\t") for line in f ] ]
+
+    def assertWindows(self, found, expected):
+        self.assertEqual([ w[:3] for w in found ], [ w[:3] for w in expected ])
+        for (f, e) in zip(found, expected):
+            self.assertAlmostEqual(f[3], e[3])
+
+    def test_window_starts(self):
+        pos = np.array([3, 4, 40, 41, 250, 900])
+        for (winsize, step) in [(10, 10), (50, 20), (20, 50), (100, 7)]:
+            expected = [ k * step for k in range(0, 1000) if any([ k * step <= p < k * step + winsize for p in pos ]) ]
+            self.assertEqual(dmaptools.windowStarts(pos, winsize, step).tolist(), expected)
+
+    def test_overlapping(self):
+        outfile = os.path.join(self.tmpdir, "win.bed")
+        for (winsize, step, minsites) in [(100, None, 0), (100, 25, 2), (60, 200, 0), (250, 100, 3)]:
+            for opts in [[], ["--threads", "2"]]:
+                cmd = dmaptools.WINAVG()
+                args = ["-w", str(winsize), "-t", str(minsites), "-o", outfile, self.bedfile]
+                if step:
+                    args = ["--step", str(step)] + args
+                cmd.parseArgs(opts + args)
+                cmd.run()
+                self.assertWindows(self.readWindows(outfile), self.brute(winsize, step or winsize, minsites=minsites))
+
+    def test_multiple_sizes(self):
+        outfile = os.path.join(self.tmpdir, "win.bed")
+        cmd = dmaptools.WINAVG()
+        cmd.parseArgs(["-w", "50,200", "--step", "50", "-o", outfile, self.bedfile])
+        cmd.run()
+        for w in [50, 200]:
+            self.assertWindows(self.readWindows(os.path.join(self.tmpdir, "win.{}.bed".format(w))), self.brute(w, 50))
+
+class TestDMRMAT(TempFiles):
+
+    def test_missing_chromosome(self):
+        hdr = ("Chrom", "Start", "End", "Strand")
+        f1 = self.writeFile("a.mat", [hdr + ("A1",), ("chr2", 10, 11, "+", 0.5), ("chr3", 5, 6, "+", 0.1)])
+        f2 = self.writeFile("b.mat", [hdr + ("B1", "B2"), ("chr1", 1, 2, "+", 0.2, "NA"), ("chr2", 10, 11, "+", 0.3, 0.4),
+                                      ("chr2", 20, 21, "+", 0.6, 0.7), ("chr3", 5, 6, "+", 0.8, 0.9)])
+        readers = [ dmaptools.MATreader(f) for f in [f1, f2] ]
+        result = [ (c, p.tolist(), v.tolist()) for (c, p, v) in dmaptools.DMRMAT().readChromosomes(readers) ]
+        nan = float("nan")
+        self.assertEqual([ (c, p) for (c, p, v) in result ], [("chr1", [1]), ("chr2", [10, 20]), ("chr3", [5])])
+        self.assertEqual(repr(result[0][2]), repr([[nan, 0.2, nan]]))
+        self.assertEqual(repr(result[1][2]), repr([[0.5, 0.3, 0.4], [nan, 0.6, 0.7]]))
+        self.assertEqual(result[2][2], [[0.1, 0.8, 0.9]])
+
+class TestREGAVG(TempFiles):
+
+    def regavg(self, bedfiles, regfile):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.REGAVG()
+        cmd.parseArgs(["-w", "10", "-m", "2", "-s", "1", "-o", outfile] + bedfiles + [regfile])
+        cmd.run()
+        with open(outfile) as f:
+            return [ line.rstrip("\n").split("\t") for line in f ][1:]
+
+    def test_missing_chromosome(self):
+        chr1 = [("chr1", 100, 101, 0.2), ("chr1", 150, 151, 0.4)]
+        chr3 = [("chr3", 120, 121, 0.8)]
+        f1 = self.writeFile("a.bed", chr1 + [("chr2", 110, 111, 1.0)] + chr3)
+        f2 = self.writeFile("b.bed", chr1 + chr3)
+        f3 = self.writeFile("c.bed", chr3)
+        regs = self.writeFile("regs.bed", [("chr1", 90, 200, "+", "g1"), ("chr3", 90, 200, "-", "g3")])
+        expected = self.regavg([f2], regs)
+        self.assertEqual(self.regavg([f1], regs), expected)
+        both = self.regavg([f1, f3], regs)
+        self.assertEqual([ row[:4] for row in both ], expected)
+        self.assertEqual([ row[:2] + row[4:] for row in both ], self.regavg([f3], regs))
+
+class TestAverager(TempFiles):
+
+    def test_chunks(self):
+        hdr = ("Chrom", "Start", "End", "Strand", "A", "B")
+        mat = self.writeFile("m.mat", [hdr, ("chr1", 10, 11, "+", 0.5, "NA"), ("chr1", 20, 21, "+", 0.25, -1),
+                                       ("chr1", 30, 31, "+"), ("chr2", 5, 6, "+", 1.0, 0.75, "x"), ("chr2", 8, 9, "+", 0.0, 0.15)])
+        for n in [1, 2, 100]:
+            chunks = list(dmaptools.MATchunks(mat, chunksize=n))
+            self.assertEqual(sum([ c.tolist() for (c, p, v) in chunks ], []), ["chr1", "chr1", "chr2", "chr2"])
+            self.assertEqual(sum([ p.tolist() for (c, p, v) in chunks ], []), [10, 20, 5, 8])
+            self.assertEqual(repr(sum([ v.tolist() for (c, p, v) in chunks ], [])),
+                             repr([[0.5, float("nan")], [0.25, -1.0], [1.0, 0.75], [0.0, 0.15]]))
+            avg = dmaptools.Averager()
+            avg.chunksize = n
+            (nreps, avgs) = avg.methAvg(mat)
+            self.assertEqual(nreps, 2)
+            self.assertAlmostEqual(avgs[0], 0.4375)
+            self.assertAlmostEqual(avgs[1], 0.45)
+            hist = dmaptools.Histcomparer()
+            hist.chunksize = n
+            (nreps, fracs) = hist.methHist(mat)
+            self.assertEqual([ f[0] for f in fracs ], [0.25, 0, 0.25, 0, 0, 0.25, 0, 0, 0, 0.25])
+            self.assertEqual([ f[1] for f in fracs ], [0, 0.5, 0, 0, 0, 0, 0, 0.5, 0, 0])
+
+    def test_header_only(self):
+        mat = self.writeFile("m.mat", [("Chrom", "Start", "End", "Strand", "A", "B")])
+        self.assertEqual(dmaptools.Averager().methAvg(mat), (0, []))
+
+class TestCpG(TempFiles):
+
+    def reference(self, islands, pos):
+        """The class of `pos' according to the first island (by start) whose shelf contains it."""
+        for isl in sorted(islands, key=lambda i: i.start):
+            if isl.start3 <= pos <= isl.end3:
+                return isl.classify(pos)
+        return ""
+
+    def test_overlapping_shelves(self):
+        r = random.Random(11)
+        islands = []
+        for i in range(40):
+            start = r.randint(0, 100000)
+            islands.append(dmaptools.CpGisland(start, start + r.randint(0, 3000)))
+        islands.append(dmaptools.CpGisland(50000, 60000))     # Contains the zones of other islands
+        zones = dmaptools.CpGzones(islands)
+        pos = list(range(-5000, 110000, 7)) + [ i.start3 for i in islands ] + [ i.end + 1 for i in islands ]
+        codes = zones.classify(pos).tolist()
+        self.assertEqual([ dmaptools.CPG_CLASSES[c] for c in codes ], [ self.reference(islands, p) for p in pos ])
+
+    def test_cpg(self):
+        cpgfile = self.writeFile("islands.bed", [("chr1", 10000, 11000), ("chr1", 14000, 14500), ("chr2", 5000, 6000)])
+        sites = [("chr1", 500), ("chr1", 7000), ("chr1", 8500), ("chr1", 10500), ("chr1", 12500), ("chr1", 13000),
+                 ("chr2", 5000), ("chr2", 10000), ("chr2", 10001), ("chr3", 10)]
+        bedfile = self.writeFile("sites.bed", [ (c, p, p + 1, 0.5) for (c, p) in sites ])
+        report = os.path.join(self.tmpdir, "report.txt")
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            for opts in [[], ["--threads", "2"]]:
+                cmd = dmaptools.CPGCOUNT()
+                cmd.chunksize = 3
+                cmd.parseArgs(opts + ["-o", report, cpgfile, bedfile])
+                cmd.run()
+                with open(report) as f:
+                    self.assertEqual(f.read().split("\n")[1], "{}\t10\t2\t3\t2\tsites.cpg.csv".format(bedfile))
+                with open("sites.cpg.csv") as f:
+                    self.assertEqual([ line.split("\t")[1:] for line in f.read().split("\n")[:-1] ],
+                                     [["chr1", "7000", "F"], ["chr1", "8500", "S"], ["chr1", "10500", "I"], ["chr1", "12500", "S"],
+                                      ["chr1", "13000", "S"], ["chr2", "5000", "I"], ["chr2", "10000", "F"]])
+        finally:
+            os.chdir(cwd)
+
+class TestBYCHROM(TempFiles):
+
+    def test_missing_chromosome(self):
+        r = random.Random(17)
+        files = []
+        sums = []
+        for (name, chroms) in [("a", ["chr1", "chr3", "chrUn_1"]), ("b", ["chr1", "chr2", "chr3"])]:
+            rows = [("#Chrom", "Start", "End", "Meth", "Cov", "C")]
+            fsums = {}
+            for chrom in chroms:
+                for p in range(r.randint(5, 20)):
+                    cov = r.randint(0, 30)
+                    c = r.randint(0, cov)
+                    rows.append((chrom, p, p + 1, 0.0, cov, c))
+                    (nr, nc) = fsums.get(chrom, (0, 0))
+                    fsums[chrom] = (nr + cov, nc + c)
+            files.append(self.writeFile(name + ".bed", rows))
+            sums.append(fsums)
+        expected = ["#Chrom\ta\tb"]
+        for chrom in ["chr1", "chr3", "chr2"]:
+            expected.append("\t".join([chrom] + [ str(1.0 * s[chrom][1] / s[chrom][0]) if chrom in s else "0.0" for s in sums ]))
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        for opts in [[], ["-n", "4"], ["--threads", "2", "-n", "7"]]:
+            cmd = dmaptools.BYCHROM()
+            cmd.parseArgs(opts + ["-o", outfile] + files)
+            cmd.run()
+            with open(outfile) as f:
+                self.assertEqual(f.read().split("\n")[:-1], expected, opts)
+
+class TestDMRAVG(TempFiles):
+
+    def test_overlapping_regions(self):
+        # Sites go to the first region (by start) containing them, as in BEDdict.findPos
+        dmrs = self.writeFile("dmrs.bed", [("chr1", 10, 100), ("chr1", 20, 30), ("chr1", 50, 60), ("chr2", 5, 8)])
+        mat = self.writeFile("m.mat", [("Chrom", "Pos", "A", "B"), ("chr1", 5, 0.9, 0.9), ("chr1", 25, 0.2, "NA"),
+                                       ("chr1", 55, 0.4, 0.6), ("chr1", 100, 0.6, 0.2), ("chr2", 8, 0.5, 0.5), ("chr3", 1, 1.0, 1.0)])
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        cmd = dmaptools.DMRAVG()
+        cmd.parseArgs(["-n", "2", "-o", outfile, dmrs, mat])
+        cmd.run()
+        with open(outfile) as f:
+            rows = [ line.rstrip("\n").split("\t") for line in f ][1:]
+        self.assertEqual([ r[:3] for r in rows ], [["chr1", "10", "100"], ["chr1", "20", "30"], ["chr1", "50", "60"], ["chr2", "5", "8"]])
+        self.assertEqual([ [ round(float(x), 6) for x in r[3:] ] for r in rows ], [[0.4, 0.4], [0, 0], [0, 0], [0.5, 0.5]])
+
+if __name__ == "__main__":
+    unittest.main()
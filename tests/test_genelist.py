@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+### Tests for GeneList.py. Run with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import random
+import tempfile
+import sqlite3
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GeneList
+import genes
+
+def makeGenes(ngenes, seed=3):
+    """Returns a Genelist with `ngenes' genes on two chromosomes. Coordinates are drawn from a coarse
+grid, so that many genes and transcripts share their start or end."""
+    r = random.Random(seed)
+    gl = GeneList.Genelist()
+    gl.source = "test"
+    for i in range(ngenes):
+        chrom = r.choice(["chr1", "chr2"])
+        strand = r.choice([1, -1])
+        g = GeneList.Gene("G{}".format(i), chrom, strand)
+        g.name = "N{}".format(i)
+        g.biotype = r.choice(["protein_coding", "lncRNA"])
+        for t in range(r.randint(1, 3)):
+            start = 1000 * r.randint(1, 100)
+            end = start + 1000 * r.randint(1, 5)
+            tr = GeneList.Transcript("G{}.{}".format(i, t), chrom, strand, start, end)
+            tr.exons = []
+            tr.addExon(start, end)
+            tr.cdsstart = start
+            tr.cdsend = end
+            g.addTranscript(tr)
+        gl.add(g, chrom)
+    return gl
+
+class TempDB(unittest.TestCase):
+    """Base class for tests that build gene databases in a temporary directory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def buildDB(self, gl, name, rtree=False):
+        filename = os.path.join(self.tmpdir, name)
+        GeneList.initializeDB(filename, indexes=False, rtree=rtree)
+        gl.saveAllToDB(filename)
+        db = GeneList.GenelistDB()
+        db.dbname = filename
+        return db
+
+    def describeTx(self, tr):
+        return (tr.ID, tr.chrom, tr.strand, tr.txstart, tr.txend, tr.cdsstart, tr.cdsend, [ tuple(e) for e in tr.exons ])
+
+    def describe(self, g):
+        return (g.ID, g.name, g.biotype, g.chrom, g.strand, g.start, g.end, [ self.describeTx(tr) for tr in g.transcripts ])
+
+class TestRtree(TempDB):
+
+    def test_same_results(self):
+        gl = makeGenes(300)
+        plain = self.buildDB(gl, "plain.db")
+        rtree = self.buildDB(gl, "rtree.db", rtree=True)
+        rtree.rtreeWindow = 2000    # Force the window to grow
+        r = random.Random(4)
+        queries = []
+        for i in range(300):
+            start = 500 * r.randint(0, 220)
+            queries.append((r.choice(["chr1", "chr2", "chr3"]), start, start + 500 * r.randint(0, 4)))
+        results = []
+        for db in [plain, rtree]:
+            with db:
+                self.assertEqual(db.hasRtree(), db is rtree)
+                res = []
+                for (chrom, start, end) in queries:
+                    res.append([ g.ID for g in db.allIntersecting(chrom, start, end) ])
+                    res.append(db.findClosestGene(chrom, start, end))
+                    res.append(db.findClosestGene(chrom, start, end, transcripts=False, biotype="lncRNA"))
+                    res.append(db.findClosestGene(chrom, start, end, canonical=True))
+                results.append(res)
+        self.assertTrue(sum([ len(r) for r in results[0][0::4] ]) > 0)
+        self.assertEqual(results[0], results[1])
+
+class TestGenesCommands(TempDB):
+    """genes.py classify and split should give the same results with an in-memory Genelist and a database."""
+
+    def setUp(self):
+        TempDB.setUp(self)
+        self.gl = makeGenes(100)
+        self.gl.sortGenes()     # As the loaders do, so that both lists return genes in the same order
+        self.gl.buildIndexes()
+        self.db = self.buildDB(self.gl, "genes.db")
+        r = random.Random(5)
+        self.bedfile = os.path.join(self.tmpdir, "regs.bed")
+        with open(self.bedfile, "w") as out:
+            for i in range(100):
+                start = 500 * r.randint(0, 220)
+                out.write("{}\t{}\t{}\n".format(r.choice(["chr1", "chr2", "chr3"]), start, start + 100))
+
+    def prog(self, gl, outfile=None):
+        P = genes.Prog("genes.py")
+        P.gl = gl
+        P.args = ["@" + self.bedfile]
+        P.outfile = outfile
+        return P
+
+    def classify(self, gl):
+        outfile = os.path.join(self.tmpdir, "out.txt")
+        genes.Classify().run(self.prog(gl, outfile))
+        with open(outfile) as f:
+            return sorted(f.readlines()[1:])
+
+    def split(self, gl):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            genes.Split().run(self.prog(gl))
+        finally:
+            sys.stdout = stdout
+        result = {}
+        for (name, key) in genes.Classify.regnames:
+            with open(os.path.join(self.tmpdir, "regs-{}.csv".format(name))) as f:
+                result[name] = sorted(f.readlines())
+        return result
+
+    def test_classify(self):
+        expected = self.classify(self.db)
+        self.assertTrue(len([ line for line in expected if "\tintergenic\t" not in line ]) > 0)
+        self.assertEqual(self.classify(self.gl), expected)
+
+    def test_split(self):
+        expected = self.split(self.db)
+        self.assertTrue(len(expected["CodingExon"]) > 0)
+        self.assertEqual(self.split(self.gl), expected)
+
+    def test_intersections(self):
+        hits = self.gl.allIntersections("chr1", 10000, 12000)
+        self.assertEqual([ ix[0] for ix in hits ], self.gl.allIntersecting("chr1", 10000, 12000))
+        self.assertTrue(len(hits) > 0)
+        for (g, how, fa, fb) in hits:
+            self.assertTrue(g.start <= 12000 and g.end >= 10000)
+            self.assertTrue(0 < fa <= 1.0 and 0 < fb <= 1.0)
+
+class TestPreload(TempDB):
+
+    def setUp(self):
+        TempDB.setUp(self)
+        self.gl = makeGenes(200)
+        self.gl.sortGenes()
+        self.dbfile = self.buildDB(self.gl, "genes.db").dbname
+
+    def test_load_all(self):
+        db = GeneList.loadGenes(self.dbfile, preload=True)
+        self.assertTrue(db.preloaded)
+        self.assertEqual(db.ngenes, self.gl.ngenes)
+        self.assertEqual(db.chroms, self.gl.chroms)
+        for chrom in self.gl.chroms:
+            self.assertEqual([ self.describe(g) for g in db.genes[chrom] ], [ self.describe(g) for g in self.gl.genes[chrom] ])
+            for (g1, g2) in zip(db.genes[chrom], self.gl.genes[chrom]):
+                self.assertEqual([ tr.canonical for tr in g1.transcripts ], [ tr.canonical for tr in g2.transcripts ])
+        self.assertEqual([ g.ID for g in db.allIntersecting("chr1", 20000, 30000) ],
+                         [ g.ID for g in self.gl.allIntersecting("chr1", 20000, 30000) ])
+
+    def test_all_transcripts(self):
+        db = GeneList.GenelistDB()
+        db.dbname = self.dbfile
+        found = [ (tr.gene, self.describeTx(tr)) for tr in db.getAllTranscripts() ]
+        expected = []
+        for chrom in sorted(self.gl.chroms):
+            txs = [ (tr.txstart, g.name, tr) for g in self.gl.genes[chrom] for tr in g.transcripts ]
+            # Ties on txstart are broken by the order in which the transcripts were written
+            txs.sort(key=lambda t: t[0])
+            expected.extend([ (name, self.describeTx(tr)) for (start, name, tr) in txs ])
+        self.assertEqual(found, expected)
+
+class TestBuild(TempDB):
+
+    def setUp(self):
+        TempDB.setUp(self)
+        self.gl = makeGenes(200)
+
+    def build(self, name, indexes):
+        filename = os.path.join(self.tmpdir, name)
+        GeneList.initializeDB(filename, indexes=indexes)
+        self.gl.saveAllToDB(filename)
+        return sqlite3.connect(filename)
+
+    def contents(self, conn):
+        return [ sorted(conn.execute("SELECT * FROM {};".format(table)).fetchall())
+                 for table in ["Genes", "Transcripts", "Exons", "Counts"] ]
+
+    def test_indexes(self):
+        conn = self.build("genes.db", False)
+        names = set([ row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index';") ])
+        for (prefix, table, fields) in GeneList.dbIndexes:
+            for field in fields:
+                self.assertIn("{}_{}".format(prefix, field), names)
+        self.assertTrue(conn.execute("SELECT count(*) FROM sqlite_stat1;").fetchone()[0] > 0)
+
+    def test_contents(self):
+        conn = self.build("genes.db", False)
+        ntrans = sum([ len(g.transcripts) for chrom in self.gl.chroms for g in self.gl.genes[chrom] ])
+        self.assertEqual(conn.execute("SELECT ngenes, ntranscripts, nexons FROM Counts;").fetchall(),
+                         [(self.gl.ngenes, ntrans, ntrans)])
+        self.assertEqual(conn.execute("SELECT filename FROM Source;").fetchall(), [(self.gl.source,)])
+        for (strand, start, end, tss) in conn.execute("SELECT strand, start, end, tss FROM Genes;"):
+            self.assertEqual(tss, start if strand == 1 else end)
+        for (strand, start, end, tss) in conn.execute("SELECT strand, txstart, txend, tss FROM Transcripts;"):
+            self.assertEqual(tss, start if strand == 1 else end)
+
+    def test_same_as_indexed(self):
+        """Creating the indexes after loading gives the same database as creating them first."""
+        self.assertEqual(self.contents(self.build("late.db", False)), self.contents(self.build("early.db", True)))
+
+class TestCanonical(TempDB):
+
+    def transcript(self, g, ID, start, end, cds=None, tags=[]):
+        tr = GeneList.Transcript(ID, g.chrom, g.strand, start, end)
+        if cds:
+            tr.cdsstart, tr.cdsend = cds
+        tr.tags = tags
+        g.addTranscript(tr)
+        return tr
+
+    def makeList(self):
+        """Returns a Genelist with genes exercising the canonical policies. In each gene, the
+longest transcript, the one with the longest CDS and the tagged one are all different."""
+        gl = GeneList.Genelist()
+        g = GeneList.Gene("A", "chr1", 1)
+        self.transcript(g, "A.1", 1000, 5000, cds=(1000, 1500))
+        self.transcript(g, "A.2", 1000, 3000, cds=(1000, 2500))
+        self.transcript(g, "A.3", 1000, 2000, tags=["T", "Ensembl_canonical"])
+        gl.add(g, "chr1")
+        # Not coding: cds falls back to the longest transcript
+        g = GeneList.Gene("B", "chr1", -1)
+        self.transcript(g, "B.1", 6000, 7000, tags=["T"])
+        self.transcript(g, "B.2", 6000, 9000)
+        gl.add(g, "chr1")
+        # B.2 and C.1 are also used by the later gene D; those copies are not written
+        g = GeneList.Gene("C", "chr2", 1)
+        self.transcript(g, "C.1", 1000, 2000, cds=(1000, 2000))
+        gl.add(g, "chr2")
+        g = GeneList.Gene("D", "chr2", 1)
+        self.transcript(g, "B.2", 3000, 20000, cds=(3000, 20000), tags=["T", "Ensembl_canonical"])
+        self.transcript(g, "C.1", 3000, 15000)
+        self.transcript(g, "D.1", 3000, 4000, cds=(3000, 3500))
+        gl.add(g, "chr2")
+        return gl
+
+    def canonical(self, policy):
+        """Run makedb with -cp `policy' and return a dictionary mapping each gene to its canonical transcript."""
+        filename = os.path.join(self.tmpdir, "genes.db")
+        P = genes.Prog("genes.py")
+        P.gl = self.makeList()
+        P.args = [filename]
+        P.canonicalPolicy = policy
+        genes.MakeDB().run(P)
+        conn = sqlite3.connect(filename)
+        result = dict(conn.execute("SELECT ID, canonical FROM Genes;").fetchall())
+        flagged = dict(conn.execute("SELECT parentID, ID FROM Transcripts WHERE canonical='Y';").fetchall())
+        self.assertEqual(conn.execute("SELECT count(*) FROM Transcripts WHERE canonical='Y';").fetchone()[0], len(flagged))
+        self.assertEqual(flagged, result)
+        return result
+
+    def test_longest(self):
+        self.assertEqual(self.canonical("longest"), {"A": "A.1", "B": "B.2", "C": "C.1", "D": "D.1"})
+
+    def test_cds(self):
+        self.assertEqual(self.canonical("cds"), {"A": "A.2", "B": "B.2", "C": "C.1", "D": "D.1"})
+
+    def test_tag(self):
+        self.assertEqual(self.canonical("tag"), {"A": "A.3", "B": "B.2", "C": "C.1", "D": "D.1"})
+        self.assertEqual(self.canonical("tag:T"), {"A": "A.3", "B": "B.1", "C": "C.1", "D": "D.1"})
+
+    def test_policy(self):
+        self.assertEqual(GeneList.getCanonicalPolicy("tag:T"), (GeneList.canonicalTagged, "T"))
+        self.assertEqual(GeneList.getCanonicalPolicy("cds"), (GeneList.canonicalCDS, None))
+        self.assertEqual(GeneList.getCanonicalPolicy("shortest"), None)
+
+class TestBatchLoaders(TempDB):
+
+    def setUp(self):
+        TempDB.setUp(self)
+        self.gl = makeGenes(200)
+        self.db = self.buildDB(self.gl, "genes.db")
+        self.genes = dict([ (g.ID, g) for chrom in self.gl.chroms for g in self.gl.genes[chrom] ])
+
+    def queries(self, f, *args):
+        """Returns the result of calling `f' with `args' and the number of database queries it took."""
+        n = self.db.nqueries
+        result = f(*args)
+        return (result, self.db.nqueries - n)
+
+    def test_find_genes(self):
+        with self.db:
+            for chrom in ["chr1", "chr2"]:
+                (genes, n) = self.queries(self.db.findGenes, "SELECT ID FROM Genes WHERE chrom=? ORDER BY rowid;", (chrom,))
+                self.assertEqual(n, 4)
+                self.assertEqual([ self.describe(g) for g in genes ], [ self.describe(g) for g in self.gl.genes[chrom] ])
+                (loaded, n) = self.queries(self.db.loadGenes, [ g.ID for g in genes ])
+                self.assertEqual(n, 3)
+                self.assertEqual(sorted(loaded), sorted([ g.ID for g in genes ]))
+
+    def test_find_gene(self):
+        with self.db:
+            for gid in ["G0", "G17", "G199"]:
+                for name in [gid, "N" + gid[1:]]:
+                    (g, n) = self.queries(self.db.findGene, name)
+                    self.assertEqual(n, 4)
+                    self.assertEqual(self.describe(g), self.describe(self.genes[gid]))
+            self.assertEqual(self.queries(self.db.findGene, "nosuchgene"), (None, 1))
+
+    def test_find_transcript(self):
+        with self.db:
+            for gid in ["G0", "G17", "G199"]:
+                for tr in self.genes[gid].transcripts:
+                    (found, n) = self.queries(self.db.findTranscript, tr.ID)
+                    self.assertEqual(n, 2)
+                    self.assertEqual(self.describeTx(found), self.describeTx(tr))
+
+    def test_large_batch(self):
+        """Batches larger than maxinlist go through a temporary table, still with a fixed number of queries."""
+        self.db.maxinlist = 10
+        counts = []
+        with self.db:
+            for limit in [20, 200]:
+                (genes, n) = self.queries(self.db.loadGenes, [ "G{}".format(i) for i in range(limit) ])
+                self.assertEqual(sorted(genes), sorted([ "G{}".format(i) for i in range(limit) ]))
+                for (gid, g) in genes.items():
+                    self.assertEqual(self.describe(g), self.describe(self.genes[gid]))
+                counts.append(n)
+        self.assertEqual(counts[0], counts[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+### Tests for Regions.py. Run with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Regions
+
+def makeRegions(n, chrom="chr1", seed=5):
+    r = random.Random(seed)
+    regions = []
+    for i in range(n):
+        start = r.randint(1, 1000)
+        regions.append(Regions.Region(chrom, start, start + r.choice([0, 5, 20, 100, 400])))
+    return regions
+
+def overlapping(regions, start, end):
+    """All regions overlapping [start, end], by brute force, in the order used by IntervalIndex."""
+    return sorted([ reg for reg in regions if reg.start <= end and reg.end >= start ], key=lambda reg: reg.start)
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = makeRegions(300)
+        self.index = Regions.IntervalIndex(self.regions)
+        r = random.Random(6)
+        self.starts = [ r.randint(0, 1200) for i in range(200) ]
+        self.ends = [ s + r.choice([0, 1, 10, 50]) for s in self.starts ]
+
+    def test_all(self):
+        for (s, e) in zip(self.starts, self.ends):
+            self.assertEqual(self.index.all(s, e), overlapping(self.regions, s, e))
+            self.assertEqual(self.index.all(s), overlapping(self.regions, s, s))
+
+    def test_batch(self):
+        self.assertEqual(self.index.batch(self.starts, self.ends),
+                         [ overlapping(self.regions, s, e) for (s, e) in zip(self.starts, self.ends) ])
+        self.assertEqual(self.index.batch(self.starts), [ overlapping(self.regions, s, s) for s in self.starts ])
+
+    def test_first(self):
+        expected = [ self.index.items.index(h[0]) if h else -1 for h in self.index.batch(self.starts, self.ends) ]
+        self.assertEqual([ self.index.firstIndex(s, e) for (s, e) in zip(self.starts, self.ends) ], expected)
+        self.assertEqual(list(self.index.batchFirst(self.starts, self.ends)), expected)
+
+class TestBEDdict(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.regions = makeRegions(200, "chr1") + makeRegions(100, "chr2", seed=7)
+        self.bedfile = os.path.join(self.tmpdir, "regions.bed")
+        with open(self.bedfile, "w") as out:
+            out.write("#Chrom\tStart\tEnd\n")
+            for reg in self.regions:
+                out.write("{}\t{}\t{}\n".format(reg.chrom, reg.start, reg.end))
+        self.bd = Regions.BEDdict(self.bedfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def spans(self, regions):
+        return [ (reg.chrom, reg.start, reg.end) for reg in regions ]
+
+    def expected(self, chrom, start, end):
+        return self.spans(overlapping([ reg for reg in self.regions if reg.chrom == chrom ], start, end))
+
+    def test_all_hits(self):
+        positions = range(0, 1500, 7)
+        for chrom in ["chr1", "chr2", "chr3"]:
+            self.assertEqual([ self.spans(h) for h in self.bd.findPositions(chrom, positions) ],
+                             [ self.expected(chrom, p, p) for p in positions ])
+            for p in positions:
+                self.assertEqual(self.spans(self.bd.findAllPos(chrom, p)), self.expected(chrom, p, p))
+        queries = [ Regions.Region(chrom, p, p + 30) for chrom in ["chr1", "chr2", "chr3"] for p in range(1, 1500, 13) ]
+        hits = self.bd.findRegions(queries)
+        for (q, h) in zip(queries, hits):
+            self.assertEqual(self.spans(h), self.expected(q.chrom, q.start, q.end))
+            self.assertEqual(self.spans(self.bd.findAll(q)), self.expected(q.chrom, q.start, q.end))
+            first = self.bd.find(q)
+            self.assertEqual(self.spans([first]) if first else [], self.spans(h[:1]))
+
+if __name__ == "__main__":
+    unittest.main()